@@ -55,6 +55,7 @@ setup(name='comptests',
           'console_scripts': [
               'comptests = comptests:main_comptests',
               'comptests-to-junit = comptests.comptest_to_junit:comptest_to_junit_main',
+              'comptests-stats = comptests.stats:comptests_stats_main',
           ],
 
       },
@@ -0,0 +1,251 @@
+# -*- coding: utf-8 -*-
+import re
+import time
+import traceback
+from collections import OrderedDict
+
+from compmake import Promise
+from contracts import contract
+from contracts.utils import indent
+
+from . import logger
+from .dedupe import aliases_last
+from .fingerprints import comptest_identity
+from .impact import Impact, run_traced
+from .incremental import pair_incremental_token, record_success
+from .objcache import get_object_refs, resolve_object
+from .selection import get_config_files, get_skip_reason
+from .state import deferred_writes
+from .timing import Timing, get_cputime, get_peak_rss, record_timing
+
+__all__ = [
+    'CellOutcome',
+    'is_batch_job',
+]
+
+# Job ids of the batches end with this pattern
+BATCH_JOB_ID = re.compile(r'.*-batch\d+$')
+
+
+def is_batch_job(job_id):
+    return BATCH_JOB_ID.match(job_id) is not None
+
+
+class CellOutcome(object):
+    """
+        Outcome of one cell of a batched pair test.
+
+        If the test raised an exception, ``exception`` and ``backtrace``
+        are set; otherwise ``result`` is what the test returned.
+    """
+
+    def __init__(self, name, result=None, exception=None, backtrace=None,
+                 walltime=None, cputime=None):
+        self.name = name
+        self.result = result
+        self.exception = exception
+        self.backtrace = backtrace
+        self.walltime = walltime
+        self.cputime = cputime
+
+    def failed(self):
+        return self.exception is not None
+
+    def __repr__(self):
+        if self.failed():
+            return 'CellOutcome(%s: failed: %s)' % (self.name, self.exception)
+        return 'CellOutcome(%s: %r)' % (self.name, self.result)
+
+
+@contract(cells='list(tuple(str,str,str))', size='int,>=1')
+def split_in_batches(cells, size):
+    """ Splits the list of cells in consecutive batches of at most size cells. """
+    return [cells[i:i + size] for i in range(0, len(cells), size)]
+
+
+@contract(cells='list(tuple(str,str,str))', size='None|int,>=1')
+def split_by_row(cells, size=None):
+    """
+        Splits the list of cells in batches that contain the cells of
+        only one row (id_ob1), with at most size cells each (if given),
+        so that each job needs to load only one object of the first kind.
+    """
+    rows = OrderedDict()
+    for cell in cells:
+        _, id_ob1, _ = cell
+        rows.setdefault(id_ob1, []).append(cell)
+    batches = []
+    for row in rows.values():
+        if size is None:
+            batches.append(row)
+        else:
+            batches.extend(split_in_batches(row, size))
+    return batches
+
+
+def run_pairs_batch(func, cells, objs1, objs2, incremental=None, timing=None,
+                    footprints=None, aliases=None):
+    """
+        Runs the test for a batch of cells.
+
+        cells: list of (name, id_ob1, id_ob2)
+        objs1, objs2: dict id -> object (or ObjectRef)
+        incremental: dict (id_ob1, id_ob2) -> token of incremental_token()
+        timing: timing DB where to record each cell (see run_timed())
+        footprints: footprints DB where to record each cell (see run_traced())
+        aliases: list of (name, id_ob1, id_ob2, cell) for the cells that
+        reuse the outcome of another cell (see --dedupe_tests)
+
+        Returns a dict (id_ob1, id_ob2) -> CellOutcome.
+    """
+    outcomes = {}
+    # the records of the cells are written at the end of the batch
+    with deferred_writes():
+        for name, id_ob1, id_ob2 in cells:
+            t0 = time.time()
+            c0 = get_cputime()
+            r0 = get_peak_rss()
+            try:
+                ob1 = resolve_object(objs1[id_ob1])
+                ob2 = resolve_object(objs2[id_ob2])
+                result = run_traced(footprints, comptest_identity(func, id_ob1, id_ob2),
+                                    [(objs1[id_ob1], ob1), (objs2[id_ob2], ob2)],
+                                    func, id_ob1, ob1, id_ob2, ob2)
+            except Exception as e:
+                outcome = CellOutcome(name, exception='%s: %s' % (type(e).__name__, e),
+                                      backtrace=traceback.format_exc())
+                logger.error('Cell %s failed: %s' % (name, outcome.exception))
+            else:
+                outcome = CellOutcome(name, result=result)
+                if incremental is not None:
+                    record_success(incremental[(id_ob1, id_ob2)])
+            outcome.walltime = time.time() - t0
+            outcome.cputime = get_cputime() - c0
+            outcomes[(id_ob1, id_ob2)] = outcome
+            record_timing(timing, comptest_identity(func, id_ob1, id_ob2),
+                          outcome.walltime, outcome.cputime,
+                          'failed' if outcome.failed() else 'ok', peak_rss0=r0)
+    for name, id_ob1, id_ob2, cell in aliases or []:
+        outcome = outcomes[cell]
+        outcomes[(id_ob1, id_ob2)] = CellOutcome(name, result=outcome.result,
+                                                 exception=outcome.exception,
+                                                 backtrace=outcome.backtrace,
+                                                 walltime=0.0, cputime=0.0)
+    return outcomes
+
+
+def check_batches(function_name, *batches):
+    """ Fails if any of the cells in the batches failed. """
+    failed = []
+    for outcomes in batches:
+        for _, outcome in sorted(outcomes.items()):
+            if outcome.failed():
+                failed.append(outcome)
+    if failed:
+        msg = '%d cells of %s failed:' % (len(failed), function_name)
+        for outcome in failed:
+            msg += '\n\n%s: %s' % (outcome.name, outcome.exception)
+            msg += '\n' + indent(outcome.backtrace, '> ')
+        raise Exception(msg)
+
+
+def merge_batches(*batches):
+    """ Merges the outcomes of the batches in one dict. """
+    res = {}
+    for outcomes in batches:
+        res.update(outcomes)
+    return res
+
+
+def define_tests_pairs_batches(cx, objspec1, objspec2, combinations,
+                               objs1, objs2, func, batch, create_reports,
+                               report_suffix, excluded=None, symmetric=False,
+                               by_row=False, aliased=None):
+    """
+        Defines the jobs for the pair test ``func``, grouping the cells
+        in jobs of ``batch`` cells each.
+
+        combinations: sequence of (context, id_ob1, id_ob2)
+        objs1, objs2: dict id -> job_id of the instance job
+        excluded: (id_ob1, id_ob2) -> reason, for the cells already excluded
+        symmetric: whether the reports show the matrix mirrored
+        by_row: each job has the cells of only one row (at most batch
+        cells if batch > 1)
+        aliased: (id_ob1, id_ob2) -> cell whose outcome is reused, which
+        is then computed in the same job
+    """
+    from .reports import report_results_pairs, report_results_pairs_jobs
+    refs1 = get_object_refs(cx, objspec1, objs1)
+    refs2 = get_object_refs(cx, objspec2, objs2)
+
+    cells = []
+    tokens = {}
+    # cell -> list of (name, id_ob1, id_ob2, cell) of its aliases
+    aliases = {}
+    aliased = aliased or {}
+    # (id_ob1, id_ob2) -> reason why there is no job
+    excluded = dict(excluded or {})
+    for c, id_ob1, id_ob2 in aliases_last(combinations, aliased):
+        token = pair_incremental_token(func, refs1[id_ob1], refs2[id_ob2])
+        config_files = (get_config_files(objspec1, id_ob1) +
+                        get_config_files(objspec2, id_ob2))
+        reason = get_skip_reason(func, [id_ob1, id_ob2], token, False, config_files)
+        if reason is not None:
+            excluded[(id_ob1, id_ob2)] = reason
+            continue
+        # same name as the job we would have had without batching
+        name = '%s-f' % c._job_prefix
+        cell = aliased.get((id_ob1, id_ob2), None)
+        if cell in tokens:
+            aliases.setdefault(cell, []).append((name, id_ob1, id_ob2, cell))
+            continue
+        tokens[(id_ob1, id_ob2)] = token
+        cells.append((name, id_ob1, id_ob2))
+
+    promises = []
+    jobs = {}
+    if by_row:
+        batches = split_by_row(cells, batch if batch > 1 else None)
+    else:
+        batches = split_in_batches(cells, batch)
+    for i, cells_i in enumerate(batches):
+        used1 = sorted(set(id_ob1 for _, id_ob1, _ in cells_i))
+        used2 = sorted(set(id_ob2 for _, _, id_ob2 in cells_i))
+        ob1s = dict((k, refs1[k]) for k in used1)
+        ob2s = dict((k, refs2[k]) for k in used2)
+        # with --instance_batch several objects come from the same job
+        instance_jobs = set(objs1[k] for k in used1) | set(objs2[k] for k in used2)
+        extra_dep = [Promise(job_id) for job_id in sorted(instance_jobs)]
+        if any(tokens.values()):
+            incremental = dict(((a, b), tokens[(a, b)]) for _, a, b in cells_i)
+        else:
+            incremental = None
+        aliases_i = [a for _, id_ob1, id_ob2 in cells_i
+                     for a in aliases.get((id_ob1, id_ob2), [])]
+        res = cx.comp_config(run_pairs_batch, func, cells_i, ob1s, ob2s,
+                             incremental=incremental,
+                             timing=Timing.filename,
+                             footprints=Impact.filename,
+                             aliases=aliases_i or None,
+                             job_id='batch%d' % i,
+                             command_name=func.__name__,
+                             extra_dep=extra_dep)
+        promises.append(res)
+        for _, id_ob1, id_ob2 in cells_i:
+            jobs[(id_ob1, id_ob2)] = res.job_id
+        for _, id_ob1, id_ob2, _ in aliases_i:
+            jobs[(id_ob1, id_ob2)] = res.job_id
+
+    cx.comp(check_batches, func.__name__, *promises, job_id='batches')
+
+    if create_reports:
+        r = cx.comp_dynamic(report_results_pairs_jobs,
+                            func, objspec1.name, objspec2.name, jobs,
+                            excluded=excluded, symmetric=symmetric)
+        cx.add_report(r, 'jobs_pairs' + report_suffix)
+
+        results = cx.comp(merge_batches, *promises)
+        r = cx.comp(report_results_pairs,
+                    func, objspec1.name, objspec2.name, results,
+                    excluded=excluded, symmetric=symmetric)
+        cx.add_report(r, 'pairs' + report_suffix)
@@ -0,0 +1,137 @@
+# -*- coding: utf-8 -*-
+import types
+
+import six
+from contracts import contract
+
+from . import logger
+
+__all__ = [
+    'get_jobs_not_run',
+    'set_max_failures',
+]
+
+# Key in the compmake DB with the list of the jobs that were not
+# started because of the failure budget (read by comptests-to-junit).
+JOBS_NOT_RUN_KEY = 'comptests-jobs-not-run'
+
+# the compmake events that we use
+BUDGET_EVENTS = ['manager-phase', 'manager-succeeded']
+
+
+class FailureBudget(object):
+    """ Static storage """
+    # Stop starting jobs after this many failures (None: no limit).
+    # This is set by CompTests (--fail_fast, --max_failures).
+    max_failures = None
+    # compmake's Manager.instance_some_jobs(), which we wrap
+    instance_some_jobs = None
+    # jobs not started in this run
+    not_run = set()
+
+
+@contract(max_failures='None|int,>=1')
+def set_max_failures(max_failures):
+    """
+        After max_failures jobs failed, compmake does not start any
+        other job; the jobs already running are completed.
+    """
+    FailureBudget.max_failures = max_failures
+    if max_failures is not None:
+        install_failure_budget()
+
+
+def install_failure_budget():
+    if FailureBudget.instance_some_jobs is not None:
+        return
+    Manager = get_manager_class()
+    if Manager is None:
+        FailureBudget.max_failures = None
+        return
+    from compmake.events.registrar import register_handler
+    FailureBudget.instance_some_jobs = Manager.instance_some_jobs
+    Manager.instance_some_jobs = instance_some_jobs_with_budget
+    register_handler('manager-phase', manager_phase)
+    register_handler('manager-succeeded', manager_succeeded)
+
+
+def get_manager_class():
+    """
+        Returns compmake's Manager if it has the method instance_some_jobs()
+        that we wrap, with the arguments we expect, and the events that we
+        use; otherwise warns and returns None (there is no budget).
+    """
+    try:
+        from compmake.events.registered_events import compmake_registered_events
+        from compmake.jobs.manager import Manager
+    except ImportError as e:
+        msg = str(e)
+    else:
+        f = getattr(Manager, 'instance_some_jobs', None)
+        f = getattr(f, '__func__', f)  # unbound method in Python 2
+        missing = [e for e in BUDGET_EVENTS if not e in compmake_registered_events]
+        if not isinstance(f, types.FunctionType):
+            msg = 'Manager.instance_some_jobs() not found'
+        elif six.get_function_code(f).co_argcount != 1:  # only self
+            msg = 'Manager.instance_some_jobs() takes other arguments'
+        elif missing:
+            msg = 'events not found: %s' % ', '.join(missing)
+        else:
+            return Manager
+    logger.warning('Cannot stop after the failures (%s); '
+                   'this version of compmake is not supported.' % msg)
+    return None
+
+
+def instance_some_jobs_with_budget(self):
+    """ Replaces Manager.instance_some_jobs(). """
+    budget = FailureBudget.max_failures
+    if budget is None or len(self.failed) < budget:
+        return FailureBudget.instance_some_jobs(self)
+
+    not_run = self.todo | self.ready_todo
+    if not_run:
+        logger.error('%d jobs failed: not starting the other %d jobs.' %
+                     (len(self.failed), len(not_run)))
+        # for compmake they are blocked by the failures
+        self.blocked.update(not_run)
+        self.todo.clear()
+        self.ready_todo.clear()
+        FailureBudget.not_run.update(not_run)
+        try:
+            self.db[JOBS_NOT_RUN_KEY] = sorted(FailureBudget.not_run)
+        except Exception as e:
+            logger.warning('Could not save the list of jobs not run: %s' % e)
+    return {'jobs': 'too many failures'}
+
+
+def manager_phase(context, event):
+    if event.kwargs['phase'] == 'init':
+        FailureBudget.not_run = set()
+        db = context.get_compmake_db()
+        if JOBS_NOT_RUN_KEY in db:
+            del db[JOBS_NOT_RUN_KEY]
+
+
+def manager_succeeded(context, event):
+    """ Writes the partial summary if we stopped early. """
+    if not FailureBudget.not_run:
+        return
+    kwargs = event.kwargs
+    failed = sorted(kwargs['failed'])
+    s = 'Stopped after %d failures (budget: %d).' % (len(failed),
+                                                     FailureBudget.max_failures)
+    s += '\n %30s : %d' % ('done', len(kwargs['done']))
+    s += '\n %30s : %d' % ('failed', len(failed))
+    s += '\n %30s : %d' % ('not run', len(FailureBudget.not_run))
+    s += '\n\nFailed jobs:'
+    for job_id in failed:
+        s += '\n %30s : failed' % job_id
+    logger.error(s)
+
+
+def get_jobs_not_run(db):
+    """ Returns the jobs not run in the last run because of the failure budget. """
+    if JOBS_NOT_RUN_KEY in db:
+        return set(db[JOBS_NOT_RUN_KEY])
+    return set()
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import sqlite3
+import sys
+import time
+
+from contracts import contract
+
+from . import logger
+from .fingerprints import sha1_of
+from .state import connect_state_db
+
+__all__ = [
+    'CollectionStore',
+]
+
+
+class CollectionStore(object):
+    """
+        Remembers the nose tests collected for each module, together with
+        a fingerprint of the source files of the module, so that the next
+        runs do not need to import the module to know its tests.
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _connect(self):
+        return connect_state_db(self.filename,
+                                'CREATE TABLE IF NOT EXISTS collections ('
+                                'module TEXT PRIMARY KEY, fingerprint TEXT, '
+                                'tests TEXT, timestamp REAL)')
+
+    @contract(module=str, fingerprint=str)
+    def get(self, module, fingerprint):
+        """ Returns the tests collected with the same fingerprint, or None. """
+        conn = self._connect()
+        try:
+            rows = list(conn.execute('SELECT tests FROM collections '
+                                     'WHERE module = ? AND fingerprint = ?',
+                                     (module, fingerprint)))
+        finally:
+            conn.close()
+        if not rows:
+            return None
+        return [(str(name), index, str(test_id))
+                for name, index, test_id in json.loads(rows[0][0])]
+
+    @contract(module=str, fingerprint=str, tests='list(tuple(str,int,str))')
+    def put(self, module, fingerprint, tests):
+        conn = self._connect()
+        try:
+            with conn:
+                conn.execute('INSERT OR REPLACE INTO collections VALUES (?, ?, ?, ?)',
+                             (module, fingerprint, json.dumps(tests), time.time()))
+        finally:
+            conn.close()
+
+
+class NoseCollection(object):
+    """ Static storage """
+    # SQLite file; None means that the tests are collected at each run.
+    # This is set by CompTests.
+    filename = None
+
+
+@contract(module=str, returns='None|str')
+def module_fingerprint(module):
+    """
+        Fingerprint of the source files of the module (their names, sizes
+        and modification times), found without importing it.
+        Returns None if the module is not found.
+    """
+    import pkgutil
+    try:
+        loader = pkgutil.find_loader(module)
+        filename = loader.get_filename(module)
+    except Exception:
+        return None
+    if os.path.basename(filename).startswith('__init__.'):
+        files = []
+        for dirpath, _, filenames in os.walk(os.path.dirname(filename)):
+            files.extend(os.path.join(dirpath, f) for f in filenames
+                         if f.endswith('.py'))
+    else:
+        files = [filename]
+    entries = []
+    for f in sorted(files):
+        try:
+            st = os.stat(f)
+        except OSError:
+            continue
+        entries.append('%s %d %r' % (f, st.st_size, st.st_mtime))
+    return sha1_of('%s\n%s' % (sys.version, '\n'.join(entries)))
+
+
+def get_collected_tests(filename, module):
+    """ Returns the tests of the module collected in a previous run, or None. """
+    if filename is None:
+        return None
+    fingerprint = module_fingerprint(module)
+    if fingerprint is None:
+        return None
+    try:
+        return CollectionStore(filename).get(module, fingerprint)
+    except sqlite3.Error as e:
+        logger.warning('Could not read the tests of %s from %s: %s' % (module, filename, e))
+        return None
+
+
+def save_collected_tests(filename, module, fingerprint, tests):
+    """
+        Saves the tests of the module for the next runs (if filename is not
+        None), with the fingerprint of the module taken before collecting.
+    """
+    if filename is None or fingerprint is None:
+        return
+    try:
+        CollectionStore(filename).put(module, fingerprint, tests)
+    except sqlite3.Error as e:
+        logger.warning('Could not save the tests of %s in %s: %s' % (module, filename, e))
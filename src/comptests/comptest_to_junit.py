@@ -3,11 +3,14 @@
 import sys
 
 from compmake.exceptions import UserError
-from compmake.jobs.storage import all_jobs, get_job_cache
+from compmake.jobs.storage import all_jobs, get_job_cache, get_job_userobject
 from compmake.storage.filesystem import StorageFilesystem
 from compmake.structures import Cache
 from contracts import check_isinstance
 from . import logger
+from .batches import is_batch_job
+from .budget import get_jobs_not_run
+from .results import Skipped
 
 
 def comptest_to_junit_main():
@@ -46,10 +49,19 @@ def junit_xml(compmake_db):
         logger.error('too few jobs (I expect at least %s)' % N)
         sys.exit(128)
 
+    not_run = get_jobs_not_run(compmake_db)
+
     test_cases = []
     for job_id in jobs:
-        tc = junit_test_case_from_compmake(compmake_db, job_id)
-        test_cases.append(tc)
+        if job_id in not_run:
+            tc = junit_test_case_not_run(compmake_db, job_id)
+            test_cases.append(tc)
+        elif is_batch_job(job_id):
+            tcs = junit_test_cases_from_batch(compmake_db, job_id)
+            test_cases.extend(tcs)
+        else:
+            tc = junit_test_case_from_compmake(compmake_db, job_id)
+            test_cases.append(tc)
 
     ts = TestSuite("comptests_test_suite", test_cases)
 
@@ -93,10 +105,45 @@ def junit_test_case_from_compmake(db, job_id):
         message = cache.exception
         output = cache.exception + "\n" + cache.backtrace
         tc.add_failure_info(message, output)
+    elif cache.state == Cache.BLOCKED:
+        # for example, the test of an alias whose object failed (--dedupe_tests)
+        tc.add_skipped_info('Not run because a job it depends on failed.')
+
+    return tc
 
+
+def junit_test_case_not_run(db, job_id):
+    """ Test case for a job not started because of too many failures. """
+    cache = get_job_cache(job_id, db=db)
+    if cache.state in [Cache.DONE, Cache.FAILED]:  # it ran afterwards
+        return junit_test_case_from_compmake(db, job_id)
+    from junit_xml import TestCase
+    tc = TestCase(name=job_id, classname=None)
+    tc.add_skipped_info('Not run because of too many failures.')
     return tc
 
 
+def junit_test_cases_from_batch(db, job_id):
+    """ Returns one test case for each cell of a batch of pair tests. """
+    from junit_xml import TestCase
+    cache = get_job_cache(job_id, db=db)
+    if cache.state != Cache.DONE:
+        return [junit_test_case_from_compmake(db, job_id)]
+
+    outcomes = get_job_userobject(job_id, db)
+    tcs = []
+    for _, outcome in sorted(outcomes.items()):
+        tc = TestCase(name=outcome.name, classname=None,
+                      elapsed_sec=outcome.cputime)
+        if outcome.failed():
+            output = outcome.exception + "\n" + outcome.backtrace
+            tc.add_failure_info(outcome.exception, output)
+        elif isinstance(outcome.result, Skipped):
+            tc.add_skipped_info(outcome.result.get_reason())
+        tcs.append(tc)
+    return tcs
+
+
 def remove_escapes(s):
     if s is None:
         return None
@@ -9,8 +9,21 @@ from contracts.utils import raise_desc, raise_wrapped
 from quickapp import QuickApp
 
 from . import logger
+from .budget import set_max_failures
+from .collection import NoseCollection
+from .dedupe import Aliases
 from .find_modules_imp import find_modules, find_modules_main
-from .nose import jobs_nosetests, jobs_nosetests_single
+from .forking import Preloaded
+from .impact import Impact, get_changed_files, get_footprint_store
+from .incremental import Incremental, get_incremental_store
+from .nose import (define_nose_jobs, get_nose_cases, jobs_nosetests,
+                   nosetests_identity, write_nosetests_coverage_report)
+from .objcache import set_object_cache_size
+from .objstore import ObjectStore, PersistentObjects
+from .priorities import use_durations_as_priorities
+from .selection import Selection, in_this_shard, parse_shard, set_shard
+from .timing import Timing, get_timing_store
+from .transport import Transport
 
 __all__ = [
     'CompTests',
@@ -42,6 +55,13 @@ class CompTests(QuickApp):
     global_output_dir = 'out-comptests'
     output_dir_for_current_test = None
 
+    # number of cells in each job for the pairs tests
+    batch = 1
+    # whether each job has the cells of only one row (object of the first kind)
+    by_row = False
+    # number of objects instanced by each job
+    instance_batch = 1
+
     cmd = 'comptests'
 
     hook_name = 'jobs_comptests'
@@ -51,11 +71,65 @@ class CompTests(QuickApp):
                           help='exclude these modules (comma separated)')
 
         params.add_flag('nonose', help='Disable nosetests')
+        params.add_int('nose_batch', default=0,
+                       help='Collect the nose tests in-process and run them in jobs '
+                            'of this many tests (0: one nosetests process per module)')
+        params.add_string('preload', default='',
+                          help='Packages (comma separated) that each worker imports once '
+                               'before forking the runs of nosetests, e.g. numpy,scipy')
         params.add_flag('coverage', help='Enable coverage module')
         params.add_flag('nocomp', help='Disable comptests hooks')
 
         params.add_flag('reports', help='Create reports jobs')
-        params.add_flag('circle', help='Do CircleCI optimization')
+        params.add_flag('circle', help='Do CircleCI optimization (same as --shard with '
+                                       'CIRCLE_NODE_INDEX/CIRCLE_NODE_TOTAL)')
+        params.add_string('shard', default=None,
+                          help='Run only the shard i/N of the tests (0 <= i < N)')
+        params.add_string('shard_durations', default=None,
+                          help='JSON file with the durations of the tests, used to '
+                               'balance the shards (the same file on all machines)')
+        params.add_int('batch', default=1,
+                       help='Group the cells of pairs tests in jobs of this size')
+        params.add_flag('by_row',
+                        help='Group the cells of pairs tests sharing the first object '
+                             'in the same job (at most --batch cells per job if given)')
+        params.add_int('objcache', default=0,
+                       help='Memory (MB) for the cache of test objects in each worker '
+                            '(0: disabled; the tests must not modify the objects)')
+        params.add_int('instance_batch', default=1,
+                       help='Instance the test objects in jobs of this many objects')
+        params.add_int('objstore', default=0,
+                       help='Disk space (MB) for the test objects kept across runs '
+                            'in the state directory (0: disabled)')
+        params.add_flag('objstore_clear',
+                        help='Remove the test objects kept in the state directory '
+                             '(e.g. after changing the data files that they read)')
+        params.add_flag('dedupe_tests',
+                        help='Run the tests once for the objects with the same class and '
+                             'params, reusing the results for the others')
+        params.add_flag('mmap_arrays',
+                        help='Store the big NumPy arrays of the test objects in files '
+                             'that the tests memory-map, rather than in the compmake DB')
+        params.add_string('state', default=None,
+                          help='Directory for the data kept across runs '
+                               '(default: <output>-state)')
+        params.add_flag('incremental',
+                        help='Skip the tests that did not change since they succeeded '
+                             '(only the module of the test and the classes of '
+                             'the objects are checked, not the other modules)')
+        params.add_flag('footprints',
+                        help='Record the source files executed by each test '
+                             '(used by --changed-since)')
+        params.add_string('changed_since', default=None,
+                          help='Run only the tests affected by the files changed '
+                               'since this git revision')
+        params.add_flag('full_pairs',
+                        help='Run the pair tests on all pairs, even if they ask for sampling')
+        params.add_flag('fail_fast', help='Stop starting jobs after the first failure')
+        params.add_int('max_failures', default=None,
+                       help='Stop starting jobs after this many failures')
+        params.add_flag('notiming',
+                        help='Do not record the duration of the tests (see comptests-stats)')
 
         params.accept_extra()
 
@@ -64,12 +138,82 @@ class CompTests(QuickApp):
         CompTests.global_output_dir = self.get_options().output
         self.info('Setting output dir to %s' % CompTests.global_output_dir)
         CompTests.output_dir_for_current_test = None
+        CompTests.batch = self.get_options().batch
+        CompTests.by_row = self.get_options().by_row
+        CompTests.instance_batch = self.get_options().instance_batch
+        set_object_cache_size(self.get_options().objcache)
+        Preloaded.packages = [p for p in self.get_options().preload.split(',') if p]
+        if self.get_options().mmap_arrays:
+            Transport.dirname = os.path.abspath(os.path.join(CompTests.global_output_dir,
+                                                             'arrays'))
+        else:
+            Transport.dirname = None
+
+        state_dir = self.get_state_dir()
+        objstore = self.get_options().objstore
+        if self.get_options().objstore_clear:
+            removed = ObjectStore(os.path.join(state_dir, 'objects')).clear()
+            self.info('Removed all the %d stored objects.' % removed)
+        if objstore > 0:
+            PersistentObjects.dirname = os.path.join(state_dir, 'objects')
+            removed = ObjectStore(PersistentObjects.dirname).evict(objstore * 1024 * 1024)
+            if removed:
+                self.info('Removed %d objects from %s.' % (removed, PersistentObjects.dirname))
+        else:
+            PersistentObjects.dirname = None
+
+        if self.get_options().incremental:
+            Incremental.filename = os.path.join(state_dir, 'incremental.sqlite')
+            self.info('Incremental mode: using %s' % Incremental.filename)
+        else:
+            Incremental.filename = None
+
+        NoseCollection.filename = os.path.join(state_dir, 'collection.sqlite')
+
+        if self.get_options().notiming:
+            Timing.filename = None
+        else:
+            Timing.filename = os.path.join(state_dir, 'timing.sqlite')
+        # start the longest jobs first
+        use_durations_as_priorities(Timing.filename)
+
+        changed_since = self.get_options().changed_since
+        if self.get_options().footprints or changed_since is not None:
+            Impact.filename = os.path.join(state_dir, 'footprints.sqlite')
+        else:
+            Impact.filename = None
+        if changed_since is not None:
+            Impact.changed_files = get_changed_files(changed_since)
+            self.info('%d files changed since %s.' % (len(Impact.changed_files),
+                                                      changed_since))
+        else:
+            Impact.changed_files = None
+
+        # the workers find the DBs already created (in WAL mode)
+        if Incremental.filename is not None:
+            get_incremental_store(Incremental.filename).create()
+        if Timing.filename is not None:
+            get_timing_store(Timing.filename).create()
+        if Impact.filename is not None:
+            get_footprint_store(Impact.filename).create()
+
+        Selection.full_pairs = self.options.full_pairs
+        Aliases.tests = self.options.dedupe_tests
+        Aliases.canonical = {}
+
+        if self.options.fail_fast:
+            set_max_failures(1)
+        else:
+            set_max_failures(self.options.max_failures)
 
         GlobalConfig.global_load_dir('default')
 
         modules = self.get_modules()
 
-        if self.options.circle:
+        shard = None
+        if self.options.shard is not None:
+            shard = parse_shard(self.options.shard)
+        elif self.options.circle:
             env = os.environ
             v_index, v_total = 'CIRCLE_NODE_INDEX', 'CIRCLE_NODE_TOTAL'
             if v_index in env and v_total in env:
@@ -77,14 +221,16 @@ class CompTests(QuickApp):
                 total = int(os.environ[v_total])
                 msg = 'Detected I am worker #%s of %d in CircleCI.' % (index, total)
                 self.info(msg)
-                mine = []
-                for i in range(len(modules)):
-                    if i % total == index:
-                        mine.append(modules[i])
+                shard = (index, total)
 
-                msg = 'I am only doing these modules: %s, instead of %s' % (mine, modules)
-                self.info(msg)
-                modules = mine
+        if shard is not None:
+            durations = self.options.shard_durations
+            if durations is not None:
+                durations = os.path.abspath(durations)
+            set_shard(shard[0], shard[1], durations=durations)
+            self.info('Running only the tests of shard %d/%d.' % shard)
+        else:
+            Selection.shard = None
 
         if not modules:
             raise Exception('No modules found.')  # XXX: what's the nicer way?
@@ -96,15 +242,27 @@ class CompTests(QuickApp):
             import coverage
             coverage.process_startup()
         if not options.nonose:
-            self.instance_nosetests_jobs(context, modules, do_coverage)
-
-        #self.instance_nosesingle_jobs(context, modules)
+            if options.nose_batch > 0 and not do_coverage:
+                self.instance_nosesingle_jobs(context, modules, options.nose_batch)
+            else:
+                if options.nose_batch > 0:
+                    self.warn('Using one nosetests process per module for --coverage.')
+                self.instance_nosetests_jobs(context, modules, do_coverage)
 
         if not options.nocomp:
             self.instance_comptests_jobs(context, modules,
                                          create_reports=options.reports,
                                          do_coverage=do_coverage)
 
+    @contract(returns=str)
+    def get_state_dir(self):
+        """ Returns the directory for the data kept across runs. """
+        state = self.get_options().state
+        if state is None:
+            output = os.path.normpath(self.get_options().output)
+            state = output + '-state'
+        return state
+
     @contract(returns='list(str)')
     def get_modules(self):
         """" Parses the command line argument and interprets them as modules. """
@@ -149,14 +307,37 @@ class CompTests(QuickApp):
                 yield m
 
     def instance_nosetests_jobs(self, context, modules, do_coverage):
+        if do_coverage:
+            # the data files of the jobs, instead of the data in the DB
+            coverage_dir = os.path.abspath(os.path.join(context.get_output_dir(),
+                                                        'coverage-data'))
+        else:
+            coverage_dir = None
+        coverage_files = []
         for module in modules:
+            if not in_this_shard(nosetests_identity(module)):
+                continue
             c = context.child(module)
-            jobs_nosetests(c, module, do_coverage=do_coverage)
-
-    def instance_nosesingle_jobs(self, context, modules):
+            res = jobs_nosetests(c, module, coverage_dir=coverage_dir)
+            if res is not None:
+                coverage_files.append(res)
+        if coverage_files:
+            outdir = os.path.join(context.get_output_dir(), 'coverage')
+            context.comp(write_nosetests_coverage_report, outdir, coverage_files,
+                         modules, job_id='coverage')
+
+    def instance_nosesingle_jobs(self, context, modules, batch):
+        # the jobs are defined here also when the tests are collected
+        # now, so that their ids do not depend on the previous runs
         for module in modules:
-            c = context.child(module)
-            c.comp_dynamic(jobs_nosetests_single, module, job_id='nosesingle')
+            try:
+                tests = get_nose_cases(module, collection=NoseCollection.filename)
+            except Exception as e:
+                # the nosetests job reports the error
+                self.warn('Could not collect the tests of %s: %s' % (module, e))
+                jobs_nosetests(context.child(module), module)
+                continue
+            define_nose_jobs(context.child(module).child('nose'), module, tests, batch)
 
     @contract(modules='list(str)', create_reports='bool')
     def instance_comptests_jobs(self, context, modules, create_reports, do_coverage):
@@ -0,0 +1,125 @@
+# -*- coding: utf-8 -*-
+import fnmatch
+import json
+import os
+
+from contracts import contract
+
+from .fingerprints import sha1_of
+
+__all__ = [
+    'write_coverage_report',
+]
+
+
+@contract(coverage_files='list(str)', modules='list(str)')
+def write_coverage_report(outdir, coverage_files, modules):
+    """
+        Combines the coverage data files written by the jobs, and writes
+        in outdir the HTML report for all the modules, a summary of the
+        coverage of each file (summary.json) and the Cobertura XML report
+        (coverage.xml).
+
+        Nothing is written if the sources and the coverage of the files
+        did not change since the last report; otherwise the pages of the
+        files that did not change are kept (coverage checks that itself).
+    """
+    import coverage
+    # the jobs that failed before running the tests wrote nothing
+    coverage_files = [f for f in coverage_files if os.path.exists(f)]
+    if not coverage_files:
+        print('No coverage data to write in %s.' % outdir)
+        return
+    print('Writing coverage data to %s' % outdir)
+    outdir = os.path.abspath(outdir)
+    if not os.path.exists(outdir):
+        os.makedirs(outdir)
+    cov = coverage.Coverage(data_file=os.path.join(outdir, '.coverage'),
+                            config_file=False)
+    try:
+        cov.combine(coverage_files, keep=True)
+    except TypeError:  # coverage < 5.5 always removes them
+        cov.combine(coverage_files)
+    cov.save()
+
+    include = ['*/%s/*' % module for module in modules]
+    fingerprints = get_coverage_fingerprints(cov, include)
+    fingerprints_file = os.path.join(outdir, 'fingerprints.json')
+    previous = read_json(fingerprints_file, {})
+    changed = [f for f in fingerprints if previous.get(f, None) != fingerprints[f]]
+    removed = [f for f in previous if not f in fingerprints]
+    if (not changed and not removed and
+            os.path.exists(os.path.join(outdir, 'index.html'))):
+        print('The coverage report is up to date.')
+        return
+    print('%d of %d files changed since the last report.' % (len(changed) + len(removed),
+                                                            len(fingerprints)))
+    try:
+        cov.html_report(directory=outdir, include=include,
+                        title='Coverage of %s' % ', '.join(modules))
+        cov.xml_report(outfile=os.path.join(outdir, 'coverage.xml'), include=include)
+    except coverage.CoverageException as e:  # e.g. nothing to report
+        print('Could not write the coverage report: %s' % e)
+        return
+    summary = get_coverage_summary(cov, sorted(fingerprints))
+    write_json(os.path.join(outdir, 'summary.json'), summary)
+    # last, so that an interrupted report is written again
+    write_json(fingerprints_file, fingerprints)
+
+
+def get_coverage_fingerprints(cov, include):
+    """
+        Returns a dict filename -> fingerprint of its source and of
+        its coverage, for the measured files matching include.
+    """
+    data = cov.get_data()
+    res = {}
+    for filename in data.measured_files():
+        if not any(fnmatch.fnmatch(filename, p) for p in include):
+            continue
+        try:
+            with open(filename, 'rb') as f:
+                source = f.read()
+        except (IOError, OSError):  # not a file anymore
+            continue
+        lines = sorted(data.lines(filename) or [])
+        arcs = sorted(data.arcs(filename) or [])
+        res[filename] = sha1_of('%s\n%r\n%r' % (sha1_of(source), lines, arcs))
+    return res
+
+
+def get_coverage_summary(cov, filenames):
+    """
+        Returns a dict with the number of statements, of missing statements
+        and the percentage covered, in total and for each file.
+    """
+    files = {}
+    total_statements = 0
+    total_missing = 0
+    for filename in filenames:
+        _, statements, _, missing, _ = cov.analysis2(filename)
+        files[filename] = coverage_counts(len(statements), len(missing))
+        total_statements += len(statements)
+        total_missing += len(missing)
+    return dict(total=coverage_counts(total_statements, total_missing), files=files)
+
+
+def coverage_counts(statements, missing):
+    if statements == 0:
+        percent = 100.0
+    else:
+        percent = round(100.0 * (statements - missing) / statements, 2)
+    return dict(statements=statements, missing=missing, percent=percent)
+
+
+def read_json(filename, default):
+    try:
+        with open(filename) as f:
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return default
+
+
+def write_json(filename, data):
+    with open(filename, 'w') as f:
+        json.dump(data, f, indent=1, sort_keys=True)
@@ -0,0 +1,123 @@
+# -*- coding: utf-8 -*-
+from contracts import contract
+
+from .fingerprints import spec_fingerprint
+
+__all__ = [
+    'find_canonical',
+    'find_aliased',
+]
+
+
+class Aliases(object):
+    """ Static storage """
+    # Whether the tests of an alias reuse the result of the same test on
+    # the object it is an alias of. This is set by CompTests (--dedupe_tests).
+    tests = False
+    # (master_name, objspec_name) -> dict id_object -> canonical id_object
+    canonical = {}
+
+
+def effective_fingerprint(spec):
+    """
+        Fingerprint of what is instanced for the spec (the class and its
+        resolved params, not the id or the description), or None if
+        we cannot tell.
+    """
+    code = spec.get('code', None) if isinstance(spec, dict) else None
+    if not code:
+        return None
+    return spec_fingerprint(code)
+
+
+@contract(specs='dict(str:*)', returns='dict(str:str)')
+def find_canonical(specs):
+    """
+        Returns a dict id_object -> canonical id_object, where the canonical
+        object is the first (in sorted order) of the objects whose spec
+        expands to the same class and params.
+    """
+    fingerprint2id = {}
+    canonical = {}
+    for id_object in sorted(specs):
+        fingerprint = effective_fingerprint(specs[id_object])
+        if fingerprint is None:
+            canonical[id_object] = id_object
+            continue
+        canonical[id_object] = fingerprint2id.setdefault(fingerprint, id_object)
+    return canonical
+
+
+def get_canonical_ids(objspec):
+    """
+        Returns the dict id_object -> canonical id_object for the objspec.
+        Only the objects that are instanced are deduplicated.
+    """
+    key = (objspec.master.name, objspec.name)
+    if not key in Aliases.canonical:
+        ids = sorted(objspec.keys())
+        if objspec.instance_method is None:
+            canonical = dict((k, k) for k in ids)
+        else:
+            canonical = find_canonical(dict((k, objspec[k]) for k in ids))
+        Aliases.canonical[key] = canonical
+    return Aliases.canonical[key]
+
+
+def find_aliased(keys, canonical):
+    """
+        Returns a dict key -> canonical key for the keys whose canonical
+        key (given by the function canonical) is different and also in keys.
+    """
+    keys = set(keys)
+    res = {}
+    for k in keys:
+        ck = canonical(k)
+        if ck != k and ck in keys:
+            res[k] = ck
+    return res
+
+
+@contract(ids='list(str)', returns='dict(str:str)')
+def get_aliased_objects(objspec, ids):
+    """ The aliased objects among ids for single tests (empty if not --dedupe_tests). """
+    if not Aliases.tests:
+        return {}
+    canonical = get_canonical_ids(objspec)
+    return find_aliased(ids, lambda k: canonical.get(k, k))
+
+
+def get_aliased_cells(objspec1, objspec2, cells, symmetric=False):
+    """
+        The aliased cells (id_ob1, id_ob2) among cells for pair tests
+        (empty if not --dedupe_tests). For symmetric tests, the canonical
+        cell is taken in the upper triangle.
+    """
+    if not Aliases.tests:
+        return {}
+    canonical1 = get_canonical_ids(objspec1)
+    canonical2 = get_canonical_ids(objspec2)
+
+    def canonical(cell):
+        a, b = cell
+        a = canonical1.get(a, a)
+        b = canonical2.get(b, b)
+        if symmetric and b < a:
+            a, b = b, a
+        return a, b
+
+    return find_aliased(cells, canonical)
+
+
+def aliases_last(combinations, aliased):
+    """ Sorts the (context, id_ob1[, id_ob2]) so that the aliased ones are
+        defined after the objects they are aliases of. """
+    def is_aliased(x):
+        key = x[1] if len(x) == 2 else (x[1], x[2])
+        return key in aliased
+    return sorted(combinations, key=is_aliased)
+
+
+def same_result(result):
+    """ The job of an alias: the result of the test on the canonical object. """
+    return result
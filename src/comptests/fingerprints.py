@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import inspect
+import os
+import re
+import sys
+import types
+
+import six
+
+__all__ = [
+    'spec_fingerprint',
+    'function_fingerprint',
+    'comptest_fingerprint',
+    'comptest_identity',
+    'sources_fingerprint',
+]
+
+# the default repr() of objects contains the address
+ADDRESS = re.compile(r' at 0x[0-9a-fA-F]+')
+
+
+def canonical_repr(x):
+    """ A repr() of x that does not depend on the order of dicts and sets. """
+    if isinstance(x, dict):
+        items = sorted((canonical_repr(k), canonical_repr(v)) for k, v in x.items())
+        return '{%s}' % ', '.join('%s: %s' % kv for kv in items)
+    if isinstance(x, (set, frozenset)):
+        return 'set(%s)' % ', '.join(sorted(canonical_repr(v) for v in x))
+    if isinstance(x, (list, tuple)):
+        return '[%s]' % ', '.join(canonical_repr(v) for v in x)
+    if isinstance(x, six.text_type):
+        return repr(x.encode('utf-8'))
+    if isinstance(x, types.FunctionType):
+        return 'function(%s)' % function_fingerprint(x)
+    return ADDRESS.sub('', repr(x))
+
+
+def sha1_of(s):
+    if isinstance(s, six.text_type):
+        s = s.encode('utf-8')
+    return hashlib.sha1(s).hexdigest()
+
+
+def spec_fingerprint(spec):
+    """ Returns a fingerprint (str) of the spec of a ConfTools object. """
+    return sha1_of(canonical_repr(spec))
+
+
+def code_repr(code):
+    """ Describes a code object, ignoring the line numbers. """
+    consts = []
+    for c in code.co_consts:
+        if isinstance(c, types.CodeType):
+            consts.append(code_repr(c))
+        else:
+            consts.append(canonical_repr(c))
+    return '%r %r %r [%s]' % (code.co_code, code.co_names, code.co_varnames,
+                              ', '.join(consts))
+
+
+class FunctionFingerprints(object):
+    """ Static storage """
+    # function -> fingerprint
+    cache = {}
+
+
+def function_fingerprint(f):
+    """
+        Returns a fingerprint of the function, based on its code object,
+        its defaults and the contents of its closure.
+
+        Callable objects (such as the wrappers of @comptest_fails) are
+        described by their class and their attributes.
+    """
+    try:
+        return FunctionFingerprints.cache[f]
+    except (KeyError, TypeError):
+        pass
+    res = function_fingerprint_(f)
+    try:
+        FunctionFingerprints.cache[f] = res
+    except TypeError:  # not hashable
+        pass
+    return res
+
+
+def function_fingerprint_(f):
+    if not isinstance(f, types.FunctionType):
+        attrs = getattr(f, '__dict__', {})
+        return sha1_of('%s %s' % (type(f).__name__, canonical_repr(attrs)))
+
+    code = six.get_function_code(f)
+    defaults = six.get_function_defaults(f)
+    closure = six.get_function_closure(f) or ()
+    cells = []
+    for cell in closure:
+        try:
+            contents = cell.cell_contents
+        except ValueError:  # empty cell
+            contents = None
+        if contents is f:
+            cells.append('self')
+        else:
+            cells.append(canonical_repr(contents))
+
+    s = '%s.%s\n%s\n%s\n%s' % (f.__module__, f.__name__, code_repr(code),
+                               canonical_repr(defaults), '\n'.join(cells))
+    return sha1_of(s)
+
+
+class SourceFingerprints(object):
+    """ Static storage """
+    # filename -> sha1 of its contents
+    cache = {}
+    # the "code" entry of a spec -> fingerprint of its source files
+    code = {}
+    # module name -> source files of its import closure
+    closures = {}
+
+
+def get_source_files(ob):
+    """ The source files of the modules defining ob (and its base classes). """
+    if inspect.isclass(ob):
+        things = inspect.getmro(ob)
+    else:
+        things = [ob]
+    files = set()
+    for x in things:
+        module = sys.modules.get(getattr(x, '__module__', None), None)
+        filename = get_module_file(module)
+        if filename is not None:
+            files.add(filename)
+    return sorted(files)
+
+
+def get_module_file(module):
+    """ The source file of the module, or None (e.g. builtins). """
+    filename = getattr(module, '__file__', None)
+    if filename is None:
+        return None
+    if filename.endswith(('.pyc', '.pyo')):
+        filename = filename[:-1]
+    if not os.path.exists(filename):
+        return None
+    return os.path.realpath(filename)
+
+
+def get_import_closure(ob):
+    """
+        The source files of the modules defining ob (and its base classes)
+        and of the modules that they import, recursively, as far as it
+        can be told from the globals of the modules (with their parent
+        packages). The standard library is not followed.
+
+        The modules imported inside functions, and the data files that
+        the code reads, are not found.
+    """
+    if inspect.isclass(ob):
+        things = inspect.getmro(ob)
+    else:
+        things = [ob]
+    files = set()
+    for x in things:
+        name = getattr(x, '__module__', None)
+        if not name in SourceFingerprints.closures:
+            SourceFingerprints.closures[name] = get_module_closure(name)
+        files.update(SourceFingerprints.closures[name])
+    return sorted(files)
+
+
+def get_module_closure(name):
+    stdlib = get_stdlib_dirs()
+    todo = [name]
+    seen = set()
+    files = set()
+    while todo:
+        name = todo.pop()
+        if name in seen or sys.modules.get(name, None) is None:
+            continue
+        seen.add(name)
+        module = sys.modules[name]
+        filename = get_module_file(module)
+        if filename is None or is_stdlib_file(filename, stdlib):
+            continue
+        files.add(filename)
+        parent = name.rpartition('.')[0]
+        if parent:
+            todo.append(parent)
+        for value in list(vars(module).values()):
+            if isinstance(value, types.ModuleType):
+                todo.append(value.__name__)
+                continue
+            try:
+                imported_from = getattr(value, '__module__', None)
+            except Exception:  # e.g. lazy proxies
+                continue
+            if isinstance(imported_from, six.string_types):
+                todo.append(imported_from)
+    return files
+
+
+def get_stdlib_dirs():
+    """ Returns (standard library dirs, installed packages dirs). """
+    import sysconfig
+    paths = sysconfig.get_paths()
+    dirs = lambda keys: tuple(set(os.path.realpath(paths[k]) + os.sep for k in keys))
+    return dirs(['stdlib', 'platstdlib']), dirs(['purelib', 'platlib'])
+
+
+def is_stdlib_file(filename, stdlib):
+    # the installed packages can be inside the standard library directory
+    stdlib_dirs, packages_dirs = stdlib
+    return filename.startswith(stdlib_dirs) and not filename.startswith(packages_dirs)
+
+
+def file_sha1(filename):
+    """ The sha1 of the contents of the file (read once per process). """
+    if not filename in SourceFingerprints.cache:
+        with open(filename, 'rb') as f:
+            SourceFingerprints.cache[filename] = sha1_of(f.read())
+    return SourceFingerprints.cache[filename]
+
+
+def sources_fingerprint(ob):
+    """ Fingerprint of the source files of the modules defining ob. """
+    return sha1_of(' '.join(file_sha1(f) for f in get_source_files(ob)))
+
+
+def spec_code_fingerprint(spec):
+    """
+        Fingerprint of the source files of the class (or function) given
+        in the "code" entry of the spec, or None if we cannot tell.
+    """
+    code = spec.get('code', None) if isinstance(spec, dict) else None
+    if not code or not isinstance(code[0], str):
+        return None
+    if not code[0] in SourceFingerprints.code:
+        from conf_tools import import_name
+        try:
+            constructor = import_name(code[0])
+        except Exception:
+            res = None
+        else:
+            res = sources_fingerprint(constructor)
+        SourceFingerprints.code[code[0]] = res
+    return SourceFingerprints.code[code[0]]
+
+
+def comptest_identity(function, *id_objects):
+    """
+        A stable identity for a test job: module, function and
+        the ids of the objects it uses.
+    """
+    s = '%s:%s' % (function.__module__, function.__name__)
+    if id_objects:
+        s += ':' + ':'.join(id_objects)
+    return s
+
+
+def comptest_fingerprint(function, object_fingerprints=(), args=(), kwargs=None):
+    """
+        Fingerprint of a test job: the test function and the source file
+        of its module, the specs of the objects it uses (with the sources of
+        their classes), its arguments and the version of comptests.
+
+        The other modules that the test uses are not considered.
+    """
+    from . import __version__
+    s = '%s\n%s\n%s\n%s\n%s\n%s' % (__version__, function_fingerprint(function),
+                                    sources_fingerprint(function),
+                                    ' '.join(object_fingerprints),
+                                    canonical_repr(args), canonical_repr(kwargs or {}))
+    return sha1_of(s)
@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import sys
+import traceback
+
+import six
+
+from . import logger
+
+__all__ = [
+    'ForkedError',
+    'run_forked',
+]
+
+
+class ForkedError(Exception):
+    """ The function called by run_forked() failed. """
+
+
+class Preloaded(object):
+    """ Static storage """
+    # Modules already imported by this process with preload_modules()
+    modules = set()
+    # The packages that the workers import before forking the runs of
+    # nosetests; this is set by CompTests (--preload).
+    packages = []
+
+
+def can_fork():
+    return hasattr(os, 'fork')
+
+
+def preload_modules(modules):
+    """
+        Imports the modules in this process (once per process), so that
+        the processes forked by run_forked() find them already imported.
+    """
+    for module in modules:
+        if module in Preloaded.modules:
+            continue
+        Preloaded.modules.add(module)
+        try:
+            __import__(module)
+        except Exception as e:  # the forked process will report it
+            logger.warning('Could not import %s: %s' % (module, e))
+
+
+def run_forked(function, *args, **kwargs):
+    """
+        Calls function(*args, **kwargs) in a process forked from this one,
+        which has all the modules already imported, and returns the result.
+
+        What the child writes on sys.stdout and sys.stderr is printed
+        by this process. If the function raises an exception, ForkedError
+        is raised here with its description and backtrace.
+    """
+    r, w = os.pipe()
+    pid = os.fork()
+    if pid == 0:  # in the child
+        os.close(r)
+        try:
+            res = run_captured(function, args, kwargs)
+            data = pickle.dumps(res, pickle.HIGHEST_PROTOCOL)
+        except BaseException as e:  # e.g. a result that cannot be pickled
+            data = pickle.dumps((False, '%s: %s' % (type(e).__name__, e),
+                                 traceback.format_exc(), ''))
+        with os.fdopen(w, 'wb') as f:
+            f.write(data)
+        os._exit(0)
+
+    os.close(w)
+    with os.fdopen(r, 'rb') as f:
+        data = f.read()
+    _, status = os.waitpid(pid, 0)
+    if not data:
+        msg = 'The forked process %s died (status %s).' % (pid, status)
+        raise ForkedError(msg)
+    ok, value, backtrace, output = pickle.loads(data)
+    if output:
+        print(output)
+    if not ok:
+        raise ForkedError('%s\n%s' % (value, backtrace))
+    return value
+
+
+def run_captured(function, args, kwargs):
+    """ Returns (ok, result or exception, backtrace, output). """
+    output = six.StringIO()
+    stdout, stderr = sys.stdout, sys.stderr
+    sys.stdout = sys.stderr = output
+    try:
+        res = (True, function(*args, **kwargs), None)
+    except BaseException as e:
+        res = (False, '%s: %s' % (type(e).__name__, e), traceback.format_exc())
+    finally:
+        sys.stdout, sys.stderr = stdout, stderr
+    return res + (output.getvalue(),)
@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+import sysconfig
+import time
+
+from contracts import contract
+from system_cmd import system_cmd_result
+
+from . import logger
+from .objcache import get_code_files
+from .state import connect_state_db, write_state
+
+__all__ = [
+    'FootprintStore',
+    'get_changed_files',
+]
+
+
+class FootprintStore(object):
+    """
+        Remembers the footprint of each test: the source files that it
+        executed the last time it ran.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS footprints ('
+              'identity TEXT PRIMARY KEY, files TEXT, timestamp REAL)',)
+
+    def __init__(self, filename):
+        self.filename = filename
+        # identity -> set of files, loaded on first use
+        self.footprints = None
+
+    def _connect(self):
+        return connect_state_db(self.filename, *self.schema)
+
+    def create(self):
+        """ Creates the DB (in the master, before the workers use it). """
+        self._connect().close()
+
+    def _load(self):
+        if self.footprints is None:
+            conn = self._connect()
+            try:
+                rows = conn.execute('SELECT identity, files FROM footprints')
+                self.footprints = dict((identity, set(files.split('\n')))
+                                       for identity, files in rows)
+            finally:
+                conn.close()
+
+    @contract(identity=str, files='list(str)')
+    def record(self, identity, files):
+        write_state(self.filename, self.schema,
+                    'INSERT OR REPLACE INTO footprints VALUES (?, ?, ?)',
+                    (identity, '\n'.join(sorted(files)), time.time()))
+        if self.footprints is not None:
+            self.footprints[identity] = set(files)
+
+    @contract(identity=str, returns='None|set(str)')
+    def get_footprint(self, identity):
+        """ Returns the files of the test, or None if we do not know them. """
+        self._load()
+        return self.footprints.get(identity, None)
+
+
+class Impact(object):
+    """ Static storage """
+    # SQLite file where the footprints are recorded; None means that
+    # they are not recorded. This is set by CompTests (--footprints).
+    filename = None
+    # The files changed since the revision given with --changed-since,
+    # or None to run all tests.
+    changed_files = None
+    # filename -> FootprintStore
+    stores = {}
+    # the coverage.Coverage used to trace the tests in this process
+    tracer = None
+
+
+def get_footprint_store(filename):
+    if not filename in Impact.stores:
+        Impact.stores[filename] = FootprintStore(filename)
+    return Impact.stores[filename]
+
+
+@contract(rev=str, returns='set(str)')
+def get_changed_files(rev, cwd='.'):
+    """ Returns the files changed since the git revision (absolute paths). """
+    cmd = ['git', 'rev-parse', '--show-toplevel']
+    res = system_cmd_result(cwd, cmd, display_stdout=False,
+                            display_stderr=False, raise_on_error=True)
+    toplevel = res.stdout.strip()
+    cmd = ['git', 'diff', '--name-only', rev]
+    res = system_cmd_result(cwd, cmd, display_stdout=False,
+                            display_stderr=False, raise_on_error=True)
+    names = [x.strip() for x in res.stdout.split('\n') if x.strip()]
+    return set(os.path.realpath(os.path.join(toplevel, x)) for x in names)
+
+
+@contract(identity=str, config_files='seq(str)', returns=bool)
+def is_affected(identity, config_files=()):
+    """
+        True if the test could be affected by the changed files
+        (always True if we do not know its footprint).
+    """
+    if Impact.changed_files is None or Impact.filename is None:
+        return True
+    config_files = set(os.path.realpath(x) for x in config_files)
+    if config_files & Impact.changed_files:
+        return True
+    try:
+        footprint = get_footprint_store(Impact.filename).get_footprint(identity)
+    except sqlite3.Error as e:
+        logger.warning('Could not read the footprint of %s: %s' % (identity, e))
+        return True
+    if footprint is None:
+        return True
+    return bool(footprint & Impact.changed_files)
+
+
+def get_library_dirs():
+    """ Directories of the standard library and installed packages. """
+    paths = sysconfig.get_paths()
+    dirs = set([paths['stdlib'], paths['platstdlib'], paths['purelib'], paths['platlib']])
+    return tuple(os.path.realpath(x) + os.sep for x in dirs)
+
+
+def get_tracer():
+    """ Returns the coverage.Coverage object used to trace the tests, or None. """
+    if Impact.tracer is None:
+        try:
+            import coverage
+        except ImportError as e:
+            logger.warning('Cannot record the footprints of the tests: %s' % e)
+            Impact.tracer = False
+        else:
+            Impact.tracer = coverage.Coverage(data_file=None, config_file=False)
+    return Impact.tracer or None
+
+
+def run_traced(footprints, identity, objects, function, *args, **kwargs):
+    """
+        Calls function(*args, **kwargs) and records in the footprints DB
+        ``footprints`` (if not None) the source files that it executed,
+        and those of the classes and constructors of the test objects
+        (objects: list of (ObjectRef, object), see get_code_files()),
+        which are run before the test.
+
+        The files of the standard library and of the installed packages
+        are not recorded.
+    """
+    if footprints is None:
+        return function(*args, **kwargs)
+    tracer = get_tracer()
+    if tracer is None or is_coverage_running():
+        return function(*args, **kwargs)
+
+    tracer.erase()
+    tracer.start()
+    if hasattr(tracer, 'switch_context'):  # coverage >= 5
+        # each test is a different coverage context
+        tracer.switch_context(identity)
+    try:
+        return function(*args, **kwargs)
+    finally:
+        tracer.stop()
+        library = get_library_dirs()
+        files = set(os.path.realpath(x) for x in tracer.get_data().measured_files())
+        for ref, ob in objects:
+            files.update(get_code_files(ref, ob))
+        files = sorted(x for x in files if not x.startswith(library))
+        try:
+            get_footprint_store(footprints).record(identity, files)
+        except sqlite3.Error as e:
+            logger.warning('Could not record the footprint of %s: %s' % (identity, e))
+
+
+def is_coverage_running():
+    """ True if we are already running under coverage (e.g. "coverage run"). """
+    try:
+        import coverage
+    except ImportError:
+        return False
+    current = getattr(coverage.Coverage, 'current', None)
+    return current is not None and current() is not None
@@ -0,0 +1,121 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import time
+
+from contracts import contract
+
+from . import logger
+from .fingerprints import comptest_fingerprint, comptest_identity
+from .state import connect_state_db, write_state
+
+__all__ = [
+    'IncrementalStore',
+]
+
+
+class IncrementalStore(object):
+    """
+        Remembers the fingerprint of each test the last time it succeeded.
+
+        The data is kept in a SQLite file, so that parallel workers
+        can write to it.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS successes ('
+              'identity TEXT PRIMARY KEY, fingerprint TEXT, timestamp REAL)',)
+
+    def __init__(self, filename):
+        self.filename = filename
+        # identity -> fingerprint, loaded on first use
+        self.successes = None
+
+    def _connect(self):
+        return connect_state_db(self.filename, *self.schema)
+
+    def create(self):
+        """ Creates the DB (in the master, before the workers use it). """
+        self._connect().close()
+
+    def _load(self):
+        if self.successes is None:
+            conn = self._connect()
+            try:
+                rows = conn.execute('SELECT identity, fingerprint FROM successes')
+                self.successes = dict(rows)
+            finally:
+                conn.close()
+
+    @contract(identity=str, fingerprint=str, returns=bool)
+    def is_unchanged(self, identity, fingerprint):
+        """ True if the test succeeded last time with the same fingerprint. """
+        self._load()
+        return self.successes.get(identity, None) == fingerprint
+
+    @contract(identity=str, fingerprint=str)
+    def record_success(self, identity, fingerprint):
+        write_state(self.filename, self.schema,
+                    'INSERT OR REPLACE INTO successes VALUES (?, ?, ?)',
+                    (identity, fingerprint, time.time()))
+        if self.successes is not None:
+            self.successes[identity] = fingerprint
+
+
+class Incremental(object):
+    """ Static storage """
+    # SQLite file; None means that the incremental mode is disabled.
+    # This is set by CompTests (--incremental).
+    filename = None
+    # filename -> IncrementalStore
+    stores = {}
+
+
+def get_incremental_store(filename):
+    if not filename in Incremental.stores:
+        Incremental.stores[filename] = IncrementalStore(filename)
+    return Incremental.stores[filename]
+
+
+def incremental_token(function, id_objects, object_fingerprints=(),
+                      args=(), kwargs=None):
+    """
+        Returns the token (filename, identity, fingerprint) for the test,
+        or None if the incremental mode is disabled.
+
+        The token is passed to the test job to record the success.
+    """
+    if Incremental.filename is None:
+        return None
+    identity = comptest_identity(function, *id_objects)
+    fingerprint = comptest_fingerprint(function, object_fingerprints, args, kwargs)
+    return (Incremental.filename, identity, fingerprint)
+
+
+def object_fingerprint(ob):
+    """ Fingerprint of the spec of the object (an ObjectRef) and
+        of the source files of its class. """
+    return '%s:%s' % (ob.fingerprint, ob.code_fingerprint)
+
+
+def pair_incremental_token(function, ob1, ob2):
+    """ Returns the token for a pair test, given the two ObjectRef. """
+    return incremental_token(function, [ob1.id_object, ob2.id_object],
+                             [object_fingerprint(ob1), object_fingerprint(ob2)])
+
+
+def is_unchanged(token):
+    """ True if the test did not change since the last time it succeeded. """
+    if token is None:
+        return False
+    filename, identity, fingerprint = token
+    return get_incremental_store(filename).is_unchanged(identity, fingerprint)
+
+
+def record_success(token):
+    """ Called by the test job after the test succeeded. """
+    if token is None:
+        return
+    filename, identity, fingerprint = token
+    try:
+        get_incremental_store(filename).record_success(identity, fingerprint)
+    except sqlite3.Error as e:
+        logger.warning('Could not record success of %s: %s' % (identity, e))
@@ -1,16 +1,34 @@
 # -*- coding: utf-8 -*-
+# this module is called nose as well
+from __future__ import absolute_import
 
 from contextlib import contextmanager
 import os
+import shutil
+import sys
 import tempfile
-import warnings
+import time
+import traceback
+import unittest
 
 from contracts import contract
 from system_cmd import system_cmd_result
 
-from compmake.utils import safe_pickle_load
+from .batches import CellOutcome, check_batches
+from .collection import get_collected_tests, module_fingerprint, save_collected_tests
+from .coverage_report import write_coverage_report
+from .fingerprints import ADDRESS
+from .forking import Preloaded, can_fork, preload_modules, run_forked
+from .results import Skipped
+from .selection import in_this_shard
+from .state import deferred_writes
+from .timing import Timing, get_cputime, get_peak_rss, record_timing, run_timed
 
-__all__ = ['jobs_nosetests']
+__all__ = [
+    'jobs_nosetests',
+    'get_nose_cases',
+    'collect_nose_cases',
+]
 
 
 @contextmanager
@@ -23,226 +41,315 @@ def create_tmp_dir():
         raise
 
 
-def jobs_nosetests(context, module, do_coverage=False):
-    """ Instances the mcdp_lang_tests for the given module. """
-    if do_coverage:
+def jobs_nosetests(context, module, coverage_dir=None):
+    """
+        Instances the mcdp_lang_tests for the given module.
+
+        If coverage_dir is given, the coverage data is written in a file
+        there; returns the promise of the result of
+        call_nosetests_plus_coverage() (see write_nosetests_coverage_report()).
+    """
+    if coverage_dir is not None:
         try:
             import coverage  # @UnusedImport
         except ImportError as e:
             print('No coverage module found: %s' % e)
-            context.comp(call_nosetests, module,
-                         job_id='nosetests')
         else:
-            covdata = context.comp(call_nosetests_plus_coverage, module,
-                                   job_id='nosetests')
-            if do_coverage:
-                outdir = os.path.join(context.get_output_dir(), 'coverage')
-                context.comp(write_coverage_report, outdir, covdata, module)
-            else:
-                warnings.warn('Skipping coverage report.')
-    else:
-        context.comp(call_nosetests, module,
-                     job_id='nosetests')
+            # the coverage report does not depend on the tests passing
+            res = context.comp(call_nosetests_plus_coverage, module, coverage_dir,
+                               timing=Timing.filename,
+                               job_id='nosetests-coverage')
+            context.comp(check_nosetests, module, res, job_id='nosetests')
+            return res
+    context.comp(call_nosetests, module, timing=Timing.filename,
+                 preload=Preloaded.packages, job_id='nosetests')
+    return None
 
 
-def call_nosetests(module):
-    import nose
-    with create_tmp_dir() as cwd:
-        cmd = ['nosetests', module]
-        system_cmd_result(
-            cwd=cwd, cmd=cmd,
-            display_stdout=True,
-            display_stderr=True,
-            raise_on_error=True)
+def nosetests_identity(module):
+    """ Identity of the nosetests job of the module in the timing DB. """
+    return '%s:nosetests' % module
 
 
-def call_nosetests_plus_coverage(module):
-    """
-        This also calls the coverage module.
-        It returns the .coverage file as a string.
-    """
-    with create_tmp_dir() as cwd:
-        prog = find_command_path('nosetests')
-        cmd = [prog, module]
+def call_nosetests(module, timing=None, preload=()):
+    """ preload: the packages that the worker imports once (--preload). """
+    run_timed(timing, nosetests_identity(module), call_nosetests_, module, preload)
 
-        # note: coverage -> python-coverage in Ubuntu14
-        cmd = ['coverage', 'run'] + cmd
-        system_cmd_result(
-            cwd=cwd, cmd=cmd,
-            display_stdout=True,
-            display_stderr=True,
-            raise_on_error=True)
-        coverage_file = os.path.join(cwd, '.coverage')
-        with open(coverage_file) as f:
-            res = f.read()
-        #print('read %d bytes in %s' % (len(res), coverage_file))
-        return res
-
-
-def find_command_path(prog):
-    res = system_cmd_result(cwd=os.getcwd(),
-                             cmd=['which', prog],
-                             display_stdout=False,
-                            display_stderr=False,
-                            raise_on_error=True)
-    prog = res.stdout
-    return prog
-
-
-@contract(covdata='str')
-def write_coverage_report(outdir, covdata, module):
-    print('Writing coverage data to %s' % outdir)
-    outdir = os.path.abspath(outdir)
-    if not os.path.exists(outdir):
-        os.makedirs(outdir)
-    with create_tmp_dir() as cwd:
-        coverage_file = os.path.join(cwd, '.coverage')
-        with open(coverage_file, 'wb') as f:
-            f.write(covdata)
 
-        cmd = ['coverage', 'html', '-d', outdir,
-               '--include=*/%s/*' % module]
-        res = system_cmd_result(
+def call_nosetests_(module, preload):
+    import nose  # @UnusedImport
+    with create_tmp_dir() as cwd:
+        if can_fork():
+            # the worker imports the dependencies once, and forks for each
+            # run; the module itself is imported in the forked process
+            preload_modules(preload)
+            success = run_forked(run_nose_program, module, cwd)
+            if not success:
+                msg = 'Some tests of %s failed.' % module
+                raise Exception(msg)
+            return
+        cmd = [sys.executable, '-m', 'nose', module]
+        system_cmd_result(
             cwd=cwd, cmd=cmd,
             display_stdout=True,
             display_stderr=True,
             raise_on_error=True)
-        print(res.stdout)
-        print(res.stderr)
 
-        system_cmd_result(
-            cwd=cwd, cmd=['find', '.'],
-            display_stdout=True,
-            display_stderr=True,
-            raise_on_error=True)
 
+def call_nosetests_plus_coverage(module, coverage_dir, timing=None):
+    """
+        This also calls the coverage module, which writes its data
+        in a file in coverage_dir.
 
-def jobs_nosetests_single(context, module):
+        It returns (filename, error): filename is None if no data was
+        written, and error is None if the tests passed (otherwise
+        check_nosetests() raises it).
+    """
+    try:
+        filename = run_timed(timing, nosetests_identity(module),
+                             call_nosetests_plus_coverage_, module, coverage_dir)
+    except Exception:
+        filename = os.path.join(coverage_dir, '.coverage.%s' % module)
+        if not os.path.exists(filename):
+            filename = None
+        return filename, traceback.format_exc()
+    return filename, None
+
+
+def check_nosetests(module, result):
+    """ Fails if the tests run by call_nosetests_plus_coverage() failed. """
+    _, error = result
+    if error is not None:
+        msg = 'Some tests of %s failed:\n%s' % (module, error)
+        raise Exception(msg)
+
+
+def write_nosetests_coverage_report(outdir, results, modules):
+    """ Writes the coverage report with the data of the nosetests jobs
+        that wrote any, including those whose tests failed. """
+    coverage_files = [filename for filename, _ in results if filename is not None]
+    write_coverage_report(outdir, coverage_files, modules)
+
+
+def call_nosetests_plus_coverage_(module, coverage_dir):
+    # one data file for each job, combined by write_coverage_report()
+    coverage_file = os.path.join(coverage_dir, '.coverage.%s' % module)
+    if not os.path.exists(coverage_dir):
+        try:
+            os.makedirs(coverage_dir)
+        except OSError:  # created by another worker
+            pass
+    if os.path.exists(coverage_file):  # from a previous run
+        os.unlink(coverage_file)
 
+    # Not forked from the worker: it has already imported the module
+    # (and so did the process it was forked from), so its import would
+    # not be measured.
     with create_tmp_dir() as cwd:
-        out = os.path.join(cwd, '%s.pickle' % module)
-        cmd = ['nosetests',
-               '--collect-only',
-               '--with-xunitext',
-               '--xunitext-file' ,
-               out,
-               '-v', '-s', module]
-        system_cmd_result(
+        cmd = [sys.executable, '-m', 'coverage', 'run', '-m', 'nose', module]
+        res = system_cmd_result(
             cwd=cwd, cmd=cmd,
             display_stdout=True,
             display_stderr=True,
-            raise_on_error=True)
-
-        tests = safe_pickle_load(out)
-        print('found %d mcdp_lang_tests ' % len(tests))
-
-        for t in tests:
-            context.comp(execute, t)
-
-
-def execute(t):
-    print(t)
-
-
-if False:
-
-    def load_nosetests(self, context, module_name):
-#         argv = ['-vv', module_name]
-        ids = '.noseids'
-        if os.path.exists(ids):
-            os.remove(ids)
-#
-#         collect = CollectOnly()
-#         testid = TestId()
-#         plugins = []
-#         plugins.append(collect)
-#         plugins.append(testid)
-#         argv = ['nosetests', '--collect-only', '--with-id', module_name]
-        argv = ['nosetests', '-s', '--nologcapture', module_name]
-
-        class FakeResult():
-
-            def wasSuccessful(self):
-                return False
+            raise_on_error=False)
+        # the data is kept also if the tests failed
+        if os.path.exists(os.path.join(cwd, '.coverage')):
+            shutil.move(os.path.join(cwd, '.coverage'), coverage_file)
+        if res.ret != 0:
+            msg = 'nosetests %s exited with code %s.' % (module, res.ret)
+            raise Exception(msg)
+        return coverage_file
+
+
+def run_nose_program(module, cwd):
+    """ Runs the tests of the module as "nosetests <module>" would;
+        returns True if they passed. Called in a forked process. """
+    import nose
+    os.chdir(cwd)
+    sys.argv = ['nosetests', module]
+    return nose.run(argv=['nosetests', module])
 
-        class Tr(object):
 
-            def run(self, what):
-                self.what = what
-                print(what)
-                print('here!')
-                return FakeResult()
+@contract(returns='list(tuple(str,int,str))')
+def get_nose_cases(module, collection=None):
+    """
+        Returns the nose tests of the module (see collect_nose_cases()),
+        collected in a previous run if the module did not change, or
+        collected now, in a forked process if possible so that this
+        process does not import the module.
 
-        mytr = Tr()
+        collection: SQLite file where the tests are saved for the next runs
+    """
+    tests = get_collected_tests(collection, module)
+    if tests is not None:
+        print('Using the %d tests of %s collected in a previous run.' %
+              (len(tests), module))
+        return tests
+    fingerprint = module_fingerprint(module)
+    if can_fork():
+        tests = run_forked(collect_nose_cases, module)
+    else:
+        tests = collect_nose_cases(module)
+    save_collected_tests(collection, module, fingerprint, tests)
+    print('found %d tests in %s' % (len(tests), module))
+    return tests
+
+
+@contract(tests='list(tuple(str,int,str))', batch='int,>=1')
+def define_nose_jobs(context, module, tests, batch):
+    """ Defines the jobs for the tests returned by collect_nose_cases(). """
+    tests = [t for t in tests if in_this_shard(nose_test_identity(module, t[2]))]
+    promises = []
+    for i in range(0, len(tests), batch):
+        res = context.comp(run_nose_batch, module, tests[i:i + batch],
+                           timing=Timing.filename,
+                           job_id='batch%d' % (i // batch),
+                           command_name='nosetests')
+        promises.append(res)
+    context.comp(check_batches, module, *promises, job_id='batches')
+
+
+@contract(returns='list(tuple(str,int,str))')
+def collect_nose_cases(module):
+    """
+        Collects the tests of the module using the loader of nose.
 
-        from nose.core import TestProgram
-        from nose.suite import ContextSuite
+        Returns a list of (name, index, test_id): loading name again gives
+        the test as the index-th test case (for example, one of the tests
+        yielded by a generator); test_id is the name shown in the results.
+    """
+    from nose.loader import TestLoader
+    suite = TestLoader().loadTestsFromName(module)
+    tests = []
+    name2n = {}
+    for case in iterate_test_cases(suite):
+        name = get_test_name(case, module)
+        index = name2n.get(name, 0)
+        name2n[name] = index + 1
+        # the arguments of generated tests might contain addresses
+        test_id = ADDRESS.sub('', case.id())
+        tests.append((name, index, test_id))
+    return tests
+
+
+def iterate_test_cases(suite):
+    """ Yields the test cases in the (nested) suites. """
+    for t in suite:
+        if isinstance(t, unittest.TestSuite):
+            for case in iterate_test_cases(t):
+                yield case
+        else:
+            yield t
 
-        class MyTestProgram(TestProgram):
 
-            def runTests(self):
-                print('hello')
+def get_test_name(case, module):
+    """ The name that the nose loader needs to load the test case again. """
+    try:
+        _, test_module, call = case.address()
+    except Exception:  # not a regular test (e.g. an import failure)
+        return module
+    # functions imported in a package might be seen in __main__
+    if test_module in [None, '__main__']:
+        return module
+    if call is None:
+        return test_module
+    return '%s:%s' % (test_module, call)
 
-#         print argv, plugins
-        tp = MyTestProgram(module=module_name, argv=argv,
-                       defaultTest=module_name,
-                       addplugins=[],
-                       exit=False,
-                       testRunner=mytr)
-        self.info('test: %s' % tp.test)
 
-        def explore(a):
-            for b in a._get_tests():
+def nose_test_identity(module, test_id):
+    """ Identity of a nose test in the timing DB (see --nose_batch). """
+    return '%s:nosetests:%s' % (module, test_id)
 
-                if isinstance(b, ContextSuite):
-                    for c in explore(b):
-                        yield c
-                else:
-                    yield b
 
-        # these things are not pickable
-        for a in explore(tp.test):
-            #context.comp(run_testcase, a)
-            pass
-#
-#             if isinstance(a, FunctionTestCase):
-#                 f = a.test
-#                 args = a.arg
-#                 print('f: %s %s ' % (f, args))
-#                 context.comp(f, *args)
-#             else:
-#                 print('unknown testcase %s' % describe_type(a))
-
-# #
-# #         print describe_value(tp.test, clip=100)
-# #         suite = tp.test
-#         for tc in suite.mcdp_lang_tests:
-#             print describe_value(tc, clip=100)
-#
-
-#         res = nose.run(module=module_name, argv=argv,
-#                        defaultTest=module_name,
-#                        addplugins=plugins)
-
-#         print 'res', res
-#         print module_name
-#         print testid
-#         print collect
-#
-#         if not os.path.exists(ids):
-#             msg = 'module %r did not produce mcdp_lang_tests' % module_name
-#             raise Exception(msg)
-#         d = safe_pickle_load(ids)
-#         for k, v in d['ids'].items():
-#             print describe_value(v)
-#             print k
-#             print v
-#
-
-# from nose.case import FunctionTestCase
-# from nose.core import TestProgram
-# from nose.plugins.collect import CollectOnly
-# from nose.plugins.testid import TestId
-# from nose.suite import ContextSuite
-# import nose
+def run_nose_batch(module, tests, timing=None):
+    """
+        Runs in this process some of the tests returned
+        by collect_nose_cases().
 
+        Returns a dict test_id -> CellOutcome.
+    """
+    from nose.loader import TestLoader
+    from nose.suite import ContextSuiteFactory
+    loader = TestLoader()
+    name2cases = {}
+    cases = []
+    case2id = {}
+    outcomes = {}
+    for name, index, test_id in tests:
+        if not name in name2cases:
+            name2cases[name] = list(iterate_test_cases(loader.loadTestsFromName(name)))
+        found = name2cases[name]
+        if index >= len(found):
+            msg = 'Could not find the test %s: %s gives %d tests now.' % (test_id, name,
+                                                                         len(found))
+            outcomes[test_id] = CellOutcome(test_id, exception=msg, backtrace=msg)
+            continue
+        cases.append(found[index])
+        case2id[id(found[index])] = test_id
+
+    result = NoseOutcomes(module, case2id, timing)
+    # the fixtures of the modules are run once for the batch
+    suite = ContextSuiteFactory()(cases)
+    # the tests see the same command line as with nosetests
+    argv = sys.argv
+    sys.argv = ['nosetests', module]
+    try:
+        # the records of the tests are written at the end of the batch
+        with deferred_writes():
+            suite(result)
+    finally:
+        sys.argv = argv
+    outcomes.update(result.outcomes)
+    return outcomes
+
+
+class NoseOutcomes(unittest.TestResult):
+    """ Records a CellOutcome for each test run. """
+
+    def __init__(self, module, case2id, timing):
+        unittest.TestResult.__init__(self)
+        self.module = module
+        # id(test case) -> test_id
+        self.case2id = case2id
+        self.timing = timing
+        self.outcomes = {}
+        self.started = None
+
+    def get_outcome(self, test):
+        # errors in the fixtures are given for the suites
+        test_id = self.case2id.get(id(test), ADDRESS.sub('', str(test)))
+        if not test_id in self.outcomes:
+            self.outcomes[test_id] = CellOutcome(test_id)
+        return self.outcomes[test_id]
+
+    def startTest(self, test):
+        unittest.TestResult.startTest(self, test)
+        self.get_outcome(test)
+        self.started = (time.time(), get_cputime(), get_peak_rss())
+
+    def stopTest(self, test):
+        unittest.TestResult.stopTest(self, test)
+        outcome = self.get_outcome(test)
+        t0, c0, r0 = self.started
+        outcome.walltime = time.time() - t0
+        outcome.cputime = get_cputime() - c0
+        record_timing(self.timing, nose_test_identity(self.module, outcome.name),
+                      outcome.walltime, outcome.cputime,
+                      'failed' if outcome.failed() else 'ok', peak_rss0=r0)
+
+    def addError(self, test, err):
+        unittest.TestResult.addError(self, test, err)
+        self.set_exception(test, err)
+
+    def addFailure(self, test, err):
+        unittest.TestResult.addFailure(self, test, err)
+        self.set_exception(test, err)
+
+    def addSkip(self, test, reason):
+        unittest.TestResult.addSkip(self, test, reason)
+        self.get_outcome(test).result = Skipped(str(reason))
+
+    def set_exception(self, test, err):
+        outcome = self.get_outcome(test)
+        outcome.exception = '%s: %s' % (err[0].__name__, err[1])
+        outcome.backtrace = ''.join(traceback.format_exception(*err))
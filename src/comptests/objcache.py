@@ -0,0 +1,299 @@
+# -*- coding: utf-8 -*-
+import re
+from collections import OrderedDict
+
+import six
+from compmake.jobs.storage import get_job_userobject, job_userobject_sizeof
+from compmake.storage.filesystem import StorageFilesystem
+from contracts import contract
+
+from . import logger
+from .dedupe import get_canonical_ids
+from .fingerprints import get_source_files, spec_code_fingerprint, spec_fingerprint
+from .transport import unmap_arrays
+
+__all__ = [
+    'ObjectCache',
+    'ObjectRef',
+    'get_object_cache',
+    'resolve_object',
+]
+
+# Job ids of the jobs that instance several objects (--instance_batch)
+INSTANCES_JOB_ID = re.compile(r'.*-instances\d+$')
+
+
+def is_instances_job(job_id):
+    return INSTANCES_JOB_ID.match(job_id) is not None
+
+
+class ObjectCache(object):
+    """
+        A LRU cache of the test objects, local to a process.
+
+        The size of each object is the size of its pickle in the
+        compmake DB; the least recently used objects are evicted when
+        the total goes above max_bytes.
+    """
+
+    @contract(max_bytes='int,>=0')
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.key2object = OrderedDict()  # key -> (object, nbytes)
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __contains__(self, key):
+        return key in self.key2object
+
+    def __len__(self):
+        return len(self.key2object)
+
+    def get(self, key):
+        """ Returns the object; raises KeyError if not present. """
+        try:
+            ob, nbytes = self.key2object.pop(key)
+        except KeyError:
+            self.misses += 1
+            raise
+        # re-insert as the most recently used
+        self.key2object[key] = (ob, nbytes)
+        self.hits += 1
+        return ob
+
+    @contract(nbytes='int,>=0')
+    def put(self, key, ob, nbytes):
+        if key in self.key2object:
+            _, nbytes0 = self.key2object.pop(key)
+            self.nbytes -= nbytes0
+
+        if nbytes > self.max_bytes:
+            # not worth evicting everything else
+            return
+
+        self.key2object[key] = (ob, nbytes)
+        self.nbytes += nbytes
+        while self.nbytes > self.max_bytes:
+            key0, (_, nbytes0) = self.key2object.popitem(last=False)
+            self.nbytes -= nbytes0
+            logger.debug('Evicted %s from object cache (%d bytes)' % (str(key0), nbytes0))
+
+    def clear(self):
+        self.key2object.clear()
+        self.nbytes = 0
+
+    def __repr__(self):
+        return ('ObjectCache(%d objects, %d/%d bytes, %d hits, %d misses)' %
+                (len(self), self.nbytes, self.max_bytes, self.hits, self.misses))
+
+
+class ObjectCacheStorage(object):
+    """ Static storage """
+    # Memory for the cache; this is set by CompTests (--objcache).
+    # 0 (the default) disables it: the tests get their own copy.
+    max_bytes = 0
+    cache = None
+    # key -> (object, number of objects of the job) for the objects
+    # instanced by the last instance job run in this process; they are
+    # moved to the cache when a test uses them (see cache_object())
+    instanced = {}
+    # (basepath, compress) -> StorageFilesystem
+    dbs = {}
+
+
+def get_object_cache():
+    """ Returns the cache of this process. """
+    if ObjectCacheStorage.cache is None:
+        ObjectCacheStorage.cache = ObjectCache(ObjectCacheStorage.max_bytes)
+    return ObjectCacheStorage.cache
+
+
+@contract(megabytes='int,>=0')
+def set_object_cache_size(megabytes):
+    ObjectCacheStorage.max_bytes = megabytes * 1024 * 1024
+    ObjectCacheStorage.cache = None
+    ObjectCacheStorage.instanced = {}
+
+
+def get_db(basepath, compress):
+    key = (basepath, compress)
+    if not key in ObjectCacheStorage.dbs:
+        ObjectCacheStorage.dbs[key] = StorageFilesystem(basepath, compress=compress)
+    return ObjectCacheStorage.dbs[key]
+
+
+class ObjectRef(object):
+    """
+        Reference to a test object, passed to the tests
+        instead of the Promise of the instance job.
+
+        In the worker, it is resolved using the object cache, and if
+        the object is not there, by loading the result of the instance
+        job from the compmake DB. If the job instanced several objects,
+        its result is a dict id_object -> (fingerprint, object).
+
+        If the object is an alias of another object with the same
+        class and params, instance_id is the id of the object that
+        was actually instanced (see find_canonical()).
+
+        code_fingerprint is the fingerprint of the source files of the
+        class that creates the object (see spec_code_fingerprint()), and
+        constructor is its name (the "code" entry of the spec).
+    """
+
+    def __init__(self, master_name, objspec_name, id_object, fingerprint,
+                 job_id, db_basepath, db_compress, instance_id=None,
+                 instance_fingerprint=None, code_fingerprint=None,
+                 constructor=None):
+        self.master_name = master_name
+        self.objspec_name = objspec_name
+        self.id_object = id_object
+        self.fingerprint = fingerprint
+        self.job_id = job_id
+        self.db_basepath = db_basepath
+        self.db_compress = db_compress
+        if instance_id is None:
+            instance_id, instance_fingerprint = id_object, fingerprint
+        self.instance_id = instance_id
+        self.instance_fingerprint = instance_fingerprint
+        self.code_fingerprint = code_fingerprint
+        self.constructor = constructor
+
+    def get_key(self):
+        return object_cache_key(self.master_name, self.objspec_name,
+                                self.instance_id, self.instance_fingerprint)
+
+    def load(self):
+        """
+            Returns object, nbytes loading from the compmake DB.
+
+            If the job instanced several objects, the others are put in
+            the object cache as well, so that the group is loaded once.
+        """
+        db = get_db(self.db_basepath, self.db_compress)
+        ob = get_job_userobject(self.job_id, db)
+        if not is_instances_job(self.job_id):
+            return unmap_arrays(ob), self.get_size(1)
+        nbytes = self.get_size(len(ob))
+        cache = get_object_cache()
+        if cache.max_bytes > 0:
+            for id_object, (fingerprint, other) in ob.items():
+                key = object_cache_key(self.master_name, self.objspec_name,
+                                       id_object, fingerprint)
+                if id_object != self.instance_id and not key in cache:
+                    cache.put(key, unmap_arrays(other), nbytes)
+        return unmap_arrays(ob[self.instance_id][1]), nbytes
+
+    def get_size(self, nobjects):
+        """
+            Size of the pickle of the result of the job in the compmake DB,
+            divided by the nobjects it contains (the memory-mapped arrays
+            are not counted: they are shared).
+        """
+        db = get_db(self.db_basepath, self.db_compress)
+        return job_userobject_sizeof(self.job_id, db) // nobjects
+
+    def _fields(self):
+        return (self.master_name, self.objspec_name, self.id_object,
+                self.fingerprint, self.job_id, self.db_basepath, self.db_compress,
+                self.instance_id, self.instance_fingerprint, self.code_fingerprint,
+                self.constructor)
+
+    # Compmake compares the arguments of the jobs when they are redefined
+    def __eq__(self, other):
+        return isinstance(other, ObjectRef) and self._fields() == other._fields()
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+    def __hash__(self):
+        return hash(self._fields())
+
+    def __repr__(self):
+        return 'ObjectRef(%s:%s:%s)' % (self.master_name, self.objspec_name, self.id_object)
+
+
+def object_cache_key(master_name, objspec_name, id_object, fingerprint):
+    return (master_name, objspec_name, id_object, fingerprint)
+
+
+def get_object_ref(context, objspec, id_object, job_id):
+    """ Returns the ObjectRef for the object created by the job job_id. """
+    db = context.cc.get_compmake_db()
+    compress = db.file_extension.endswith('.gz')
+    fingerprint = spec_fingerprint(objspec[id_object])
+    instance_id = get_canonical_ids(objspec).get(id_object, id_object)
+    code = objspec[id_object].get('code', None)
+    constructor = code[0] if code and isinstance(code[0], six.string_types) else None
+    return ObjectRef(master_name=objspec.master.name,
+                     objspec_name=objspec.name,
+                     id_object=id_object,
+                     fingerprint=fingerprint,
+                     job_id=job_id,
+                     db_basepath=db.basepath,
+                     db_compress=compress,
+                     instance_id=instance_id,
+                     instance_fingerprint=spec_fingerprint(objspec[instance_id]),
+                     code_fingerprint=spec_code_fingerprint(objspec[id_object]),
+                     constructor=constructor)
+
+
+@contract(objs='dict(str:str)', returns='dict(str:*)')
+def get_object_refs(context, objspec, objs):
+    """ Returns the ObjectRef for each of objs (dict id -> instance job_id). """
+    return dict((k, get_object_ref(context, objspec, k, job_id))
+                for k, job_id in objs.items())
+
+
+def get_code_files(ref, ob):
+    """
+        The source files of the class of the test object ob, and of the
+        constructor in its spec, if ref is its ObjectRef.
+    """
+    files = set(get_source_files(type(ob)))
+    constructor = getattr(ref, 'constructor', None)
+    if constructor is not None:
+        from conf_tools import import_name
+        try:
+            files.update(get_source_files(import_name(constructor)))
+        except Exception:  # the test would have failed
+            pass
+    return files
+
+
+def resolve_object(ob):
+    """ If ob is an ObjectRef, returns the object it refers to. """
+    if not isinstance(ob, ObjectRef):
+        return ob
+    cache = get_object_cache()
+    key = ob.get_key()
+    try:
+        return cache.get(key)
+    except KeyError:
+        pass
+    instanced = ObjectCacheStorage.instanced
+    if key in instanced:
+        # instanced in this process: its pickle is in the DB by now
+        value, nobjects = instanced.pop(key)
+        nbytes = ob.get_size(nobjects)
+    else:
+        value, nbytes = ob.load()
+    cache.put(key, value, nbytes)
+    return value
+
+
+def cache_object(master_name, objspec_name, id2spec, id2object):
+    """
+        Keeps the objects that an instance job just created, so that the
+        tests running in this process do not load them again. They are
+        added to the cache when used, with the size of their pickle
+        (which compmake writes after the job).
+    """
+    ObjectCacheStorage.instanced = {}
+    if get_object_cache().max_bytes == 0:
+        return
+    for id_object, ob in id2object.items():
+        key = object_cache_key(master_name, objspec_name, id_object,
+                               spec_fingerprint(id2spec[id_object]))
+        ObjectCacheStorage.instanced[key] = (ob, len(id2object))
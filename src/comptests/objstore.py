@@ -0,0 +1,132 @@
+# -*- coding: utf-8 -*-
+import os
+import pickle
+import sys
+
+from contracts import contract
+
+from . import logger
+from .dedupe import effective_fingerprint
+from .fingerprints import file_sha1, get_import_closure, sha1_of
+
+__all__ = [
+    'ObjectStore',
+]
+
+
+class PersistentObjects(object):
+    """ Static storage """
+    # Directory of the ObjectStore shared across runs; None disables it.
+    # This is set by CompTests (--objstore).
+    dirname = None
+
+
+class ObjectStore(object):
+    """
+        A directory with the pickles of the test objects that were
+        instanced, keyed by the fingerprint of their spec and of the
+        code that creates them (see object_store_key()), so that they
+        can be reused across runs, output directories and branches.
+
+        The files are touched when used; evict() removes the least
+        recently used ones.
+    """
+
+    def __init__(self, dirname):
+        self.dirname = dirname
+
+    def _filename(self, key):
+        return os.path.join(self.dirname, '%s.pickle' % key)
+
+    def get(self, key):
+        """ Returns the object; raises KeyError if not present. """
+        filename = self._filename(key)
+        try:
+            with open(filename, 'rb') as f:
+                ob = pickle.load(f)
+        except (IOError, OSError):
+            raise KeyError(key)
+        except Exception as e:
+            logger.warning('Could not read %s: %s' % (filename, e))
+            raise KeyError(key)
+        try:
+            os.utime(filename, None)
+        except OSError:
+            pass
+        return ob
+
+    def put(self, key, ob):
+        if not os.path.exists(self.dirname):
+            try:
+                os.makedirs(self.dirname)
+            except OSError:  # created by another worker
+                pass
+        filename = self._filename(key)
+        tmp = '%s.tmp%s' % (filename, os.getpid())
+        try:
+            with open(tmp, 'wb') as f:
+                pickle.dump(ob, f, pickle.HIGHEST_PROTOCOL)
+            os.rename(tmp, filename)
+        except Exception as e:
+            logger.warning('Could not save the object in %s: %s' % (filename, e))
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+
+    def clear(self):
+        """ Removes all the objects; returns how many. """
+        return self.evict(0)
+
+    @contract(max_bytes='int,>=0', returns='int')
+    def evict(self, max_bytes):
+        """ Removes the least recently used objects until the total size is
+            at most max_bytes. Returns the number of objects removed. """
+        if not os.path.exists(self.dirname):
+            return 0
+        files = []
+        for name in os.listdir(self.dirname):
+            if not name.endswith('.pickle'):
+                continue
+            filename = os.path.join(self.dirname, name)
+            try:
+                st = os.stat(filename)
+            except OSError:
+                continue
+            files.append((st.st_mtime, st.st_size, filename))
+        total = sum(size for _, size, _ in files)
+        removed = 0
+        for _, size, filename in sorted(files):
+            if total <= max_bytes:
+                break
+            try:
+                os.unlink(filename)
+            except OSError:
+                continue
+            total -= size
+            removed += 1
+        return removed
+
+
+def object_store_key(spec):
+    """
+        Returns the key of the object in the ObjectStore, or None if we
+        cannot tell which code creates it (then it is not stored).
+
+        The key depends on the "code" entry of the spec (the class or
+        function and its params, not the id of the object), and on the
+        source files of the modules that the class imports, recursively
+        (see get_import_closure()). What that does not find (e.g. the
+        data files read by the constructor) is not checked: use
+        --objstore_clear after changing it.
+    """
+    from conf_tools import import_name
+    code = spec.get('code', None) if isinstance(spec, dict) else None
+    if not code or not isinstance(code[0], str):
+        return None
+    try:
+        constructor = import_name(code[0])
+    except Exception:
+        return None
+    sources = [file_sha1(filename) for filename in get_import_closure(constructor)]
+    s = '%s\n%s\n%s' % (effective_fingerprint(spec), ' '.join(sources),
+                        sys.version_info[:2])
+    return sha1_of(s)
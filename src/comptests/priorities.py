@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import types
+
+import six
+from contracts import contract
+
+from . import logger
+from .timing import get_timing_store
+
+__all__ = [
+    'use_durations_as_priorities',
+]
+
+
+# the arguments of compmake's compute_priority()
+COMPUTE_PRIORITY_ARGS = ['job_id', 'priorities', 'targets', 'cq']
+
+
+class Priorities(object):
+    """ Static storage """
+    # job_id -> expected duration (seconds), from the timing DB
+    durations = {}
+    # the function of compmake that we wrap
+    compute_priority = None
+
+
+def compute_priority_with_durations(job_id, priorities, targets, cq):
+    """
+        Same as compmake's compute_priority(), plus the expected duration
+        of the job in seconds, so that the longest jobs (and the jobs they
+        depend on) are started first.
+    """
+    if job_id in priorities:
+        return priorities[job_id]
+    priority = Priorities.compute_priority(job_id, priorities, targets, cq)
+    priority += Priorities.durations.get(job_id, 0.0)
+    priorities[job_id] = priority
+    return priority
+
+
+@contract(timing='None|str')
+def use_durations_as_priorities(timing):
+    """
+        Makes compmake start the jobs with the longest recorded
+        duration first (LPT order).
+
+        timing: the timing DB (see TimingStore)
+    """
+    durations = {}
+    if timing is not None:
+        try:
+            durations = get_timing_store(timing).get_job_durations()
+        except sqlite3.Error as e:
+            logger.warning('Could not read the durations of the jobs: %s' % e)
+    Priorities.durations = durations
+    if not durations:
+        return
+
+    if Priorities.compute_priority is None:
+        priority = get_priority_module()
+        if priority is None:
+            return
+        # compute_priorities() calls compute_priority() through the module
+        Priorities.compute_priority = priority.compute_priority
+        priority.compute_priority = compute_priority_with_durations
+    logger.info('Using the durations of %d jobs as priorities.' % len(durations))
+
+
+def get_priority_module():
+    """
+        Returns the module compmake.jobs.priority if it has the function
+        compute_priority() that we wrap, with the arguments we expect;
+        otherwise warns and returns None (the durations are not used).
+    """
+    try:
+        from compmake.jobs import priority
+    except ImportError as e:
+        logger.warning('Cannot set the priorities of the jobs: %s' % e)
+        return None
+    f = getattr(priority, 'compute_priority', None)
+    if not isinstance(f, types.FunctionType):
+        msg = 'compmake.jobs.priority.compute_priority() not found'
+    else:
+        code = six.get_function_code(f)
+        args = list(code.co_varnames[:code.co_argcount])
+        if args == COMPUTE_PRIORITY_ARGS:
+            return priority
+        msg = 'compmake.jobs.priority.compute_priority() takes %s' % args
+    logger.warning('Cannot set the priorities of the jobs (%s); '
+                   'this version of compmake is not supported.' % msg)
+    return None
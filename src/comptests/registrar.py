@@ -4,10 +4,10 @@ import os
 import sys
 import traceback
 import warnings
-from collections import defaultdict, namedtuple, OrderedDict
+from collections import defaultdict
 
 from compmake import Promise
-from compmake.jobs import assert_job_exists
+from compmake.jobs import all_jobs
 from conf_tools import ConfigMaster, GlobalConfig, ObjectSpec
 from conf_tools.utils import expand_string
 from contracts import contract
@@ -15,8 +15,24 @@ from contracts.utils import raise_desc, indent
 from quickapp import iterate_context_names, iterate_context_names_pair
 
 from . import logger
+from .batches import define_tests_pairs_batches
+from .dedupe import (aliases_last, get_aliased_cells, get_aliased_objects,
+                     get_canonical_ids, same_result)
+from .fingerprints import comptest_identity, spec_fingerprint
+from .impact import Impact, run_traced
+from .incremental import (incremental_token, object_fingerprint,
+                          pair_incremental_token, record_success)
+from .objcache import (cache_object, get_object_refs, is_instances_job,
+                       resolve_object)
+from .objstore import ObjectStore, PersistentObjects, object_store_key
 from .reports import (report_results_pairs, report_results_pairs_jobs,
                       report_results_single)
+from .selection import (Selection, filter_compatible, filter_sampled,
+                        get_config_files, get_pair_cells, get_sampling,
+                        get_skip_reason, in_this_shard, is_upper_triangle)
+from .state import deferred_writes
+from .timing import Timing, run_timed
+from .transport import Transport, map_arrays
 
 __all__ = [
     'comptest',
@@ -34,9 +50,27 @@ __all__ = [
 ]
 
 
+class RegularTest(object):
+    """ A test registered with @comptest, @comptest_fails or @comptest_dynamic. """
+    __slots__ = ['function', 'dynamic', 'args', 'kwargs', 'module']
+
+    def __init__(self, function, dynamic, args, kwargs):
+        self.function = function
+        self.dynamic = dynamic
+        self.args = args
+        self.kwargs = kwargs
+        # top-level module, used by jobs_registrar_simple()
+        self.module = function.__module__.split('.')[0]
+
+    def __repr__(self):
+        return 'RegularTest(%s.%s)' % (self.function.__module__, self.function.__name__)
+
+
 class ComptestsRegistrar(object):
     """ Static storage """
-    regular = []  # list of dict(function=f, dynamic=dynamic))
+    regular = []  # list of RegularTest, in order of registration
+    # top-level module -> list of RegularTest
+    regular_by_module = defaultdict(list)
     # Once they are scheduled we add id(x) here, so we make sure we
     # don't register something twice
     regular_scheduled = set()
@@ -45,34 +79,50 @@ class ComptestsRegistrar(object):
     objspec2pairs = defaultdict(list)  # -> (objspec2, f)
     objspec2testsome = defaultdict(list)  # -> dict(function, id_object, dynamic=False)
     objspec2testsomepairs = defaultdict(list)
+    # objspec name -> ObjectSpec, for the objspecs with tests
+    objspecs = {}
 
 
 @contract(objspec=ObjectSpec, dynamic=bool)
 def register_single(objspec, f, dynamic):
+    ComptestsRegistrar.objspecs[objspec.name] = objspec
     ts = ComptestsRegistrar.objspec2tests[objspec.name]
     ts.append(dict(function=f, dynamic=dynamic))
 
 
-def register_pair(objspec1, objspec2, f, dynamic):
+def register_pair(objspec1, objspec2, f, dynamic, batch=None, compatible=None,
+                  symmetric=False, diagonal=True, sampling=None, by_row=None):
+    if symmetric and objspec1.name != objspec2.name:
+        msg = 'Symmetric pair tests need the same objspec, got %r and %r.' % (
+            objspec1.name, objspec2.name)
+        raise ValueError(msg)
+    ComptestsRegistrar.objspecs[objspec1.name] = objspec1
     ts = ComptestsRegistrar.objspec2pairs[objspec1.name]
-    ts.append(dict(objspec2=objspec2, function=f, dynamic=dynamic))
+    ts.append(dict(objspec2=objspec2, function=f, dynamic=dynamic, batch=batch,
+                   compatible=compatible, symmetric=symmetric, diagonal=diagonal,
+                   sampling=sampling, by_row=by_row))
 
 
-def register_for_some_pairs(objspec1, objspec2, f, which1, which2, dynamic):
+def register_for_some_pairs(objspec1, objspec2, f, which1, which2, dynamic,
+                            batch=None, compatible=None, sampling=None, by_row=None):
+    ComptestsRegistrar.objspecs[objspec1.name] = objspec1
     ts = ComptestsRegistrar.objspec2testsomepairs[objspec1.name]
     ts.append(dict(objspec2=objspec2, function=f, dynamic=dynamic,
-                   which1=which1, which2=which2))
+                   which1=which1, which2=which2, batch=batch,
+                   compatible=compatible, sampling=sampling, by_row=by_row))
 
 
 @contract(objspec=ObjectSpec, dynamic=bool)
 def register_for_some(objspec, f, which, dynamic):
+    ComptestsRegistrar.objspecs[objspec.name] = objspec
     ts = ComptestsRegistrar.objspec2testsome[objspec.name]
     ts.append(dict(function=f, which=which, dynamic=dynamic))
 
 
 def register_indep(f, dynamic, args, kwargs):
-    d = dict(function=f, dynamic=dynamic, args=args, kwargs=kwargs)
-    ComptestsRegistrar.regular.append(d)
+    x = RegularTest(function=f, dynamic=dynamic, args=args, kwargs=kwargs)
+    ComptestsRegistrar.regular.append(x)
+    ComptestsRegistrar.regular_by_module[x.module].append(x)
 
 
 def comptest(f):
@@ -200,13 +250,34 @@ def comptests_for_some_dynamic(objspec):
     return dec
 
 
-@contract(objspec1=ObjectSpec, objspec2=ObjectSpec)
-def comptests_for_some_pairs(objspec1, objspec2):
-    """ Returns a decorator for a test involving only a subset of objects. """
+@contract(objspec1=ObjectSpec, objspec2=ObjectSpec, batch='None|int,>=1',
+          by_row='None|bool', sample='None|int,>=1', cover='None|int,>=1', seed=int)
+def comptests_for_some_pairs(objspec1, objspec2, batch=None, compatible=None,
+                             sample=None, cover=None, seed=0, by_row=None):
+    """
+        Returns a decorator for a test involving only a subset of objects.
+
+        If batch is given, the cells are grouped in jobs of that many
+        cells (see the option --batch of comptests). If by_row, each job
+        has the cells of one object of objspec1 (see --by_row).
+
+        If compatible is given, it is called as
+        ``compatible(id_ob1, spec1, id_ob2, spec2)`` with the specs of
+        the objects; no job is defined for the pairs for which it
+        returns False (they are shown as "n/a" in the reports).
+
+        If sample or cover is given, the test is run only on a subset
+        of the pairs (see sample_cells()), unless comptests is called
+        with --full_pairs.
+    """
+    sampling = get_sampling(sample=sample, cover=cover, seed=seed)
 
     def dec(which1, which2):
         def register(f):
-            register_for_some_pairs(objspec1, objspec2, f, which1, which2, dynamic=False)
+            register_for_some_pairs(objspec1, objspec2, f, which1, which2,
+                                    dynamic=False, batch=batch,
+                                    compatible=compatible, sampling=sampling,
+                                    by_row=by_row)
             return f
 
         return register
@@ -237,10 +308,38 @@ def comptests_for_all_pairs_dynamic(objspec1, objspec2):
     return register
 
 
-@contract(objspec1=ObjectSpec, objspec2=ObjectSpec)
-def comptests_for_all_pairs(objspec1, objspec2):
+@contract(objspec1=ObjectSpec, objspec2=ObjectSpec, batch='None|int,>=1',
+          by_row='None|bool', symmetric=bool, diagonal=bool,
+          sample='None|int,>=1', cover='None|int,>=1', seed=int)
+def comptests_for_all_pairs(objspec1, objspec2, batch=None, compatible=None,
+                            symmetric=False, diagonal=True,
+                            sample=None, cover=None, seed=0, by_row=None):
+    """
+        Returns a decorator for a test involving all pairs of objects.
+
+        If batch is given, the cells are grouped in jobs of that many
+        cells (see the option --batch of comptests). If by_row, each job
+        has the cells of one object of objspec1 (see --by_row).
+
+        If compatible is given, it is called as
+        ``compatible(id_ob1, spec1, id_ob2, spec2)`` with the specs of
+        the objects; no job is defined for the pairs for which it
+        returns False (they are shown as "n/a" in the reports).
+
+        If symmetric (objspec1 and objspec2 must be the same), the test
+        is run only for id_ob1 < id_ob2, plus id_ob1 == id_ob2 if diagonal;
+        the reports show the matrix mirrored.
+
+        If sample or cover is given, the test is run only on a subset
+        of the pairs (see sample_cells()), unless comptests is called
+        with --full_pairs. The other pairs are shown as "not run".
+    """
+    sampling = get_sampling(sample=sample, cover=cover, seed=seed)
+
     def register(f):
-        register_pair(objspec1, objspec2, f, dynamic=False)
+        register_pair(objspec1, objspec2, f, dynamic=False, batch=batch,
+                      compatible=compatible, symmetric=symmetric,
+                      diagonal=diagonal, sampling=sampling, by_row=by_row)
         return f
 
     return register
@@ -256,7 +355,13 @@ def jobs_registrar(context, cm, create_reports=False):
 
     names = sorted(cm.specs.keys())
 
-    names2test_objects = context.comp_config_dynamic(get_testobjects_promises, cm)
+    if can_load_config(cm):
+        # Define all the tests now, rather than in two rounds of dynamic jobs.
+        names2test_objects = get_testobjects_promises(context, cm)
+        define = define_tests_for
+    else:
+        names2test_objects = context.comp_config_dynamic(get_testobjects_promises, cm)
+        define = None
 
     for c, name in iterate_context_names(context, names):
         pairs = ComptestsRegistrar.objspec2pairs[name]
@@ -264,37 +369,57 @@ def jobs_registrar(context, cm, create_reports=False):
         some = ComptestsRegistrar.objspec2testsome[name]
         some_pairs = ComptestsRegistrar.objspec2testsomepairs[name]
 
-        c.comp_config_dynamic(define_tests_for,
-                              cm=cm,
-                              name=name,
-                              names2test_objects=names2test_objects,
-                              pairs=pairs,
-                              functions=functions,
-                              some=some,
-                              some_pairs=some_pairs,
-                              create_reports=create_reports)
+        params = dict(cm=cm,
+                      name=name,
+                      names2test_objects=names2test_objects,
+                      pairs=pairs,
+                      functions=functions,
+                      some=some,
+                      some_pairs=some_pairs,
+                      create_reports=create_reports)
+        if define is not None:
+            define(c, **params)
+        else:
+            c.comp_config_dynamic(define_tests_for, **params)
 
     jobs_registrar_simple(context)
 
 
+@contract(cm=ConfigMaster, returns=bool)
+def can_load_config(cm):
+    """
+        True if the configuration can be loaded in this process,
+        so that the tests can be defined statically.
+    """
+    try:
+        cm.load()
+        for objspec in cm.specs.values():
+            objspec.keys()
+    except Exception as e:
+        msg = 'Could not load the configuration %r; ' % cm.name
+        msg += 'defining the tests in dynamic jobs:\n%s' % indent(str(e), '> ')
+        logger.warning(msg)
+        return False
+    return True
+
+
 def jobs_registrar_simple(context, only_for_module=None):
     """ Registers the simple "comptest" """
     prefix = context._job_prefix
 
+    if only_for_module is None:
+        regular = ComptestsRegistrar.regular
+    else:
+        regular = ComptestsRegistrar.regular_by_module.get(only_for_module, [])
+
     n = 0
-    for x in ComptestsRegistrar.regular:
-        function = x['function']
-        dynamic = x['dynamic']
-        args = x['args']
-        kwargs = x['kwargs']
-
-        if only_for_module is not None:
-            this = function.__module__.split(".")[0]
-            if this != only_for_module:
-                msg = ('Skipping function %s in module %s because not in module %r' %
-                       (function, function.__module__, only_for_module))
-                #                 logger.error(msg)
-                continue
+    # reason -> number of tests skipped
+    skipped = defaultdict(int)
+    for x in regular:
+        function = x.function
+        dynamic = x.dynamic
+        args = x.args
+        kwargs = x.kwargs
 
         id_x = id(x)
         if id_x in ComptestsRegistrar.regular_scheduled:
@@ -304,9 +429,18 @@ def jobs_registrar_simple(context, only_for_module=None):
 
         ComptestsRegistrar.regular_scheduled.add(id_x)
 
+        if dynamic:
+            token = None
+        else:
+            token = incremental_token(function, [], args=args, kwargs=kwargs)
+        reason = get_skip_reason(function, [], token, dynamic)
+        if reason is not None:
+            skipped[reason] += 1
+            continue
+
         # print('registering %s' % x)
         #         logger.debug("registering %s" % function.__name__)
-        wrapper = WrapTest(function, prefix)
+        wrapper = WrapTest(function, prefix, incremental=token)
         if not dynamic:
             _res = context.comp_config(wrapper, *args, **kwargs)
         else:
@@ -314,14 +448,21 @@ def jobs_registrar_simple(context, only_for_module=None):
 
         n += 1
 
-    logger.info('Registered %d tests (reading a list of %s)' % (n, len(ComptestsRegistrar.regular)))
+    logger.info('Registered %d tests (reading a list of %s)' % (n, len(regular)))
+    for reason, nskipped in sorted(skipped.items()):
+        logger.info('Skipped %d tests (%s).' % (nskipped, reason))
 
 
 class WrapTest(object):
 
-    def __init__(self, function, prefix):
+    def __init__(self, function, prefix, incremental=None):
         self.__name__ = function.__name__
         self.function = function
+        # see incremental_token()
+        self.incremental = incremental
+        # see run_timed() and run_traced()
+        self.timing = Timing.filename
+        self.footprints = Impact.filename
         from .comptests import CompTests
         if prefix is not None:
             self.output_dir = os.path.join(CompTests.global_output_dir,
@@ -333,20 +474,87 @@ class WrapTest(object):
     def __call__(self, *args, **kwargs):
         from .comptests import CompTests
         CompTests.output_dir_for_current_test = self.output_dir
-        return self.function(*args, **kwargs)
+        identity = comptest_identity(self.function)
+        with deferred_writes():
+            res = run_timed(self.timing, identity,
+                            run_traced, self.footprints, identity, [],
+                            self.function, *args, **kwargs)
+            record_success(self.incremental)
+        return res
 
 
 @contract(cm=ConfigMaster,
           returns='dict(str:dict(str:str))')
 def get_testobjects_promises(context, cm):
+    """
+        Defines the instance jobs of all the test objects, and returns
+        the dict objspec name -> id_object -> job_id, which is then
+        passed to define_tests_for() for each objspec.
+
+        With --shard, only the objects used by the tests of this shard
+        are instanced; the others have the id their job would have.
+    """
+    needed = get_shard_objects(cm)
     names2test_objects = {}
+    defined = {}
     for name in sorted(cm.specs.keys()):
         objspec = cm.specs[name]
-        its = get_testobjects_promises_for_objspec(context, objspec)
+        needed_i = None if needed is None else needed[name]
+        its = get_testobjects_promises_for_objspec(context, objspec, needed=needed_i)
         names2test_objects[name] = its
+        defined[name] = dict((k, v) for k, v in its.items()
+                             if needed_i is None or k in needed_i)
+    check_instance_jobs(context, defined)
     return names2test_objects
 
 
+@contract(cm=ConfigMaster, returns='None|dict(str:set(str))')
+def get_shard_objects(cm):
+    """
+        Returns the dict objspec name -> ids of the objects used by the
+        tests of this shard (--shard), or None if we run all the tests.
+    """
+    if Selection.shard is None:
+        return None
+    ids = dict((name, sorted(objspec.keys())) for name, objspec in cm.specs.items())
+    needed = dict((name, set()) for name in cm.specs)
+
+    def add_single(function, objspec_name, objects):
+        for id_object in objects:
+            if in_this_shard(comptest_identity(function, id_object)):
+                needed[objspec_name].add(id_object)
+
+    def add_pairs(function, objspec1, objspec2, cells):
+        for id_ob1, id_ob2 in cells:
+            if in_this_shard(comptest_identity(function, id_ob1, id_ob2)):
+                needed[objspec1.name].add(id_ob1)
+                needed[objspec2.name].add(id_ob2)
+
+    for name in sorted(cm.specs):
+        objspec = cm.specs[name]
+        for x in ComptestsRegistrar.objspec2tests[name]:
+            add_single(x['function'], name, ids[name])
+        for x in ComptestsRegistrar.objspec2testsome[name]:
+            add_single(x['function'], name, expand_string(x['which'], ids[name]))
+        for x in ComptestsRegistrar.objspec2pairs[name]:
+            objspec2 = x['objspec2']
+            cells = get_pair_cells(objspec, objspec2, ids[name], ids[objspec2.name],
+                                   symmetric=x.get('symmetric', False),
+                                   diagonal=x.get('diagonal', True),
+                                   compatible=x.get('compatible', None),
+                                   sampling=x.get('sampling', None))
+            add_pairs(x['function'], objspec, objspec2, cells)
+        for x in ComptestsRegistrar.objspec2testsomepairs[name]:
+            objspec2 = x['objspec2']
+            cells = get_pair_cells(objspec, objspec2,
+                                   expand_string(x['which1'], ids[name]),
+                                   expand_string(x['which2'], ids[objspec2.name]),
+                                   compatible=x.get('compatible', None),
+                                   sampling=x.get('sampling', None))
+            add_pairs(x['function'], objspec, objspec2, cells)
+    return needed
+
+
 @contract(name=str, create_reports='bool',
           names2test_objects='dict(str:dict(str:str))')
 def define_tests_for(context, cm, name, names2test_objects,
@@ -368,6 +576,24 @@ def define_tests_for(context, cm, name, names2test_objects,
                       some=some, create_reports=create_reports)
 
 
+@contract(names2test_objects='dict(str:dict(str:str))')
+def check_instance_jobs(context, names2test_objects):
+    """
+        Checks that the instance jobs of the test objects exist,
+        listing the jobs in the DB only once (for all the objspecs).
+    """
+    expected = set()
+    for objs in names2test_objects.values():
+        expected.update(objs.values())
+    if not expected:
+        return
+    db = context.cc.get_compmake_db()
+    missing = expected - set(all_jobs(db))
+    if missing:
+        msg = 'Could not find the instance jobs %s.' % sorted(missing)
+        raise ValueError(msg)
+
+
 @contract(names2test_objects='dict(str:dict(str:str))')
 def define_tests_some(context, objspec, names2test_objects,
                       some, create_reports):
@@ -383,13 +609,13 @@ def define_tests_some(context, objspec, names2test_objects,
         print(msg)
         return
 
-    db = context.cc.get_compmake_db()
-
     for x in some:
         f = x['function']
         which = x['which']
         dynamic = x['dynamic']
         results = {}
+        # id_object -> reason why there is no job
+        excluded = {}
 
         c = context.child(f.__name__)
         c.add_extra_report_keys(objspec=objspec.name, function=f.__name__)
@@ -400,26 +626,42 @@ def define_tests_some(context, objspec, names2test_objects,
             raise ValueError(msg)
 
         print('Testing %s for %s' % (f, objects))
+        refs = get_object_refs(context, objspec, dict((k, test_objects[k]) for k in objects))
 
+        # id_object -> object whose results are reused (--dedupe_tests)
+        aliased = get_aliased_objects(objspec, objects)
         it = iterate_context_names(c, objects, key=objspec.name)
-        for cc, id_object in it:
+        for cc, id_object in aliases_last(it, aliased):
             ob_job_id = test_objects[id_object]
-            assert_job_exists(ob_job_id, db)
-            ob = Promise(ob_job_id)
+            ob = refs[id_object]
+            token = incremental_token(f, [id_object], [object_fingerprint(ob)])
+            reason = get_skip_reason(f, [id_object], token, dynamic,
+                                     get_config_files(objspec, id_object))
+            if reason is not None:
+                excluded[id_object] = reason
+                continue
             # bjob_id = 'f'  # XXX
             job_id = '%s-%s' % (f.__name__, id_object)
+            if aliased.get(id_object, None) in results:
+                results[id_object] = cc.comp(same_result, results[aliased[id_object]],
+                                             job_id=job_id, command_name=f.__name__)
+                continue
 
-            params = dict(job_id=job_id, command_name=f.__name__)
+            params = dict(job_id=job_id, command_name=f.__name__,
+                          extra_dep=[Promise(ob_job_id)],
+                          timing=Timing.filename,
+                          footprints=Impact.filename)
             if dynamic:
                 res = cc.comp_config_dynamic(wrap_func_dyn, f, id_object, ob,
                                              **params)
             else:
                 res = cc.comp_config(wrap_func, f, id_object, ob,
-                                     **params)
+                                     incremental=token, **params)
             results[id_object] = res
 
         if create_reports:
-            r = c.comp(report_results_single, f, objspec.name, results)
+            r = c.comp(report_results_single, f, objspec.name, results,
+                       excluded=excluded)
             c.add_report(r, 'some')
 
 
@@ -436,34 +678,51 @@ def define_tests_single(context, objspec, names2test_objects,
         msg = 'No mcdp_lang_tests specified for objects of kind %r.' % objspec.name
         print(msg)
 
-    db = context.cc.get_compmake_db()
+    refs = get_object_refs(context, objspec, test_objects)
 
     for x in functions:
         f = x['function']
         dynamic = x['dynamic']
         results = {}
+        # id_object -> reason why there is no job
+        excluded = {}
 
         c = context.child(f.__name__)
         c.add_extra_report_keys(objspec=objspec.name, function=f.__name__)
 
+        # id_object -> object whose results are reused (--dedupe_tests)
+        aliased = get_aliased_objects(objspec, list(test_objects))
         it = iterate_context_names(c, list(test_objects), key=objspec.name)
-        for cc, id_object in it:
+        for cc, id_object in aliases_last(it, aliased):
             ob_job_id = test_objects[id_object]
-            assert_job_exists(ob_job_id, db)
-            ob = Promise(ob_job_id)
+            ob = refs[id_object]
+            token = incremental_token(f, [id_object], [object_fingerprint(ob)])
+            reason = get_skip_reason(f, [id_object], token, dynamic,
+                                     get_config_files(objspec, id_object))
+            if reason is not None:
+                excluded[id_object] = reason
+                continue
             job_id = 'f'
+            if aliased.get(id_object, None) in results:
+                results[id_object] = cc.comp(same_result, results[aliased[id_object]],
+                                             job_id=job_id, command_name=f.__name__)
+                continue
 
-            params = dict(job_id=job_id, command_name=f.__name__)
+            params = dict(job_id=job_id, command_name=f.__name__,
+                          extra_dep=[Promise(ob_job_id)],
+                          timing=Timing.filename,
+                          footprints=Impact.filename)
             if dynamic:
                 res = cc.comp_config_dynamic(wrap_func_dyn, f, id_object, ob,
                                              **params)
             else:
                 res = cc.comp_config(wrap_func, f, id_object, ob,
-                                     **params)
+                                     incremental=token, **params)
             results[id_object] = res
 
         if create_reports:
-            r = c.comp(report_results_single, f, objspec.name, results)
+            r = c.comp(report_results_single, f, objspec.name, results,
+                       excluded=excluded)
             c.add_report(r, 'single')
 
 
@@ -494,17 +753,54 @@ def define_tests_pairs(context, objspec1, names2test_objects, pairs, create_repo
         results = {}
         jobs = {}
 
-        db = context.cc.get_compmake_db()
+        symmetric = x.get('symmetric', False)
+        combinations = iterate_pairs(cx, objspec1, objspec2, objs1, objs2,
+                                     symmetric=symmetric,
+                                     diagonal=x.get('diagonal', True))
+        # (id_ob1, id_ob2) -> reason why there is no job
+        combinations, excluded = filter_compatible(combinations, objspec1, objspec2,
+                                                   x.get('compatible', None))
+        combinations, not_sampled = filter_sampled(combinations, x.get('sampling', None))
+        excluded.update(not_sampled)
+        # (id_ob1, id_ob2) -> cell whose results are reused (--dedupe_tests)
+        aliased = get_aliased_cells(objspec1, objspec2,
+                                    [(a, b) for _, a, b in combinations],
+                                    symmetric=symmetric)
+        batch = get_batch_size(x)
+        by_row = get_by_row(x)
+        if (batch > 1 or by_row) and not dynamic:
+            define_tests_pairs_batches(cx, objspec1, objspec2, combinations,
+                                       objs1, objs2, func, batch,
+                                       create_reports, report_suffix='',
+                                       excluded=excluded, symmetric=symmetric,
+                                       by_row=by_row, aliased=aliased)
+            continue
 
-        combinations = iterate_context_names_pair(cx, list(objs1), list(objs2),
-                                                  key1=objspec1.name, key2=objspec2.name)
-        for c, id_ob1, id_ob2 in combinations:
-            assert_job_exists(objs1[id_ob1], db)
-            assert_job_exists(objs2[id_ob2], db)
-            ob1 = Promise(objs1[id_ob1])
-            ob2 = Promise(objs2[id_ob2])
+        refs1 = get_object_refs(context, objspec1, objs1)
+        refs2 = get_object_refs(context, objspec2, objs2)
+        for c, id_ob1, id_ob2 in aliases_last(combinations, aliased):
+            ob1 = refs1[id_ob1]
+            ob2 = refs2[id_ob2]
+            token = pair_incremental_token(func, ob1, ob2)
+            config_files = (get_config_files(objspec1, id_ob1) +
+                            get_config_files(objspec2, id_ob2))
+            reason = get_skip_reason(func, [id_ob1, id_ob2], token, dynamic,
+                                     config_files)
+            if reason is not None:
+                excluded[(id_ob1, id_ob2)] = reason
+                continue
+            key = (id_ob1, id_ob2)
+            if aliased.get(key, None) in results:
+                res = c.comp(same_result, results[aliased[key]],
+                             job_id='f', command_name=func.__name__)
+                results[key] = res
+                jobs[key] = res.job_id
+                continue
 
-            params = dict(job_id='f', command_name=func.__name__)
+            params = dict(job_id='f', command_name=func.__name__,
+                          extra_dep=[Promise(objs1[id_ob1]), Promise(objs2[id_ob2])],
+                          timing=Timing.filename,
+                          footprints=Impact.filename)
             if dynamic:
                 res = c.comp_config_dynamic(wrap_func_pair_dyn,
                                             func, id_ob1, ob1, id_ob2, ob2,
@@ -512,7 +808,7 @@ def define_tests_pairs(context, objspec1, names2test_objects, pairs, create_repo
             else:
                 res = c.comp_config(wrap_func_pair,
                                     func, id_ob1, ob1, id_ob2, ob2,
-                                    **params)
+                                    incremental=token, **params)
             results[(id_ob1, id_ob2)] = res
             jobs[(id_ob1, id_ob2)] = res.job_id
 
@@ -520,11 +816,13 @@ def define_tests_pairs(context, objspec1, names2test_objects, pairs, create_repo
 
         if create_reports:
             r = cx.comp_dynamic(report_results_pairs_jobs,
-                                func, objspec1.name, objspec2.name, jobs)
+                                func, objspec1.name, objspec2.name, jobs,
+                                excluded=excluded, symmetric=symmetric)
             cx.add_report(r, 'jobs_pairs')
 
             r = cx.comp(report_results_pairs,
-                        func, objspec1.name, objspec2.name, results)
+                        func, objspec1.name, objspec2.name, results,
+                        excluded=excluded, symmetric=symmetric)
             cx.add_report(r, 'pairs')
 
 
@@ -542,6 +840,10 @@ def define_tests_some_pairs(context, objspec1, names2test_objects, some_pairs, c
         which1 = x['which1']
         which2 = x['which2']
         dynamic = x['dynamic']
+        batch = get_batch_size(x)
+        by_row = get_by_row(x)
+        compatible = x.get('compatible', None)
+        sampling = x.get('sampling', None)
 
         allobjs1 = names2test_objects[objspec1.name]
         allobjs2 = names2test_objects[objspec2.name]
@@ -570,25 +872,60 @@ def define_tests_some_pairs(context, objspec1, names2test_objects, some_pairs, c
         cx = context.child(func.__name__)
         cx.add_extra_report_keys(objspec1=objspec1.name, objspec2=objspec2.name,
                                  function=func.__name__, type='some')
-        db = context.cc.get_compmake_db()
 
         use_objs1 = dict((k, allobjs1[k]) for k in objs1)
         use_objs2 = dict((k, allobjs2[k]) for k in objs2)
-        define_tests_some_pairs_(cx, db, objspec1, objspec2, use_objs1, use_objs2, func, dynamic, create_reports)
+        define_tests_some_pairs_(cx, objspec1, objspec2, use_objs1, use_objs2, func, dynamic, create_reports,
+                                 batch=batch, compatible=compatible,
+                                 sampling=sampling, by_row=by_row)
 
 
-def define_tests_some_pairs_(cx, db, objspec1, objspec2, objs1, objs2, func, dynamic, create_reports):
+def define_tests_some_pairs_(cx, objspec1, objspec2, objs1, objs2, func, dynamic, create_reports,
+                             batch=1, compatible=None, sampling=None, by_row=False):
     results = {}
     jobs = {}
-    combinations = iterate_context_names_pair(cx, list(objs1), list(objs2),
-                                              key1=objspec1.name, key2=objspec2.name)
-    for c, id_ob1, id_ob2 in combinations:
-        assert_job_exists(objs1[id_ob1], db)
-        assert_job_exists(objs2[id_ob2], db)
-        ob1 = Promise(objs1[id_ob1])
-        ob2 = Promise(objs2[id_ob2])
+    combinations = iterate_pairs(cx, objspec1, objspec2, objs1, objs2)
+    # (id_ob1, id_ob2) -> reason why there is no job
+    combinations, excluded = filter_compatible(combinations, objspec1, objspec2,
+                                               compatible)
+    combinations, not_sampled = filter_sampled(combinations, sampling)
+    excluded.update(not_sampled)
+    # (id_ob1, id_ob2) -> cell whose results are reused (--dedupe_tests)
+    aliased = get_aliased_cells(objspec1, objspec2,
+                                [(a, b) for _, a, b in combinations])
+    if (batch > 1 or by_row) and not dynamic:
+        define_tests_pairs_batches(cx, objspec1, objspec2, combinations,
+                                   objs1, objs2, func, batch,
+                                   create_reports, report_suffix='_some',
+                                   excluded=excluded, by_row=by_row,
+                                   aliased=aliased)
+        return
+
+    refs1 = get_object_refs(cx, objspec1, objs1)
+    refs2 = get_object_refs(cx, objspec2, objs2)
+    for c, id_ob1, id_ob2 in aliases_last(combinations, aliased):
+        ob1 = refs1[id_ob1]
+        ob2 = refs2[id_ob2]
+        token = pair_incremental_token(func, ob1, ob2)
+        config_files = (get_config_files(objspec1, id_ob1) +
+                        get_config_files(objspec2, id_ob2))
+        reason = get_skip_reason(func, [id_ob1, id_ob2], token, dynamic,
+                                 config_files)
+        if reason is not None:
+            excluded[(id_ob1, id_ob2)] = reason
+            continue
+        key = (id_ob1, id_ob2)
+        if aliased.get(key, None) in results:
+            res = c.comp(same_result, results[aliased[key]],
+                         job_id='f', command_name=func.__name__)
+            results[key] = res
+            jobs[key] = res.job_id
+            continue
 
-        params = dict(job_id='f', command_name=func.__name__)
+        params = dict(job_id='f', command_name=func.__name__,
+                      extra_dep=[Promise(objs1[id_ob1]), Promise(objs2[id_ob2])],
+                      timing=Timing.filename,
+                      footprints=Impact.filename)
         if dynamic:
             res = c.comp_config_dynamic(wrap_func_pair_dyn,
                                         func, id_ob1, ob1, id_ob2, ob2,
@@ -596,44 +933,121 @@ def define_tests_some_pairs_(cx, db, objspec1, objspec2, objs1, objs2, func, dyn
         else:
             res = c.comp_config(wrap_func_pair,
                                 func, id_ob1, ob1, id_ob2, ob2,
-                                **params)
+                                incremental=token, **params)
         results[(id_ob1, id_ob2)] = res
         jobs[(id_ob1, id_ob2)] = res.job_id
 
     if create_reports:
         r = cx.comp_dynamic(report_results_pairs_jobs,
-                            func, objspec1.name, objspec2.name, jobs)
+                            func, objspec1.name, objspec2.name, jobs,
+                            excluded=excluded)
         cx.add_report(r, 'jobs_pairs_some')
 
         r = cx.comp(report_results_pairs,
-                    func, objspec1.name, objspec2.name, results)
+                    func, objspec1.name, objspec2.name, results,
+                    excluded=excluded)
         cx.add_report(r, 'pairs_some')
 
 
-def wrap_func(func, id_ob1, ob1):
-    # print('%20s: %s' % (id_ob1, describe_value(ob1)))
-    return func(id_ob1, ob1)
+def iterate_pairs(cx, objspec1, objspec2, objs1, objs2, symmetric=False,
+                  diagonal=True):
+    """
+        Yields (context, id_ob1, id_ob2) for the pairs of objects.
+
+        If symmetric, only the pairs with id_ob1 < id_ob2 (and with
+        id_ob1 == id_ob2 if diagonal) are generated.
+    """
+    key1 = objspec1.name
+    key2 = objspec2.name
+    if key2 == key1:
+        # the two report keys must be different
+        key2 = '%s2' % key2
+    combinations = iterate_context_names_pair(cx, list(objs1), list(objs2),
+                                              key1=key1, key2=key2)
+    for c, id_ob1, id_ob2 in combinations:
+        if symmetric and not is_upper_triangle(id_ob1, id_ob2, diagonal):
+            continue
+        yield c, id_ob1, id_ob2
 
 
-def wrap_func_dyn(context, func, id_ob1, ob1):
+def get_batch_size(x):
+    """ Returns the number of cells per job for the pair test x
+        (1 means one job per cell). """
+    from .comptests import CompTests
+    batch = x.get('batch', None)
+    if batch is None:
+        batch = CompTests.batch
+    return max(1, batch)
+
+
+def get_by_row(x):
+    """ True if the jobs of the pair test x should have the cells of one row each. """
+    from .comptests import CompTests
+    by_row = x.get('by_row', None)
+    if by_row is None:
+        by_row = CompTests.by_row
+    return by_row
+
+
+# The objects are passed as ObjectRef and resolved using the object cache.
+# The execution is recorded in the timing DB (see run_timed()) and
+# in the footprints DB (see run_traced()), at the end of the job
+# (see deferred_writes()).
+
+def wrap_func(func, id_ob1, ob1, incremental=None, timing=None, footprints=None):
     # print('%20s: %s' % (id_ob1, describe_value(ob1)))
-    return func(context, id_ob1, ob1)
+    ref1, ob1 = ob1, resolve_object(ob1)
+    identity = comptest_identity(func, id_ob1)
+    with deferred_writes():
+        res = run_timed(timing, identity, run_traced, footprints, identity,
+                        [(ref1, ob1)], func, id_ob1, ob1)
+        record_success(incremental)
+    return res
 
 
-def wrap_func_pair_dyn(context, func, id_ob1, ob1, id_ob2, ob2):
+def wrap_func_dyn(context, func, id_ob1, ob1, timing=None, footprints=None):
     # print('%20s: %s' % (id_ob1, describe_value(ob1)))
-    # print('%20s: %s' % (id_ob2, describe_value(ob2)))
-    return func(context, id_ob1, ob1, id_ob2, ob2)
+    ref1, ob1 = ob1, resolve_object(ob1)
+    identity = comptest_identity(func, id_ob1)
+    with deferred_writes():
+        return run_timed(timing, identity, run_traced, footprints, identity,
+                         [(ref1, ob1)], func, context, id_ob1, ob1)
 
 
-def wrap_func_pair(func, id_ob1, ob1, id_ob2, ob2):
+def wrap_func_pair_dyn(context, func, id_ob1, ob1, id_ob2, ob2, timing=None,
+                       footprints=None):
     # print('%20s: %s' % (id_ob1, describe_value(ob1)))
     # print('%20s: %s' % (id_ob2, describe_value(ob2)))
-    return func(id_ob1, ob1, id_ob2, ob2)
+    ref1, ob1 = ob1, resolve_object(ob1)
+    ref2, ob2 = ob2, resolve_object(ob2)
+    identity = comptest_identity(func, id_ob1, id_ob2)
+    with deferred_writes():
+        return run_timed(timing, identity, run_traced, footprints, identity,
+                         [(ref1, ob1), (ref2, ob2)],
+                         func, context, id_ob1, ob1, id_ob2, ob2)
 
 
-@contract(objspec=ObjectSpec, returns='dict(str:str)')
-def get_testobjects_promises_for_objspec(context, objspec):
+def wrap_func_pair(func, id_ob1, ob1, id_ob2, ob2, incremental=None, timing=None,
+                   footprints=None):
+    # print('%20s: %s' % (id_ob1, describe_value(ob1)))
+    # print('%20s: %s' % (id_ob2, describe_value(ob2)))
+    ref1, ob1 = ob1, resolve_object(ob1)
+    ref2, ob2 = ob2, resolve_object(ob2)
+    identity = comptest_identity(func, id_ob1, id_ob2)
+    with deferred_writes():
+        res = run_timed(timing, identity, run_traced, footprints, identity,
+                        [(ref1, ob1), (ref2, ob2)], func, id_ob1, ob1, id_ob2, ob2)
+        record_success(incremental)
+    return res
+
+
+@contract(objspec=ObjectSpec, needed='None|set(str)', returns='dict(str:str)')
+def get_testobjects_promises_for_objspec(context, objspec, needed=None):
+    """
+        Defines the instance jobs of the objects, and returns the dict
+        id_object -> job_id. If needed is given, only the jobs for those
+        objects are defined (see get_shard_objects()).
+    """
     warnings.warn('Need to be smarter here.')
     objspec.master.load()
     warnings.warn('Select test objects here.')
@@ -645,10 +1059,38 @@ def get_testobjects_promises_for_objspec(context, objspec):
             msg = 'Could not find any test objects for %r.' % objspec
             raise ValueError(msg)
 
+    # the objects with the same class and params are instanced once
+    canonical = get_canonical_ids(objspec)
+    aliases = [k for k in objects if canonical.get(k, k) != k]
+    if aliases:
+        logger.info('%s: %d objects are aliases of other objects: %s' %
+                    (objspec.name, len(aliases), ', '.join(aliases)))
+    instanced = [k for k in objects if not k in aliases]
+    if needed is None:
+        to_define = set(instanced)
+    else:
+        # the aliases use the instance job of their canonical object
+        to_define = set(canonical.get(k, k) for k in needed)
+        logger.info('%s: instancing %d of %d objects for this shard.' %
+                    (objspec.name, len(to_define), len(instanced)))
+
+    from .comptests import CompTests
+    if CompTests.instance_batch > 1 and objspec.instance_method is not None:
+        promises = define_instance_batches(context, objspec,
+                                           [k for k in instanced if k in to_define],
+                                           CompTests.instance_batch)
+        for id_object in instanced:
+            if not id_object in promises:  # not used by this shard
+                promises[id_object] = '%s-instance-%s' % (objspec.name, id_object)
+        return add_aliases(promises, aliases, canonical)
+
     promises = {}
-    for id_object in objects:
+    for id_object in instanced:
         params = dict(job_id='%s-instance-%s' % (objspec.name, id_object),
                       command_name='instance_%s' % objspec.name)
+        if not id_object in to_define:  # not used by this shard
+            promises[id_object] = params['job_id']
+            continue
         if objspec.instance_method is None:
             job = context.comp_config(get_spec, master_name=objspec.master.name,
                                       objspec_name=objspec.name, id_object=id_object,
@@ -657,25 +1099,102 @@ def get_testobjects_promises_for_objspec(context, objspec):
             job = context.comp_config(instance_object,
                                       master_name=objspec.master.name,
                                       objspec_name=objspec.name, id_object=id_object,
+                                      arrays_dir=Transport.dirname,
+                                      objstore=PersistentObjects.dirname,
                                       **params)
         promises[id_object] = job.job_id
-        db = context.cc.get_compmake_db()
-        assert_job_exists(job.job_id, db)
         # print('defined %r -> %s' % (id_object, job.job_id))
         if not job.job_id.endswith(params['job_id']):
             msg = 'Wanted %r but got %r' % (params['job_id'], job.job_id)
             raise ValueError(msg)
+    return add_aliases(promises, aliases, canonical)
+
+
+def add_aliases(promises, aliases, canonical):
+    """ The aliases use the instance job of their canonical object. """
+    for id_object in aliases:
+        promises[id_object] = promises[canonical[id_object]]
+    return promises
+
+
+@contract(objects='list(str)', size='int,>=2', returns='dict(str:str)')
+def define_instance_batches(context, objspec, objects, size):
+    """
+        Defines jobs that instance up to size objects each. The tests
+        find each object in the result of its job (see ObjectRef).
+    """
+    promises = {}
+    for i in range(0, len(objects), size):
+        id_objects = objects[i:i + size]
+        job_id = '%s-instances%d' % (objspec.name, i // size)
+        job = context.comp_config(instance_objects,
+                                  master_name=objspec.master.name,
+                                  objspec_name=objspec.name, id_objects=id_objects,
+                                  arrays_dir=Transport.dirname,
+                                  objstore=PersistentObjects.dirname,
+                                  job_id=job_id,
+                                  command_name='instance_%s' % objspec.name)
+        if not is_instances_job(job.job_id):
+            msg = 'Wanted %r but got %r' % (job_id, job.job_id)
+            raise ValueError(msg)
+        for id_object in id_objects:
+            promises[id_object] = job.job_id
     return promises
 
 
+def instance_objects(master_name, objspec_name, id_objects, arrays_dir=None,
+                     objstore=None):
+    """
+        Returns a dict id_object -> (fingerprint of its spec, result of
+        instance_object()); the fingerprints let ObjectRef.load() put
+        all the objects in the cache.
+    """
+    objspec = get_objspec(master_name, objspec_name)
+    id2object = dict((id_object, create_object(objspec, id_object, objstore))
+                     for id_object in id_objects)
+    # the tests running in this process will find them here
+    cache_object(master_name, objspec_name,
+                 dict((id_object, objspec[id_object]) for id_object in id_objects),
+                 id2object)
+    return dict((id_object, (spec_fingerprint(objspec[id_object]),
+                             map_arrays(ob, arrays_dir)))
+                for id_object, ob in id2object.items())
+
+
 def get_spec(master_name, objspec_name, id_object):
     objspec = get_objspec(master_name, objspec_name)
     return objspec[id_object]
 
 
-def instance_object(master_name, objspec_name, id_object):
+def instance_object(master_name, objspec_name, id_object, arrays_dir=None,
+                    objstore=None):
+    """
+        arrays_dir: if given, the big NumPy arrays of the object are
+        written there rather than in the compmake DB (see map_arrays()).
+        objstore: if given, the directory of the ObjectStore where the
+        object is looked up before instancing it, and saved after.
+    """
     objspec = get_objspec(master_name, objspec_name)
-    return objspec.instance(id_object)
+    ob = create_object(objspec, id_object, objstore)
+    # the tests running in this process will find it here
+    cache_object(master_name, objspec_name, {id_object: objspec[id_object]},
+                 {id_object: ob})
+    return map_arrays(ob, arrays_dir)
+
+
+def create_object(objspec, id_object, objstore):
+    """ Instances the object, or loads it from the ObjectStore in objstore. """
+    if objstore is None:
+        return objspec.instance(id_object)
+    key = object_store_key(objspec[id_object])
+    try:
+        ob = ObjectStore(objstore).get(key)
+    except KeyError:
+        ob = objspec.instance(id_object)
+        ObjectStore(objstore).put(key, ob)
+    else:
+        logger.info('Using the stored instance of %s.' % id_object)
+    return ob
 
 
 def get_objspec(master_name, objspec_name):
@@ -697,9 +1216,15 @@ def run_module_tests():
             run_module_tests()
 
         argument 1: grep
+
+        With "-j N", the tests are run in N processes, and also the tests
+        on objects (comptests_for_all and similar) are run, each object
+        being instanced once.
     """
+    from .runner import (get_objects_tasks, get_regular_tasks,
+                         parse_runner_args, run_tasks)
     #     logger.debug('run_module_tests: args = %s' % sys.argv)
-    grep = sys.argv[1] if len(sys.argv) > 1 else None
+    grep, nprocesses = parse_runner_args(sys.argv[1:])
 
     #     logger.debug('grep = %r' % grep)
     def should_ignore(its_name):
@@ -710,35 +1235,16 @@ def run_module_tests():
         #             print('found %s in %s' % ( grep, r))
         return do_ignore
 
-    Res = namedtuple('Res', 'x es en')
-    results = OrderedDict()
-    all_tests_regular = list(ComptestsRegistrar.regular)
-    seen = []
-    for x in reversed(all_tests_regular):
-        function = x['function']
-        name = function.__name__
-        if function.__module__ != '__main__':
-            # logger.debug('not running test %s' % name)
-            continue
-
-        seen.append(name)
-
+    tasks = get_regular_tasks()
+    if nprocesses is not None:
+        tasks.extend(get_objects_tasks())
+    seen = [task[0] for task in tasks]
+    for name in seen:
         if should_ignore(name):
             logger.debug('Ignoring test %s' % name)
-            continue
-
-        logger.debug('Running test %s' % name)
-
-        try:
-            wrapped = WrapTest(function, prefix=None)
-            wrapped(*x['args'], **x['kwargs'])
-            r = Res(x=x, es=None, en=None)
+    tasks = [task for task in tasks if not should_ignore(task[0])]
 
-        except BaseException as e2:
-            es = traceback.format_exc()
-            r = Res(x=x, es=es, en=type(e2).__name__)
-
-        results[name] = r
+    results = run_tasks(tasks, nprocesses)
 
     nerrors = 0
     msg = ""
@@ -797,3 +1303,7 @@ def run_module_tests():
         logger.info('run_module_tests: run these tests successfully: %s' % l)
     else:
         sys.exit(1)
+
+
+# its name matches the pattern of nose, but it is not a test
+run_module_tests.__test__ = False
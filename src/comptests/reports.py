@@ -9,6 +9,7 @@ from compmake.jobs.storage import get_job_cache, get_job_userobject
 from compmake.structures import Cache
 from reprep import Report
 
+from .batches import CellOutcome, is_batch_job
 from .results import PartiallySkipped, Skipped
 
 __all__ = [
@@ -18,8 +19,11 @@ __all__ = [
 ]
 
 
-@contract(results='dict(str:*)')
-def report_results_single(func, objspec_name, results):
+@contract(results='dict(str:*)', excluded='None|dict(str:str)')
+def report_results_single(func, objspec_name, results, excluded=None):
+    """ excluded: id_object -> reason why the test was not run """
+    if excluded is None:
+        excluded = {}
 
     def get_string_result(res):
         if res is None:
@@ -35,26 +39,51 @@ def report_results_single(func, objspec_name, results):
         return s
 
     r = Report()
-    if not results:
+    if not results and not excluded:
         r.text('warning', 'no test objects defined')
         return r
 
     rows = []
     data = []
-    for id_object, res in list(results.items()):
+    for id_object in sorted(set(results) | set(excluded)):
         rows.append(id_object)
-
-        data.append([get_string_result(res)])
+        if id_object in results:
+            data.append([get_string_result(results[id_object])])
+        else:
+            data.append([excluded[id_object]])
 
     r.table('summary', rows=rows, data=data)
     return r
 
 
-@contract(results='dict(tuple(str,str):*)')
-def report_results_pairs(func, objspec1_name, objspec2_name, results):
+def mirrored(cells):
+    """ Adds (b, a) -> value for each (a, b) -> value (for symmetric tests). """
+    res = dict(((b, a), value) for (a, b), value in cells.items())
+    res.update(cells)
+    return res
+
+
+@contract(results='dict(tuple(str,str):*)', excluded='None|dict(tuple(str,str):str)',
+          symmetric=bool)
+def report_results_pairs(func, objspec1_name, objspec2_name, results, excluded=None,
+                         symmetric=False):
+    """
+        excluded: (id_object1, id_object2) -> reason why the test was not run
+        symmetric: only one of (a, b) and (b, a) was run; show both.
+    """
+    if excluded is None:
+        excluded = {}
+    if symmetric:
+        results = mirrored(results)
+        excluded = mirrored(excluded)
     reason2symbol = {}
 
     def get_string_result(res):
+        if isinstance(res, CellOutcome):
+            if res.failed():
+                return 'FAIL'
+            res = res.result
+
         if res is None:
             s = 'ok'
         elif isinstance(res, Skipped):
@@ -73,18 +102,22 @@ def report_results_pairs(func, objspec1_name, objspec2_name, results):
         return s
 
     r = Report()
-    if not results:
+    if not results and not excluded:
         r.text('warning', 'no test objects defined')
         return r
 
-    rows = sorted(set([a for a, _ in results]))
-    cols = sorted(set([b for _, b in results]))
+    cells = set(results) | set(excluded)
+    rows = sorted(set([a for a, _ in cells]))
+    cols = sorted(set([b for _, b in cells]))
     data = [[None for a in range(len(cols))] for b in range(len(rows))]
     # a nice bug: data = [[None * len(cols)] * len(rows)
 
     for ((i, id_object1), (j, id_object2)) in itertools.product(enumerate(rows), enumerate(cols)):
-        res = results[(id_object1, id_object2)]
-        data[i][j] = get_string_result(res)
+        key = (id_object1, id_object2)
+        if key in results:
+            data[i][j] = get_string_result(results[key])
+        else:
+            data[i][j] = excluded.get(key, ' ')
 
     r.table('summary', rows=rows, data=data, cols=cols)
 
@@ -96,12 +129,28 @@ def report_results_pairs(func, objspec1_name, objspec2_name, results):
     return r
 
 
-@contract(jobs='dict(tuple(str,str):str)')
-def report_results_pairs_jobs(context, func, objspec1_name, objspec2_name, jobs):
+@contract(jobs='dict(tuple(str,str):str)', excluded='None|dict(tuple(str,str):str)',
+          symmetric=bool)
+def report_results_pairs_jobs(context, func, objspec1_name, objspec2_name, jobs,
+                              excluded=None, symmetric=False):
     """ This version gets the jobs ID """
+    if excluded is None:
+        excluded = {}
+    if symmetric:
+        excluded = mirrored(excluded)
+        # the key of the cell in the batch results
+        cell_keys = mirrored(dict((k, k) for k in jobs))
+        jobs = mirrored(jobs)
+    else:
+        cell_keys = dict((k, k) for k in jobs)
     reason2symbol = {}
 
     def get_string_result(res):
+        if isinstance(res, CellOutcome):
+            if res.failed():
+                return 'FAIL'
+            res = res.result
+
         if res is None:
             s = 'ok'
         elif isinstance(res, Skipped):
@@ -120,24 +169,34 @@ def report_results_pairs_jobs(context, func, objspec1_name, objspec2_name, jobs)
         return s
 
     r = Report()
-    if not jobs:
+    if not jobs and not excluded:
         r.text('warning', 'no test objects defined')
         return r
 
-    rows = sorted(set([a for a, _ in jobs]))
-    cols = sorted(set([b for _, b in jobs]))
+    cells = set(jobs) | set(excluded)
+    rows = sorted(set([a for a, _ in cells]))
+    cols = sorted(set([b for _, b in cells]))
     data = [[None for a in range(len(cols))] for b in range(len(rows))]
     # a nice bug: data = [[None * len(cols)] * len(rows)
 
-    db = context.get_compmake_db()
+    db = context.cc.get_compmake_db()
+    # batch jobs are shared by many cells
+    userobjects = {}
 
     comb = itertools.product(enumerate(rows), enumerate(cols))
     for ((i, id_object1), (j, id_object2)) in comb:
+        if not (id_object1, id_object2) in jobs:
+            data[i][j] = excluded.get((id_object1, id_object2), ' ')
+            continue
         job_id = jobs[(id_object1, id_object2)]
         cache = get_job_cache(job_id, db)
 
         if cache.state == Cache.DONE:
-            res = get_job_userobject(job_id, db)
+            if not job_id in userobjects:
+                userobjects[job_id] = get_job_userobject(job_id, db)
+            res = userobjects[job_id]
+            if is_batch_job(job_id):
+                res = res[cell_keys[(id_object1, id_object2)]]
             s = get_string_result(res)
         elif cache.state == Cache.FAILED:
             s = 'FAIL'
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+import multiprocessing
+import traceback
+from collections import namedtuple, OrderedDict
+
+from conf_tools.utils import expand_string
+
+from . import logger
+from .registrar import ComptestsRegistrar, WrapTest
+from .selection import filter_sampled, is_compatible, is_upper_triangle
+
+__all__ = []
+
+# es: the backtrace, en: the name of the exception (None if passed)
+Res = namedtuple('Res', 'es en')
+
+
+class LocalRunner(object):
+    """ Static storage """
+    # list of (name, function, args, kwargs). The worker processes find
+    # it here (together with the objects) because they are forked after
+    # it is set.
+    tasks = []
+
+
+def parse_runner_args(args):
+    """ Returns grep, nprocesses from the arguments of run_module_tests(). """
+    grep = None
+    nprocesses = None
+    args = list(args)
+    while args:
+        a = args.pop(0)
+        if a == '-j':
+            if not args:
+                raise ValueError('Option -j requires the number of processes.')
+            nprocesses = int(args.pop(0))
+        elif a.startswith('-j'):
+            nprocesses = int(a[2:])
+        else:
+            grep = a
+    if nprocesses is not None and nprocesses < 1:
+        raise ValueError('Invalid number of processes %d.' % nprocesses)
+    return grep, nprocesses
+
+
+def is_local(function):
+    return function.__module__ == '__main__'
+
+
+def get_regular_tasks():
+    """ The tests registered with @comptest in the __main__ module. """
+    tasks = []
+    for x in reversed(ComptestsRegistrar.regular):
+        if is_local(x.function):
+            tasks.append((x.function.__name__, x.function, x.args, x.kwargs))
+    return tasks
+
+
+def get_objects_tasks():
+    """
+        The tests on objects (comptests_for_all and similar)
+        in the __main__ module, one for each object or pair of objects.
+
+        The objects are instanced here, once for all the tests.
+    """
+    R = ComptestsRegistrar
+    instances = {}
+    tasks = []
+
+    def get_ob(objspec, id_object):
+        key = (objspec.name, id_object)
+        if not key in instances:
+            instances[key] = instance_local(objspec, id_object)
+        return instances[key]
+
+    def add_single(objspec, x, objects):
+        f = x['function']
+        for id_object in objects:
+            name = '%s-%s' % (f.__name__, id_object)
+            tasks.append(make_task(name, f, [(id_object, get_ob(objspec, id_object))]))
+
+    def add_pairs(objspec1, objspec2, x, objects1, objects2):
+        f = x['function']
+        compatible = x.get('compatible', None)
+        symmetric = x.get('symmetric', False)
+        diagonal = x.get('diagonal', True)
+        combinations = []
+        for id_ob1 in objects1:
+            for id_ob2 in objects2:
+                if symmetric and not is_upper_triangle(id_ob1, id_ob2, diagonal):
+                    continue
+                if not is_compatible(compatible, objspec1, id_ob1, objspec2, id_ob2):
+                    continue
+                combinations.append((None, id_ob1, id_ob2))
+        combinations, _ = filter_sampled(combinations, x.get('sampling', None))
+        for _, id_ob1, id_ob2 in combinations:
+            name = '%s-%s-%s' % (f.__name__, id_ob1, id_ob2)
+            obs = [(id_ob1, get_ob(objspec1, id_ob1)),
+                   (id_ob2, get_ob(objspec2, id_ob2))]
+            tasks.append(make_task(name, f, obs))
+
+    for objspec_name in sorted(R.objspecs):
+        objspec = R.objspecs[objspec_name]
+        objspec.master.load()
+        universe = sorted(objspec.keys())
+
+        for x in local_tests(R.objspec2tests[objspec_name]):
+            add_single(objspec, x, universe)
+
+        for x in local_tests(R.objspec2testsome[objspec_name]):
+            add_single(objspec, x, expand_string(x['which'], universe))
+
+        for x in local_tests(R.objspec2pairs[objspec_name]):
+            objspec2 = x['objspec2']
+            objspec2.master.load()
+            add_pairs(objspec, objspec2, x, universe, sorted(objspec2.keys()))
+
+        for x in local_tests(R.objspec2testsomepairs[objspec_name]):
+            objspec2 = x['objspec2']
+            objspec2.master.load()
+            objects1 = expand_string(x['which1'], universe)
+            objects2 = expand_string(x['which2'], sorted(objspec2.keys()))
+            add_pairs(objspec, objspec2, x, objects1, objects2)
+
+    return tasks
+
+
+def local_tests(tests):
+    """ Filters the tests defined in __main__; dynamic tests need compmake. """
+    res = []
+    for x in tests:
+        f = x['function']
+        if not is_local(f):
+            continue
+        if x['dynamic']:
+            logger.info('Skipping dynamic test %s.' % f.__name__)
+            continue
+        res.append(x)
+    return res
+
+
+class InstanceError(object):
+    """ Remembers that we could not instance the object. """
+
+    def __init__(self, id_object, backtrace):
+        self.id_object = id_object
+        self.backtrace = backtrace
+
+
+def instance_local(objspec, id_object):
+    try:
+        if objspec.instance_method is None:
+            return objspec[id_object]
+        else:
+            return objspec.instance(id_object)
+    except Exception:
+        return InstanceError(id_object, traceback.format_exc())
+
+
+def make_task(name, function, obs):
+    """ obs: list of (id_object, object or InstanceError) """
+    args = []
+    for id_object, ob in obs:
+        if isinstance(ob, InstanceError):
+            return (name, fail_instance, (ob,), {})
+        args.extend([id_object, ob])
+    return (name, function, tuple(args), {})
+
+
+def fail_instance(error):
+    msg = 'Could not instance object %r:\n%s' % (error.id_object, error.backtrace)
+    raise Exception(msg)
+
+
+def run_task(i):
+    name, function, args, kwargs = LocalRunner.tasks[i]
+    logger.debug('Running test %s' % name)
+    try:
+        wrapped = WrapTest(function, prefix=None)
+        wrapped(*args, **kwargs)
+        return Res(es=None, en=None)
+    except BaseException as e:
+        return Res(es=traceback.format_exc(), en=type(e).__name__)
+
+
+def run_tasks(tasks, nprocesses=None):
+    """
+        Runs the tasks, in nprocesses forked processes if given.
+        Returns an OrderedDict name -> Res.
+    """
+    LocalRunner.tasks = tasks
+    indices = list(range(len(tasks)))
+    pool = None
+    if nprocesses is not None and len(tasks) > 1:
+        pool = get_pool(nprocesses)
+
+    if pool is None:
+        results = [run_task(i) for i in indices]
+    else:
+        try:
+            results = pool.map(run_task, indices, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+
+    return OrderedDict((task[0], r) for task, r in zip(tasks, results))
+
+
+def get_pool(nprocesses):
+    # the tasks and the objects are passed to the workers by forking
+    if hasattr(multiprocessing, 'get_context'):
+        try:
+            context = multiprocessing.get_context('fork')
+        except ValueError:
+            logger.warning('Cannot fork: running the tests serially.')
+            return None
+        return context.Pool(nprocesses)
+    return multiprocessing.Pool(nprocesses)
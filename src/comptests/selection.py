@@ -0,0 +1,274 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import json
+import random
+import re
+
+from contracts import contract
+
+from . import logger
+from .fingerprints import comptest_identity
+from .impact import is_affected
+from .incremental import is_unchanged
+
+__all__ = [
+    'parse_shard',
+]
+
+# What the reports show for the pairs rejected by the predicate
+# given to comptests_for_all_pairs() and comptests_for_some_pairs().
+NOT_APPLICABLE = 'n/a'
+# What the reports show for the pairs left out by sampling.
+NOT_SAMPLED = 'not run'
+
+
+class Selection(object):
+    """ Static storage """
+    # (index, total) if we are running only one shard of the tests.
+    # This is set by CompTests (--shard).
+    shard = None
+    # JSON file identity -> duration (seconds) used to balance the shards,
+    # the same for all the machines; None means that the tests are assigned
+    # by hash. This is set by CompTests (--shard_durations).
+    durations = None
+    # identity -> shard, computed on first use from the durations
+    assignment = None
+    # whether we warned about the tests that are not in the durations
+    warned = False
+    # If True, the pair tests are run on all pairs even if they
+    # ask for sampling. This is set by CompTests (--full_pairs).
+    full_pairs = False
+
+
+@contract(s=str, returns='tuple(int,int)')
+def parse_shard(s):
+    """ Parses a string "i/N" (with 0 <= i < N) describing a shard. """
+    m = re.match(r'^(\d+)/(\d+)$', s.strip())
+    if m is None:
+        msg = 'Invalid shard %r: expected "i/N", such as "0/4".' % s
+        raise ValueError(msg)
+    index, total = int(m.group(1)), int(m.group(2))
+    if not (0 <= index < total):
+        msg = 'Invalid shard %r: expected 0 <= i < N.' % s
+        raise ValueError(msg)
+    return index, total
+
+
+@contract(total='int,>=1')
+def set_shard(index, total, durations=None):
+    """ durations: JSON file identity -> seconds (see get_shard_assignment()). """
+    Selection.shard = (index, total)
+    Selection.durations = durations
+    Selection.assignment = None
+    Selection.warned = False
+
+
+@contract(durations='dict(str:float)', total='int,>=1', returns='dict(str:int)')
+def balance_shards(durations, total):
+    """
+        Assigns the tests to the shards so that the shards take about the
+        same time: the longest tests first, each to the shard with the
+        least load so far (LPT).
+    """
+    load = [0.0] * total
+    assignment = {}
+    for identity in sorted(durations, key=lambda k: (-durations[k], k)):
+        i = load.index(min(load))
+        assignment[identity] = i
+        load[i] += durations[identity]
+    return assignment
+
+
+@contract(identity=str, total='int,>=1', returns='int')
+def hash_shard(identity, total):
+    """ Shard for a test without timing information. """
+    h = hashlib.md5(identity.encode('utf-8')).hexdigest()
+    return int(h, 16) % total
+
+
+@contract(returns='dict(str:float)')
+def read_durations(filename):
+    """ Reads a JSON file identity -> seconds (see comptests-stats --show durations). """
+    try:
+        with open(filename) as f:
+            durations = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+        msg = 'Could not read the durations from %s: %s' % (filename, e)
+        raise ValueError(msg)
+    return dict((str(k), float(v)) for k, v in durations.items())
+
+
+def get_shard_assignment():
+    """
+        The assignment identity -> shard of the tests in the durations file.
+
+        It depends only on that file (not on the timing DB of this machine),
+        so that all the machines compute the same partition.
+    """
+    if Selection.assignment is None:
+        _, total = Selection.shard
+        durations = {}
+        if Selection.durations is not None:
+            durations = read_durations(Selection.durations)
+        Selection.assignment = balance_shards(durations, total)
+        logger.info('Sharding: %d tests with known durations.' % len(durations))
+    return Selection.assignment
+
+
+@contract(identity=str, returns=bool)
+def in_this_shard(identity):
+    """ True if the test is in the shard we are running (or if we run all tests). """
+    if Selection.shard is None:
+        return True
+    index, total = Selection.shard
+    assignment = get_shard_assignment()
+    if identity in assignment:
+        return assignment[identity] == index
+    if assignment and not Selection.warned:
+        Selection.warned = True
+        logger.warning('Some tests (such as %s) are not in %s: they are assigned '
+                       'to the shards by hash.' % (identity, Selection.durations))
+    return hash_shard(identity, total) == index
+
+
+def get_skip_reason(function, id_objects, token, dynamic, config_files=()):
+    """
+        Returns the reason why the test should not be defined
+        in this run (to show in the reports), or None.
+
+        token: the token of incremental_token()
+        config_files: the configuration files of the objects
+    """
+    identity = comptest_identity(function, *id_objects)
+    if not in_this_shard(identity):
+        return 'other shard'
+    if dynamic:
+        return None
+    if is_unchanged(token):
+        return 'unchanged'
+    if not is_affected(identity, config_files):
+        return 'not affected'
+    return None
+
+
+@contract(id_object=str, returns='list(str)')
+def get_config_files(objspec, id_object):
+    """
+        Returns the configuration files that define the object
+        (all the files of the objspec if we cannot tell which one).
+    """
+    entry2file = objspec.entry2file
+    if id_object in entry2file:
+        return [entry2file[id_object]]
+    return sorted(set(entry2file.values()))
+
+
+def is_compatible(compatible, objspec1, id_ob1, objspec2, id_ob2):
+    """
+        True if the pair test should be defined for the two objects.
+
+        compatible: None, or a function (id_ob1, spec1, id_ob2, spec2) -> bool,
+        called with the specs of the objects (not the instances).
+    """
+    if compatible is None:
+        return True
+    return bool(compatible(id_ob1, objspec1[id_ob1], id_ob2, objspec2[id_ob2]))
+
+
+def filter_compatible(combinations, objspec1, objspec2, compatible):
+    """
+        Returns the combinations (context, id_ob1, id_ob2) accepted by
+        the predicate, and a dict (id_ob1, id_ob2) -> NOT_APPLICABLE
+        for the others.
+    """
+    accepted = []
+    excluded = {}
+    for c, id_ob1, id_ob2 in combinations:
+        if is_compatible(compatible, objspec1, id_ob1, objspec2, id_ob2):
+            accepted.append((c, id_ob1, id_ob2))
+        else:
+            excluded[(id_ob1, id_ob2)] = NOT_APPLICABLE
+    return accepted, excluded
+
+
+@contract(id_ob1=str, id_ob2=str, diagonal=bool, returns=bool)
+def is_upper_triangle(id_ob1, id_ob2, diagonal):
+    """ True if a symmetric pair test is defined for (id_ob1, id_ob2). """
+    if id_ob1 == id_ob2:
+        return diagonal
+    return id_ob1 < id_ob2
+
+
+@contract(cells='list(tuple(str,str))', sample='None|int,>=1', cover='None|int,>=1',
+          returns='set(tuple(str,str))')
+def sample_cells(cells, sample=None, cover=None, seed=0):
+    """
+        Chooses a subset of the cells (id_ob1, id_ob2) of a pair test.
+
+        cover: each object (as first and as second element) appears in
+        at least this many chosen cells (or in all its cells, if fewer).
+        sample: then random cells are added until there are this many.
+
+        The choice depends only on the cells and on the seed.
+    """
+    order = sorted(cells)
+    random.Random(seed).shuffle(order)
+    chosen = set()
+    if cover is not None:
+        count1 = {}
+        count2 = {}
+        for a, b in order:
+            if count1.get(a, 0) < cover or count2.get(b, 0) < cover:
+                chosen.add((a, b))
+                count1[a] = count1.get(a, 0) + 1
+                count2[b] = count2.get(b, 0) + 1
+    if sample is not None:
+        for cell in order:
+            if len(chosen) >= sample:
+                break
+            chosen.add(cell)
+    return chosen
+
+
+def filter_sampled(combinations, sampling):
+    """
+        Returns the combinations (context, id_ob1, id_ob2) chosen by
+        sample_cells(), and a dict (id_ob1, id_ob2) -> NOT_SAMPLED for
+        the others. All are chosen if we run all pairs (--full_pairs).
+
+        sampling: None, or dict with the arguments of sample_cells()
+    """
+    combinations = list(combinations)
+    if sampling is None or Selection.full_pairs:
+        return combinations, {}
+    cells = [(id_ob1, id_ob2) for _, id_ob1, id_ob2 in combinations]
+    chosen = sample_cells(cells, **sampling)
+    accepted = []
+    excluded = {}
+    for c, id_ob1, id_ob2 in combinations:
+        if (id_ob1, id_ob2) in chosen:
+            accepted.append((c, id_ob1, id_ob2))
+        else:
+            excluded[(id_ob1, id_ob2)] = NOT_SAMPLED
+    return accepted, excluded
+
+
+def get_pair_cells(objspec1, objspec2, objs1, objs2, symmetric=False, diagonal=True,
+                   compatible=None, sampling=None):
+    """
+        Returns the cells (id_ob1, id_ob2) for which the pair test is
+        defined, as define_tests_pairs() chooses them, without the contexts.
+    """
+    combinations = [(None, id_ob1, id_ob2) for id_ob1 in objs1 for id_ob2 in objs2
+                    if not symmetric or is_upper_triangle(id_ob1, id_ob2, diagonal)]
+    combinations, _ = filter_compatible(combinations, objspec1, objspec2, compatible)
+    combinations, _ = filter_sampled(combinations, sampling)
+    return [(id_ob1, id_ob2) for _, id_ob1, id_ob2 in combinations]
+
+
+@contract(sample='None|int,>=1', cover='None|int,>=1', seed=int)
+def get_sampling(sample=None, cover=None, seed=0):
+    """ Returns the sampling argument of filter_sampled(). """
+    if sample is None and cover is None:
+        return None
+    return dict(sample=sample, cover=cover, seed=seed)
@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import os
+import sqlite3
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from . import logger
+
+__all__ = []
+
+
+class StateDBs(object):
+    """ Static storage """
+    # the SQLite files whose schema was already created by this process
+    # (or by the master process that forked it)
+    created = set()
+    # filename -> (schema statements, list of (sql, args)) to write at
+    # the end of the job (see deferred_writes())
+    pending = OrderedDict()
+    # how many deferred_writes() blocks we are in
+    depth = 0
+
+
+def connect_state_db(filename, *statements):
+    """
+        Opens the SQLite file in the state directory. The first time in
+        this process, it creates the directory if needed, switches the
+        file to WAL mode (so that the workers can write while others read)
+        and executes the statements (usually CREATE TABLE IF NOT EXISTS ...).
+    """
+    if filename in StateDBs.created:
+        return sqlite3.connect(filename, timeout=60)
+    dirname = os.path.dirname(filename)
+    if dirname and not os.path.exists(dirname):
+        try:
+            os.makedirs(dirname)
+        except OSError:  # created by another worker
+            pass
+    conn = sqlite3.connect(filename, timeout=60)
+    conn.execute('PRAGMA journal_mode=WAL')
+    with conn:
+        for statement in statements:
+            conn.execute(statement)
+    StateDBs.created.add(filename)
+    return conn
+
+
+def write_state(filename, statements, sql, args):
+    """
+        Executes sql with args in the SQLite file (statements is its schema,
+        see connect_state_db()). Inside deferred_writes(), the writes are
+        done all together at the end.
+    """
+    if StateDBs.depth > 0:
+        _, rows = StateDBs.pending.setdefault(filename, (statements, []))
+        rows.append((sql, args))
+        return
+    conn = connect_state_db(filename, *statements)
+    try:
+        with conn:
+            conn.execute(sql, args)
+    finally:
+        conn.close()
+
+
+@contextmanager
+def deferred_writes():
+    """
+        The records written by the tests in this block (timing, footprints,
+        successes) are written at the end, in one transaction per file.
+        Used by the jobs, so that each job writes once.
+    """
+    StateDBs.depth += 1
+    try:
+        yield
+    finally:
+        StateDBs.depth -= 1
+        if StateDBs.depth == 0:
+            flush_writes()
+
+
+def flush_writes():
+    pending = StateDBs.pending
+    StateDBs.pending = OrderedDict()
+    for filename, (statements, rows) in pending.items():
+        try:
+            conn = connect_state_db(filename, *statements)
+            try:
+                with conn:
+                    for sql, args in rows:
+                        conn.execute(sql, args)
+            finally:
+                conn.close()
+        except sqlite3.Error as e:
+            logger.warning('Could not write %d records in %s: %s' % (len(rows), filename, e))
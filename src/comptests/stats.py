@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import time
+
+from quickapp import QuickAppBase
+
+from .timing import get_timing_store
+
+__all__ = [
+    'CompTestsStats',
+    'comptests_stats_main',
+]
+
+
+class CompTestsStats(QuickAppBase):
+    """
+        Shows the statistics of the tests recorded by comptests:
+        the slowest tests, the trend of a test over the runs and
+        the tests whose duration varies the most.
+    """
+
+    cmd = 'comptests-stats'
+
+    def define_program_options(self, params):
+        params.add_string('state', default='out-comptests-state',
+                          help='State directory of comptests')
+        params.add_string_choice('show', ['slowest', 'trend', 'variance', 'durations'],
+                                 default='slowest', help='What to show')
+        params.add_string('test', default=None,
+                          help='Test identity (module:function:ids) for --show trend')
+        params.add_int('n', default=20, help='Number of tests to show')
+
+    def go(self):
+        options = self.get_options()
+        filename = os.path.join(options.state, 'timing.sqlite')
+        if not os.path.exists(filename):
+            self.error('Could not find timing data in %s' % filename)
+            return 1
+        store = get_timing_store(filename)
+
+        if options.show == 'slowest':
+            print('%-60s %5s %10s %10s %10s' % ('test', 'runs', 'wall (s)', 'cpu (s)',
+                                                'RSS growth'))
+            for identity, runs, walltime, cputime, rss_growth in store.slowest(options.n):
+                print('%-60s %5d %10.3f %10.3f %10s' % (identity, runs, walltime, cputime,
+                                                        format_bytes(rss_growth)))
+
+        elif options.show == 'variance':
+            print('%-60s %5s %10s %10s' % ('test', 'runs', 'wall (s)', 'std (s)'))
+            for identity, runs, walltime, std in store.variance(options.n):
+                print('%-60s %5d %10.3f %10.3f' % (identity, runs, walltime, std))
+
+        elif options.show == 'durations':
+            # the input of comptests --shard_durations
+            print(json.dumps(store.get_durations(), indent=1, sort_keys=True))
+
+        elif options.show == 'trend':
+            if options.test is None:
+                self.error('Please specify the test with --test.')
+                return 2
+            rows = store.trend(options.test)
+            if not rows:
+                self.error('No data for test %r.' % options.test)
+                return 1
+            print('%-20s %10s %10s %10s %8s' % ('date', 'wall (s)', 'cpu (s)', 'RSS growth',
+                                                 'outcome'))
+            for timestamp, walltime, cputime, rss_growth, outcome in rows:
+                date = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp))
+                print('%-20s %10.3f %10.3f %10s %8s' % (date, walltime, cputime,
+                                                       format_bytes(rss_growth), outcome))
+
+
+def format_bytes(n):
+    if n is None:
+        return '-'
+    return '%.1f MB' % (n / (1024.0 * 1024))
+
+
+comptests_stats_main = CompTestsStats.get_sys_main()
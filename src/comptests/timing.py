@@ -0,0 +1,196 @@
+# -*- coding: utf-8 -*-
+import sqlite3
+import sys
+import time
+
+from contracts import contract
+
+from . import logger
+from .state import connect_state_db, write_state
+
+__all__ = [
+    'TimingStore',
+    'get_timing_store',
+]
+
+
+def get_cputime():
+    # time.clock() is gone in Python 3.8
+    return time.process_time() if hasattr(time, 'process_time') else time.clock()
+
+
+def get_peak_rss():
+    """ Returns the peak RSS of this process in bytes, or None if not available. """
+    try:
+        import resource
+    except ImportError:  # Windows
+        return None
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on OS X, kilobytes on Linux
+    if sys.platform == 'darwin':
+        return maxrss
+    return maxrss * 1024
+
+
+def get_rss_growth(peak_rss0):
+    """
+        How much the peak RSS of this process grew since it was peak_rss0
+        (0 if it did not grow), or None if not available.
+    """
+    peak_rss = get_peak_rss()
+    if peak_rss is None or peak_rss0 is None:
+        return None
+    return max(0, peak_rss - peak_rss0)
+
+
+def get_current_job_id():
+    try:
+        from compmake.jobs.job_execution import JobCompute
+    except ImportError:
+        return None
+    return JobCompute.current_job_id
+
+
+class TimingStore(object):
+    """
+        Keeps the wall time, CPU time, RSS growth and outcome of each
+        execution of the tests, across runs.
+
+        The tests are identified by comptest_identity(): module, function
+        and the ids of the objects they use. The RSS growth is how much the
+        peak RSS of the worker process grew during the test; it is 0 if the
+        test did not need more memory than an earlier one in the same worker.
+    """
+
+    schema = ('CREATE TABLE IF NOT EXISTS runs ('
+              'identity TEXT, job_id TEXT, timestamp REAL, '
+              'walltime REAL, cputime REAL, rss_growth INTEGER, '
+              'outcome TEXT)',
+              'CREATE INDEX IF NOT EXISTS runs_identity '
+              'ON runs (identity)')
+
+    def __init__(self, filename):
+        self.filename = filename
+
+    def _connect(self):
+        return connect_state_db(self.filename, *self.schema)
+
+    def create(self):
+        """ Creates the DB (in the master, before the workers use it). """
+        self._connect().close()
+
+    def _query(self, sql, args=()):
+        conn = self._connect()
+        try:
+            return list(conn.execute(sql, args))
+        finally:
+            conn.close()
+
+    @contract(identity=str, walltime='float', cputime='float', outcome=str)
+    def record(self, identity, job_id, walltime, cputime, rss_growth, outcome):
+        write_state(self.filename, self.schema,
+                    'INSERT INTO runs VALUES (?, ?, ?, ?, ?, ?, ?)',
+                    (identity, job_id, time.time(), walltime, cputime,
+                     rss_growth, outcome))
+
+    @contract(n='int,>=1', returns='list(tuple)')
+    def slowest(self, n=20):
+        """
+            Returns the n tests with the largest mean wall time, as tuples
+            (identity, runs, mean walltime, mean cputime, max RSS growth).
+        """
+        return self._query('SELECT identity, COUNT(*), AVG(walltime), AVG(cputime), '
+                           'MAX(rss_growth) FROM runs GROUP BY identity '
+                           'ORDER BY AVG(walltime) DESC LIMIT ?', (n,))
+
+    @contract(identity=str, returns='list(tuple)')
+    def trend(self, identity):
+        """
+            Returns the executions of the test, oldest first, as tuples
+            (timestamp, walltime, cputime, RSS growth, outcome).
+        """
+        return self._query('SELECT timestamp, walltime, cputime, rss_growth, outcome '
+                           'FROM runs WHERE identity = ? ORDER BY timestamp',
+                           (identity,))
+
+    @contract(n='int,>=1', returns='list(tuple)')
+    def variance(self, n=20):
+        """
+            Returns the n tests whose wall time varies the most, as tuples
+            (identity, runs, mean walltime, standard deviation).
+        """
+        rows = self._query('SELECT identity, COUNT(*), AVG(walltime), '
+                           'AVG(walltime * walltime) - AVG(walltime) * AVG(walltime) '
+                           'FROM runs GROUP BY identity HAVING COUNT(*) > 1')
+        res = [(identity, runs, mean, max(0.0, var) ** 0.5)
+               for identity, runs, mean, var in rows]
+        res.sort(key=lambda x: -x[3])
+        return res[:n]
+
+    @contract(returns='dict(str:float)')
+    def get_durations(self):
+        """ Returns the mean wall time of each test (identity -> seconds). """
+        rows = self._query('SELECT identity, AVG(walltime) FROM runs GROUP BY identity')
+        return dict(rows)
+
+    @contract(returns='dict(str:float)')
+    def get_job_durations(self):
+        """
+            Returns the expected wall time of each job (job_id -> seconds):
+            the sum of the mean wall time of the tests that it ran.
+        """
+        rows = self._query('SELECT job_id, SUM(walltime) FROM '
+                           '(SELECT job_id, identity, AVG(walltime) AS walltime '
+                           'FROM runs WHERE job_id IS NOT NULL GROUP BY job_id, identity) '
+                           'GROUP BY job_id')
+        return dict(rows)
+
+
+class Timing(object):
+    """ Static storage """
+    # SQLite file; None means that the timing is not recorded.
+    # This is set by CompTests.
+    filename = None
+
+
+def get_timing_store(filename):
+    return TimingStore(filename)
+
+
+def record_timing(timing, identity, walltime, cputime, outcome, job_id=None,
+                  peak_rss0=None):
+    """
+        Records the execution of a test in the timing DB (if timing is not None).
+
+        peak_rss0 is the peak RSS (see get_peak_rss()) when the test started.
+    """
+    if timing is None:
+        return
+    if job_id is None:
+        job_id = get_current_job_id()
+    try:
+        get_timing_store(timing).record(identity, job_id, walltime, cputime,
+                                        get_rss_growth(peak_rss0), outcome)
+    except sqlite3.Error as e:
+        logger.warning('Could not record timing of %s: %s' % (identity, e))
+
+
+def run_timed(timing, identity, function, *args, **kwargs):
+    """
+        Calls function(*args, **kwargs), recording its execution in the
+        timing DB ``timing`` (if not None).
+    """
+    if timing is None:
+        return function(*args, **kwargs)
+    t0 = time.time()
+    c0 = get_cputime()
+    r0 = get_peak_rss()
+    try:
+        res = function(*args, **kwargs)
+    except BaseException:
+        record_timing(timing, identity, time.time() - t0, get_cputime() - c0, 'failed',
+                      peak_rss0=r0)
+        raise
+    record_timing(timing, identity, time.time() - t0, get_cputime() - c0, 'ok',
+                  peak_rss0=r0)
+    return res
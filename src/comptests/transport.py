@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import hashlib
+import io
+import os
+import pickle
+
+from contracts import contract
+
+from . import logger
+
+__all__ = [
+    'MappedObject',
+    'map_arrays',
+    'unmap_arrays',
+]
+
+
+class Transport(object):
+    """ Static storage """
+    # Directory where the big arrays of the test objects are written;
+    # None means that they are pickled as usual.
+    # This is set by CompTests (--mmap_arrays).
+    dirname = None
+    # The arrays smaller than this are pickled together with the object.
+    min_bytes = 1024 * 1024
+
+
+class MappedObject(object):
+    """
+        A test object pickled without its big NumPy arrays, which are
+        stored in separate .npy files.
+
+        When loaded, the arrays are memory-mapped copy-on-write: the
+        processes using the object share the pages of the files, and a
+        test that modifies an array modifies only its own copy.
+    """
+
+    def __init__(self, data, filenames):
+        # the pickle of the object
+        self.data = data
+        # the .npy files of the arrays
+        self.filenames = filenames
+
+    def load(self):
+        unpickler = ArraysUnpickler(io.BytesIO(self.data))
+        return unpickler.load()
+
+    def __repr__(self):
+        return 'MappedObject(%d bytes, %d arrays)' % (len(self.data), len(self.filenames))
+
+
+class ArraysPickler(pickle.Pickler):
+    """ Pickler that writes the big arrays to .npy files in dirname. """
+
+    def __init__(self, f, dirname, min_bytes):
+        pickle.Pickler.__init__(self, f, pickle.HIGHEST_PROTOCOL)
+        self.dirname = dirname
+        self.min_bytes = min_bytes
+        self.filenames = []
+
+    def persistent_id(self, obj):
+        if not is_mappable_array(obj, self.min_bytes):
+            return None
+        filename = write_array(self.dirname, obj)
+        self.filenames.append(filename)
+        return ('npy', filename)
+
+
+class ArraysUnpickler(pickle.Unpickler):
+
+    def persistent_load(self, pid):
+        kind, filename = pid
+        if kind != 'npy':
+            msg = 'Unknown persistent id %r.' % (pid,)
+            raise pickle.UnpicklingError(msg)
+        import numpy as np
+        return np.load(filename, mmap_mode='c')
+
+
+def is_mappable_array(obj, min_bytes):
+    try:
+        import numpy as np
+    except ImportError:
+        return False
+    # not the subclasses, which np.load() would not give back
+    return (type(obj) is np.ndarray and not obj.dtype.hasobject
+            and obj.nbytes >= min_bytes)
+
+
+def write_array(dirname, a):
+    """ Writes the array to dirname (once for each content); returns the filename. """
+    import numpy as np
+    h = hashlib.sha1()
+    h.update(str((a.dtype.str, a.shape)).encode('utf-8'))
+    h.update(np.ascontiguousarray(a).data)
+    filename = os.path.join(dirname, '%s.npy' % h.hexdigest())
+    if not os.path.exists(filename):
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        tmp = '%s.tmp%s' % (filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            np.save(f, a)
+        os.rename(tmp, filename)
+    return filename
+
+
+@contract(dirname='None|str')
+def map_arrays(ob, dirname):
+    """
+        Returns a MappedObject if ob contains big NumPy arrays,
+        writing them in dirname; otherwise returns ob.
+        If dirname is None, returns ob.
+    """
+    if dirname is None:
+        return ob
+    f = io.BytesIO()
+    pickler = ArraysPickler(f, dirname, Transport.min_bytes)
+    try:
+        pickler.dump(ob)
+    except Exception as e:
+        logger.warning('Could not write the arrays of %s separately: %s' %
+                       (type(ob).__name__, e))
+        return ob
+    if not pickler.filenames:
+        return ob
+    return MappedObject(f.getvalue(), pickler.filenames)
+
+
+def unmap_arrays(ob):
+    """ If ob is a MappedObject, returns the object it contains. """
+    if isinstance(ob, MappedObject):
+        return ob.load()
+    return ob
@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from comptests.batches import (check_batches, is_batch_job, run_pairs_batch,
+                               split_by_row, split_in_batches)
+from comptests.results import Skipped
+
+
+def check_pair(id_ob1, ob1, id_ob2, ob2):
+    if id_ob2 == 'b2':
+        raise ValueError('bad cell')
+    if id_ob1 == 'a2':
+        return Skipped('not meaningful')
+
+
+def test_batches_outcomes():
+    cells = [('t-a1-b1-f', 'a1', 'b1'),
+             ('t-a1-b2-f', 'a1', 'b2'),
+             ('t-a2-b1-f', 'a2', 'b1')]
+    batches = split_in_batches(cells, 2)
+    assert [len(b) for b in batches] == [2, 1]
+
+    objs1 = dict(a1=1, a2=2)
+    objs2 = dict(b1=1, b2=2)
+    outcomes = [run_pairs_batch(check_pair, b, objs1, objs2) for b in batches]
+
+    assert outcomes[0][('a1', 'b1')].result is None
+    assert outcomes[0][('a1', 'b2')].failed()
+    assert 'bad cell' in outcomes[0][('a1', 'b2')].backtrace
+    assert isinstance(outcomes[1][('a2', 'b1')].result, Skipped)
+
+    check_batches('check_pair', outcomes[1])
+    try:
+        check_batches('check_pair', *outcomes)
+    except Exception as e:
+        assert 't-a1-b2-f' in str(e)
+    else:
+        raise Exception('Expected failure')
+
+
+def test_split_by_row():
+    cells = [('t-a1-b1-f', 'a1', 'b1'),
+             ('t-a1-b2-f', 'a1', 'b2'),
+             ('t-a1-b3-f', 'a1', 'b3'),
+             ('t-a2-b1-f', 'a2', 'b1')]
+    assert [len(b) for b in split_by_row(cells)] == [3, 1]
+    assert [len(b) for b in split_by_row(cells, 2)] == [2, 1, 1]
+    for b in split_by_row(cells, 2):
+        assert len(set(id_ob1 for _, id_ob1, _ in b)) == 1
+
+
+def test_batch_job_ids():
+    assert is_batch_job('mod-class1-check-batch12')
+    assert not is_batch_job('mod-class1-check-batches')
+    assert not is_batch_job('mod-class1-check-a-b-f')
@@ -0,0 +1,54 @@
+# -*- coding: utf-8 -*-
+from comptests.budget import (FailureBudget, JOBS_NOT_RUN_KEY, get_jobs_not_run,
+                              get_manager_class, instance_some_jobs_with_budget)
+
+
+class FakeManager(object):
+
+    def __init__(self, failed):
+        self.failed = set(failed)
+        self.todo = set(['c'])
+        self.ready_todo = set(['d'])
+        self.blocked = set()
+        self.db = {}
+        self.started = False
+
+
+def test_failure_budget():
+    saved = FailureBudget.max_failures, FailureBudget.instance_some_jobs
+
+    def instance_some_jobs(manager):
+        manager.started = True
+        return {}
+
+    FailureBudget.instance_some_jobs = instance_some_jobs
+    FailureBudget.not_run = set()
+    try:
+        FailureBudget.max_failures = 2
+        m = FakeManager(failed=['a'])
+        instance_some_jobs_with_budget(m)
+        assert m.started
+
+        m = FakeManager(failed=['a', 'b'])
+        instance_some_jobs_with_budget(m)
+        assert not m.started
+        assert not m.todo and not m.ready_todo
+        assert m.blocked == set(['c', 'd'])
+        assert m.db[JOBS_NOT_RUN_KEY] == ['c', 'd']
+        assert get_jobs_not_run(m.db) == set(['c', 'd'])
+    finally:
+        FailureBudget.max_failures, FailureBudget.instance_some_jobs = saved
+        FailureBudget.not_run = set()
+
+
+def test_manager_patchable():
+    """ Fails if compmake changes what instance_some_jobs_with_budget() wraps. """
+    from compmake.jobs.manager import Manager
+    assert get_manager_class() is Manager
+
+    instance_some_jobs = Manager.__dict__['instance_some_jobs']
+    Manager.instance_some_jobs = lambda self, limit: None
+    try:
+        assert get_manager_class() is None
+    finally:
+        Manager.instance_some_jobs = instance_some_jobs
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import tempfile
+
+from comptests.coverage_report import coverage_counts, write_coverage_report
+from comptests.nose import call_nosetests_plus_coverage
+
+
+def test_coverage_counts():
+    assert coverage_counts(0, 0)['percent'] == 100.0
+    assert coverage_counts(8, 2) == dict(statements=8, missing=2, percent=75.0)
+
+
+def test_coverage_report():
+    try:
+        import coverage
+    except ImportError:
+        return
+    dirname = tempfile.mkdtemp()
+    try:
+        coverage_file = os.path.join(dirname, '.coverage.comptests_ex')
+        cov = coverage.Coverage(data_file=coverage_file, config_file=False)
+        cov.start()
+        from comptests_ex.test_yield import check_it
+        check_it(0)
+        cov.stop()
+        cov.save()
+
+        outdir = os.path.join(dirname, 'coverage')
+        write_coverage_report(outdir, [coverage_file], ['comptests_ex'])
+        assert os.path.exists(coverage_file)
+        assert os.path.exists(os.path.join(outdir, 'index.html'))
+        assert os.path.exists(os.path.join(outdir, 'coverage.xml'))
+        with open(os.path.join(outdir, 'summary.json')) as f:
+            summary = json.load(f)
+        assert summary['total']['statements'] > 0, summary
+
+        # nothing changed: the report is not written again
+        os.unlink(os.path.join(outdir, 'coverage.xml'))
+        write_coverage_report(outdir, [coverage_file], ['comptests_ex'])
+        assert not os.path.exists(os.path.join(outdir, 'coverage.xml'))
+
+        # the jobs that wrote no data are ignored
+        outdir2 = os.path.join(dirname, 'coverage2')
+        write_coverage_report(outdir2, [coverage_file + '.missing'], ['comptests_ex'])
+        assert not os.path.exists(os.path.join(outdir2, 'index.html'))
+    finally:
+        shutil.rmtree(dirname)
+
+
+def test_coverage_job():
+    """ The combined data has the lines run when importing the module. """
+    try:
+        import coverage
+    except ImportError:
+        return
+    # as in the workers, which have already imported the module
+    import comptests_ex.test_yield  # @UnusedImport
+    dirname = tempfile.mkdtemp()
+    try:
+        coverage_dir = os.path.join(dirname, 'coverage-data')
+        coverage_file, error = call_nosetests_plus_coverage('comptests_ex', coverage_dir)
+        assert error is None, error
+        outdir = os.path.join(dirname, 'coverage')
+        write_coverage_report(outdir, [coverage_file], ['comptests_ex'])
+
+        cov = coverage.Coverage(data_file=os.path.join(outdir, '.coverage'),
+                                config_file=False)
+        cov.load()
+        data = cov.get_data()
+        measured = [f for f in data.measured_files()
+                    if f.endswith(os.path.join('comptests_ex', 'test_yield.py'))]
+        assert len(measured) == 1, data.measured_files()
+        lines = data.lines(measured[0])
+        # the definitions of check_it() and test_yielding()
+        assert 2 in lines and 5 in lines, lines
+    finally:
+        shutil.rmtree(dirname)
@@ -0,0 +1,26 @@
+# -*- coding: utf-8 -*-
+from comptests.dedupe import find_aliased, find_canonical
+
+
+def test_find_canonical():
+    specs = {
+        'a': dict(id='a', desc='one', code=['mod.Class', dict(x=1, y=2)]),
+        'b': dict(id='b', desc='two', code=['mod.Class', dict(y=2, x=1)]),
+        'c': dict(id='c', code=['mod.Class', dict(x=2, y=2)]),
+        'd': dict(id='d'),
+        'e': dict(id='e'),
+    }
+    canonical = find_canonical(specs)
+    assert canonical == dict(a='a', b='a', c='c', d='d', e='e'), canonical
+
+
+def test_find_aliased():
+    canonical = dict(a='a', b='a', c='c', d='c')
+    cells = [('a', 'a'), ('a', 'b'), ('b', 'b'), ('c', 'd'), ('d', 'd')]
+
+    def canonical_cell(cell):
+        return canonical[cell[0]], canonical[cell[1]]
+
+    aliased = find_aliased(cells, canonical_cell)
+    # ('d', 'd') is an alias of ('c', 'c'), which is not tested
+    assert aliased == {('a', 'b'): ('a', 'a'), ('b', 'b'): ('a', 'a')}, aliased
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import json
 import os
 import tempfile
 from contextlib import contextmanager
@@ -50,6 +51,8 @@ def test_example_package():
             msg = 'Files not found:\n' + '\n'.join(errors)
             raise Exception(msg)
 
+        check_coverage_summary(os.path.join(cwd, 'out-comptests/coverage/summary.json'))
+
         print('now calling comptests-to-junit')
         cmd = ['comptests-to-junit', 'out-comptests/compmake']
         system_cmd_result(cwd, cmd,
@@ -58,6 +61,29 @@ def test_example_package():
                           raise_on_error=True)
 
 
+def check_coverage_summary(filename):
+    """ The merged report covers all the files of example_package,
+        including the lines run when importing them. """
+    try:
+        import coverage  # @UnusedImport
+    except ImportError:
+        return
+    with open(filename) as f:
+        summary = json.load(f)
+
+    def percent(name):
+        found = [v['percent'] for k, v in summary['files'].items()
+                 if k.endswith(os.path.join('example_package', name))]
+        assert len(found) == 1, (name, summary)
+        return found[0]
+
+    # only module-level code is run when importing it
+    assert percent('configuration.py') == 100.0, summary
+    assert percent('__init__.py') > 0, summary
+    assert percent('interfaces.py') > 0, summary
+    assert summary['total']['percent'] > 50, summary
+
+
 @contextmanager
 def create_tmp_dir():
     dirname = tempfile.mkdtemp()
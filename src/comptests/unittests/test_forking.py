@@ -0,0 +1,28 @@
+# -*- coding: utf-8 -*-
+import os
+
+from comptests.forking import ForkedError, can_fork, run_forked
+
+
+def double_pid(x):
+    print('in the child')
+    return x * 2, os.getpid()
+
+
+def failing(x):
+    raise ValueError('bad %s' % x)
+
+
+def test_run_forked():
+    if not can_fork():
+        return
+    value, pid = run_forked(double_pid, 21)
+    assert value == 42
+    assert pid != os.getpid()
+
+    try:
+        run_forked(failing, 1)
+    except ForkedError as e:
+        assert 'ValueError: bad 1' in str(e)
+    else:
+        raise Exception('Expected failure')
@@ -0,0 +1,76 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from comptests.fingerprints import (function_fingerprint, spec_fingerprint,
+                                    comptest_fingerprint, comptest_identity,
+                                    spec_code_fingerprint, SourceFingerprints)
+from comptests.incremental import IncrementalStore
+
+
+def f1(id_ob, ob):
+    assert ob.param1 > 0
+
+
+def f2(id_ob, ob):
+    assert ob.param1 > 1
+
+
+def make_closure(value):
+    def f(id_ob, ob):
+        assert ob.param1 > value
+
+    return f
+
+
+def test_fingerprints():
+    assert function_fingerprint(f1) != function_fingerprint(f2)
+    assert function_fingerprint(f1) == function_fingerprint(f1)
+    c1 = make_closure(1)
+    c2 = make_closure(2)
+    assert function_fingerprint(c1) != function_fingerprint(c2)
+    assert function_fingerprint(c1) == function_fingerprint(make_closure(1))
+
+    spec1 = dict(id='a', code=['m.C', dict(x=1, y=2)])
+    spec2 = dict(code=['m.C', dict(y=2, x=1)], id='a')
+    spec3 = dict(id='a', code=['m.C', dict(x=1, y=3)])
+    assert spec_fingerprint(spec1) == spec_fingerprint(spec2)
+    assert spec_fingerprint(spec1) != spec_fingerprint(spec3)
+
+    fp1 = comptest_fingerprint(f1, [spec_fingerprint(spec1)])
+    fp3 = comptest_fingerprint(f1, [spec_fingerprint(spec3)])
+    assert fp1 != fp3
+
+    assert comptest_identity(f1, 'a', 'b') == '%s:f1:a:b' % __name__
+
+
+def test_source_fingerprints():
+    fp1 = comptest_fingerprint(f1)
+    # the source file of the module of the test changed
+    SourceFingerprints.cache[os.path.realpath(__file__.replace('.pyc', '.py'))] = 'changed'
+    try:
+        assert comptest_fingerprint(f1) != fp1
+    finally:
+        SourceFingerprints.cache.clear()
+    assert comptest_fingerprint(f1) == fp1
+
+    spec = dict(id='c1', code=['example_package.ExampleClass1', dict(param1=1)])
+    assert spec_code_fingerprint(spec) is not None
+    assert spec_code_fingerprint(dict(id='c1')) is None
+
+
+def test_incremental_store():
+    d = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(d, 'state', 'incremental.sqlite')
+        store = IncrementalStore(fn)
+        assert not store.is_unchanged('m:f1', 'fp1')
+        store.record_success('m:f1', 'fp1')
+        assert store.is_unchanged('m:f1', 'fp1')
+
+        store2 = IncrementalStore(fn)
+        assert store2.is_unchanged('m:f1', 'fp1')
+        assert not store2.is_unchanged('m:f1', 'fp2')
+    finally:
+        shutil.rmtree(d)
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+import shutil
+import tempfile
+
+from compmake.jobs.storage import set_job_userobject
+from compmake.storage.filesystem import StorageFilesystem
+from comptests.objcache import (ObjectRef, get_object_cache, is_instances_job,
+                                resolve_object, set_object_cache_size)
+
+
+def test_instances_job_ids():
+    assert is_instances_job('mod-example_class1-instances3')
+    assert not is_instances_job('mod-example_class1-instance-c1a')
+
+
+def test_instances_group_cached():
+    """ Loading one object of an -instancesN job caches the others. """
+    d = tempfile.mkdtemp()
+    try:
+        job_id = 'mod-s-instances0'
+        db = StorageFilesystem(d, compress=False)
+        set_job_userobject(job_id, {'a': ('fa', 'A'), 'b': ('fb', 'B')}, db)
+
+        def make_ref(id_object, fingerprint):
+            return ObjectRef('m', 's', id_object, fingerprint, job_id, d, False)
+
+        set_object_cache_size(1)
+        assert resolve_object(make_ref('a', 'fa')) == 'A'
+        cache = get_object_cache()
+        assert len(cache) == 2
+        assert resolve_object(make_ref('b', 'fb')) == 'B'
+        assert cache.hits == 1 and cache.misses == 1, cache
+
+        # without the cache, only the object asked is loaded
+        set_object_cache_size(0)
+        assert resolve_object(make_ref('b', 'fb')) == 'B'
+        assert len(get_object_cache()) == 0
+    finally:
+        set_object_cache_size(0)
+        shutil.rmtree(d)
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import sys
+import tempfile
+
+from comptests.collection import CollectionStore, module_fingerprint
+from comptests.forking import can_fork
+from comptests.nose import (call_nosetests, collect_nose_cases, get_nose_cases,
+                            run_nose_batch)
+
+
+def test_nose_batches():
+    tests = collect_nose_cases('comptests_ex')
+    names = [name for name, _, _ in tests]
+    assert names == ['comptests_ex.test_yield:test_yielding'] * 3, tests
+    assert [index for _, index, _ in tests] == [0, 1, 2]
+
+    # each generated test can run separately
+    outcomes = run_nose_batch('comptests_ex', tests[1:])
+    test_id = 'comptests_ex.test_yield.test_yielding(1,)'
+    assert sorted(outcomes) == [test_id, 'comptests_ex.test_yield.test_yielding(2,)']
+    assert not outcomes[test_id].failed()
+
+    outcomes = run_nose_batch('comptests_ex', [('comptests_ex.test_yield:test_yielding', 5, 'x')])
+    assert outcomes['x'].failed()
+
+
+def test_nosetests_preload():
+    if not can_fork():
+        return
+    before = set(sys.modules)
+    call_nosetests('comptests_ex', preload=['xml.dom.minidom'])
+    added = set(sys.modules) - before
+    # the dependencies are imported by the worker, the module under test is not
+    assert 'xml.dom.minidom' in sys.modules
+    assert not [m for m in added if m.startswith('comptests_ex')], added
+
+
+def test_collection_store():
+    dirname = tempfile.mkdtemp()
+    try:
+        filename = os.path.join(dirname, 'collection.sqlite')
+        fingerprint = module_fingerprint('comptests_ex')
+        assert fingerprint is not None
+        assert module_fingerprint('comptests_ex') == fingerprint
+        assert module_fingerprint('comptests_no_such_module') is None
+
+        tests = collect_nose_cases('comptests_ex')
+        store = CollectionStore(filename)
+        assert store.get('comptests_ex', fingerprint) is None
+        store.put('comptests_ex', fingerprint, tests)
+        assert store.get('comptests_ex', fingerprint) == tests
+        assert store.get('comptests_ex', 'other') is None
+
+        # collected and saved, then read back
+        filename2 = os.path.join(dirname, 'collection2.sqlite')
+        assert get_nose_cases('comptests_ex', filename2) == tests
+        assert CollectionStore(filename2).get('comptests_ex', fingerprint) == tests
+        assert get_nose_cases('comptests_ex', filename2) == tests
+    finally:
+        shutil.rmtree(dirname)
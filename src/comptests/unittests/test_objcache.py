@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from comptests.objcache import ObjectCache
+
+
+def test_object_cache_lru():
+    cache = ObjectCache(max_bytes=100)
+    cache.put('a', 'A', 40)
+    cache.put('b', 'B', 40)
+    assert cache.get('a') == 'A'
+    # b is now the least recently used
+    cache.put('c', 'C', 40)
+    assert 'a' in cache
+    assert 'c' in cache
+    assert not 'b' in cache
+    assert cache.nbytes == 80
+
+    try:
+        cache.get('b')
+    except KeyError:
+        pass
+    else:
+        raise Exception('Expected KeyError')
+    assert cache.hits == 1
+    assert cache.misses == 1
+
+    # too big to be cached at all
+    cache.put('d', 'D', 101)
+    assert not 'd' in cache
+    assert len(cache) == 2
+
+
+def test_instanced_objects():
+    from comptests.objcache import (ObjectCacheStorage, cache_object,
+                                    set_object_cache_size)
+    spec = {'id': 'a', 'code': ['m.A', {}]}
+    try:
+        # disabled by default: nothing is kept
+        cache_object('m', 's', {'a': spec}, {'a': 'A'})
+        assert ObjectCacheStorage.instanced == {}
+
+        set_object_cache_size(1)
+        cache_object('m', 's', {'a': spec, 'b': spec}, {'a': 'A', 'b': 'B'})
+        kept = sorted(ObjectCacheStorage.instanced.values())
+        assert kept == [('A', 2), ('B', 2)]
+    finally:
+        set_object_cache_size(0)
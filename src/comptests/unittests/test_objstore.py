@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import time
+
+import example_package.configuration
+from comptests.fingerprints import SourceFingerprints
+from comptests.objstore import ObjectStore, object_store_key
+
+
+def test_object_store():
+    d = tempfile.mkdtemp()
+    try:
+        store = ObjectStore(d)
+        spec = dict(id='c1a', code=['example_package.ExampleClass1', dict(param1=10)])
+        key = object_store_key(spec)
+        assert key is not None
+        spec2 = dict(id='c1a', code=['example_package.ExampleClass1', dict(param1=11)])
+        assert key != object_store_key(spec2)
+        # the same object with another id
+        assert key == object_store_key(dict(spec, id='c1b', desc='alias'))
+        assert object_store_key(dict(id='c1a')) is None
+
+        # a module imported by the package of the class changed
+        filename = os.path.realpath(example_package.configuration.__file__)
+        SourceFingerprints.cache[filename.replace('.pyc', '.py')] = 'changed'
+        try:
+            assert object_store_key(spec) != key
+        finally:
+            SourceFingerprints.cache.clear()
+        assert object_store_key(spec) == key
+
+        try:
+            store.get(key)
+        except KeyError:
+            pass
+        else:
+            raise Exception('Expected KeyError')
+        store.put(key, 'A' * 1000)
+        assert store.get(key) == 'A' * 1000
+
+        store.put('old', 'B' * 1000)
+        past = time.time() - 100
+        os.utime(os.path.join(d, 'old.pickle'), (past, past))
+        assert store.evict(1500) == 1
+        assert store.get(key) == 'A' * 1000
+        assert store.clear() == 1
+    finally:
+        shutil.rmtree(d)
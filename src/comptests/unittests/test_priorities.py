@@ -0,0 +1,15 @@
+# -*- coding: utf-8 -*-
+from comptests.priorities import get_priority_module
+
+
+def test_priority_patchable():
+    """ Fails if compmake changes what compute_priority_with_durations() wraps. """
+    from compmake.jobs import priority
+    assert get_priority_module() is priority
+
+    compute_priority = priority.compute_priority
+    priority.compute_priority = lambda job_id, cq: 0
+    try:
+        assert get_priority_module() is None
+    finally:
+        priority.compute_priority = compute_priority
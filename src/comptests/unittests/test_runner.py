@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from comptests.runner import parse_runner_args, run_tasks
+
+
+def passes(x):
+    assert x == 1
+
+
+def test_parse_runner_args():
+    assert parse_runner_args([]) == (None, None)
+    assert parse_runner_args(['check']) == ('check', None)
+    assert parse_runner_args(['-j', '4', 'check']) == ('check', 4)
+    assert parse_runner_args(['check', '-j2']) == ('check', 2)
+
+
+def test_run_tasks():
+    tasks = [('a', passes, (1,), {}),
+             ('b', passes, (2,), {}),
+             ('c', passes, (1,), {})]
+    for nprocesses in [None, 2]:
+        results = run_tasks(tasks, nprocesses)
+        assert list(results) == ['a', 'b', 'c']
+        assert results['a'].es is None
+        assert results['b'].en == 'AssertionError'
@@ -0,0 +1,198 @@
+# -*- coding: utf-8 -*-
+import json
+import os
+import shutil
+import sys
+import tempfile
+
+from comptests.impact import (FootprintStore, Impact, is_affected, is_coverage_running,
+                              run_traced)
+from comptests.selection import (NOT_APPLICABLE, Selection, balance_shards,
+                                 filter_compatible, get_pair_cells, hash_shard,
+                                 in_this_shard, parse_shard, sample_cells, set_shard)
+from comptests.timing import Timing, TimingStore
+
+
+def test_parse_shard():
+    assert parse_shard('1/4') == (1, 4)
+    for s in ['4/4', '1', 'a/b', '-1/2']:
+        try:
+            parse_shard(s)
+        except ValueError:
+            pass
+        else:
+            raise Exception('Expected failure for %r' % s)
+
+
+def test_balance_shards():
+    durations = {'m:a': 10.0, 'm:b': 6.0, 'm:c': 5.0, 'm:d': 1.0}
+    assignment = balance_shards(durations, 2)
+    load = [0.0, 0.0]
+    for identity, i in assignment.items():
+        load[i] += durations[identity]
+    assert sorted(load) == [11.0, 11.0]
+    assert hash_shard('m:e', 3) == hash_shard('m:e', 3)
+
+
+def test_shards_partition():
+    """ Two machines with different timing DBs agree on the shards. """
+    d = tempfile.mkdtemp()
+    identities = ['m:f:%d' % i for i in range(50)]
+    durations = os.path.join(d, 'durations.json')
+    with open(durations, 'w') as f:
+        # only some of the tests
+        json.dump(dict((k, float(i)) for i, k in enumerate(identities[:30])), f)
+    total = 3
+    try:
+        for durations_file in [None, durations]:
+            shards = []
+            for node in range(2):
+                # each machine has its own history
+                Timing.filename = os.path.join(d, 'node%d' % node, 'timing.sqlite')
+                store = TimingStore(Timing.filename)
+                for identity in identities[node::2]:
+                    store.record(identity, None, 100.0 * (node + 1), 0.0, 0, 'ok')
+                for index in range(total):
+                    if index % 2 != node:  # each node runs some of the shards
+                        continue
+                    set_shard(index, total, durations=durations_file)
+                    shards.append(set(k for k in identities if in_this_shard(k)))
+            assert len(shards) == total
+            assert sum(len(s) for s in shards) == len(identities)
+            assert set.union(*shards) == set(identities)
+    finally:
+        Timing.filename = None
+        Selection.shard = None
+        Selection.durations = None
+        Selection.assignment = None
+        shutil.rmtree(d)
+
+
+def test_is_affected():
+    d = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(d, 'footprints.sqlite')
+        FootprintStore(fn).record('m:f:a', ['/src/m.py', '/src/n.py'])
+        Impact.filename = fn
+        Impact.changed_files = set(['/src/n.py'])
+        assert is_affected('m:f:a')
+        assert is_affected('m:f:unknown')
+        Impact.changed_files = set(['/src/other.py', '/conf/a.yaml'])
+        assert not is_affected('m:f:a')
+        assert is_affected('m:f:a', ['/conf/a.yaml'])
+    finally:
+        Impact.filename = None
+        Impact.changed_files = None
+        Impact.stores.clear()
+        shutil.rmtree(d)
+
+
+def read_param(id_ob, ob):
+    return ob.param
+
+
+def test_constructor_changed():
+    """ The tests are affected by the module of the class of their objects,
+        even if they do not run any of its code. """
+    try:
+        import coverage  # @UnusedImport
+    except ImportError:
+        return
+    if is_coverage_running():
+        return
+    d = tempfile.mkdtemp()
+    sys.path.insert(0, d)
+    try:
+        module = os.path.join(d, 'comptests_constructor_ex.py')
+        with open(module, 'w') as f:
+            f.write('class Thing(object):\n'
+                    '    def __init__(self, param):\n'
+                    '        self.param = param\n')
+        from comptests_constructor_ex import Thing
+        fn = os.path.join(d, 'footprints.sqlite')
+        assert run_traced(fn, 'm:read_param:a', [(None, Thing(1))],
+                          read_param, 'a', Thing(1)) == 1
+
+        with open(module, 'a') as f:
+            f.write('        self.param2 = 2 * param\n')
+        Impact.filename = fn
+        Impact.changed_files = set([os.path.realpath(module)])
+        assert is_affected('m:read_param:a')
+        Impact.changed_files = set([os.path.join(d, 'other.py')])
+        assert not is_affected('m:read_param:a')
+    finally:
+        sys.path.remove(d)
+        sys.modules.pop('comptests_constructor_ex', None)
+        Impact.filename = None
+        Impact.changed_files = None
+        Impact.stores.clear()
+        shutil.rmtree(d)
+
+
+def test_filter_compatible():
+    specs1 = {'a': {'dim': 2}, 'b': {'dim': 3}}
+    specs2 = {'x': {'dim': 2}, 'y': {'dim': 3}}
+
+    def same_dim(id_ob1, spec1, id_ob2, spec2):
+        return spec1['dim'] == spec2['dim']
+
+    combinations = [(None, a, b) for a in sorted(specs1) for b in sorted(specs2)]
+    accepted, excluded = filter_compatible(combinations, specs1, specs2, same_dim)
+    assert accepted == [(None, 'a', 'x'), (None, 'b', 'y')]
+    assert excluded == {('a', 'y'): NOT_APPLICABLE, ('b', 'x'): NOT_APPLICABLE}
+    accepted, excluded = filter_compatible(combinations, specs1, specs2, None)
+    assert accepted == combinations and not excluded
+
+
+def test_pair_cells():
+    specs = {'a': {'dim': 2}, 'b': {'dim': 3}, 'c': {'dim': 2}}
+
+    def same_dim(id_ob1, spec1, id_ob2, spec2):
+        return spec1['dim'] == spec2['dim']
+
+    ids = sorted(specs)
+    assert get_pair_cells(specs, specs, ids, ids, compatible=same_dim) == \
+        [('a', 'a'), ('a', 'c'), ('b', 'b'), ('c', 'a'), ('c', 'c')]
+    assert get_pair_cells(specs, specs, ids, ids, symmetric=True, diagonal=False) == \
+        [('a', 'b'), ('a', 'c'), ('b', 'c')]
+
+
+def test_shard_objects():
+    from conf_tools import GlobalConfig
+    from comptests.registrar import get_shard_objects
+    from example_package import get_example_package_config
+    GlobalConfig.global_load_dir('example_package.configs')
+    import example_package.unittests  # @UnusedImport registers the tests
+    cm = get_example_package_config()
+    ids = dict((name, set(objspec.keys())) for name, objspec in cm.specs.items())
+    assert get_shard_objects(cm) is None
+    total = 40
+    used = dict((name, set()) for name in ids)
+    try:
+        fewer = False
+        for i in range(total):
+            set_shard(i, total)
+            needed = get_shard_objects(cm)
+            for name in ids:
+                assert needed[name] <= ids[name]
+                used[name].update(needed[name])
+                fewer = fewer or needed[name] != ids[name]
+        # some shards do not need all the objects
+        assert fewer
+        assert used == ids, used
+    finally:
+        Selection.shard = None
+        Selection.assignment = None
+
+
+def test_sample_cells():
+    cells = [('a%d' % i, 'b%d' % j) for i in range(20) for j in range(30)]
+    chosen = sample_cells(cells, cover=2, seed=1)
+    assert chosen == sample_cells(list(reversed(cells)), cover=2, seed=1)
+    assert len(chosen) < len(cells) / 4
+    for i in range(20):
+        assert len([1 for a, _ in chosen if a == 'a%d' % i]) >= 2
+    for j in range(30):
+        assert len([1 for _, b in chosen if b == 'b%d' % j]) >= 2
+    assert len(sample_cells(cells, sample=50, seed=1)) == 50
+    assert len(sample_cells(cells, sample=5000, seed=1)) == len(cells)
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+
+from comptests.state import deferred_writes
+from comptests.timing import TimingStore, run_timed
+
+
+def f(x):
+    if x < 0:
+        raise ValueError(x)
+    return x
+
+
+def allocate(nbytes):
+    return len(b'x' * nbytes)
+
+
+def test_timing_store():
+    d = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(d, 'state', 'timing.sqlite')
+        assert run_timed(fn, 'm:f:a', f, 1) == 1
+        assert run_timed(fn, 'm:f:a', f, 2) == 2
+        try:
+            run_timed(fn, 'm:f:b', f, -1)
+        except ValueError:
+            pass
+        else:
+            raise Exception('Expected failure')
+
+        store = TimingStore(fn)
+        outcomes = [row[4] for row in store.trend('m:f:a')]
+        assert outcomes == ['ok', 'ok']
+        assert store.trend('m:f:b')[0][4] == 'failed'
+        assert set(x[0] for x in store.slowest(5)) == set(['m:f:a', 'm:f:b'])
+        assert [x[0] for x in store.variance(5)] == ['m:f:a']
+        assert set(store.get_durations()) == set(['m:f:a', 'm:f:b'])
+
+        # the memory that the test needed more than the ones before
+        run_timed(fn, 'm:g', allocate, 50 * 1024 * 1024)
+        run_timed(fn, 'm:f:c', f, 3)
+        if store.trend('m:g')[0][3] is not None:  # not on Windows
+            assert store.trend('m:g')[0][3] >= 40 * 1024 * 1024
+            assert store.trend('m:f:c')[0][3] < 40 * 1024 * 1024
+    finally:
+        shutil.rmtree(d)
+
+
+def test_deferred_writes():
+    d = tempfile.mkdtemp()
+    try:
+        fn = os.path.join(d, 'state', 'timing.sqlite')
+        store = TimingStore(fn)
+        store.create()
+        with deferred_writes():
+            run_timed(fn, 'm:f:a', f, 1)
+            run_timed(fn, 'm:f:b', f, 2)
+            # written at the end of the job
+            assert store.trend('m:f:a') == []
+        assert len(store.trend('m:f:a')) == 1
+        assert len(store.trend('m:f:b')) == 1
+    finally:
+        shutil.rmtree(d)
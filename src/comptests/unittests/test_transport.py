@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+import pickle
+import shutil
+import tempfile
+
+from comptests.transport import MappedObject, map_arrays, unmap_arrays
+
+
+def test_mapped_arrays():
+    import numpy as np
+
+    d = tempfile.mkdtemp()
+    try:
+        big = np.arange(300000, dtype='float64')
+        ob = dict(big=big, small=np.zeros(3), name='map')
+        mapped = map_arrays(ob, d)
+        assert isinstance(mapped, MappedObject)
+        assert len(mapped.filenames) == 1
+        # what is stored in the compmake DB is small
+        assert len(pickle.dumps(mapped)) < big.nbytes / 100
+
+        ob2 = unmap_arrays(pickle.loads(pickle.dumps(mapped)))
+        assert isinstance(ob2['big'], np.memmap)
+        assert np.all(ob2['big'] == big)
+        assert ob2['name'] == 'map'
+        # copy-on-write: the file is not modified
+        ob2['big'][0] = -1
+        assert unmap_arrays(mapped)['big'][0] == 0
+
+        assert not isinstance(map_arrays(dict(a=1), d), MappedObject)
+    finally:
+        shutil.rmtree(d)
@@ -1,8 +1,9 @@
 from comptests.registrar import comptest, comptest_dynamic, comptest_fails
 from example_package.unittests.generation import for_some_class1, \
     for_some_class1_class2
-from .generation import (for_all_class1, for_all_class1_class2,
-                         for_all_class1_class2_dynamic, for_all_class1_dynamic)
+from .generation import (for_all_class1, for_all_class1_class1_symmetric,
+                         for_all_class1_class2, for_all_class1_class2_dynamic,
+                         for_all_class1_dynamic)
 
 
 @comptest
@@ -33,7 +34,7 @@ def check_some_class1(id_ob, _):
 
 @for_some_class1_class2('c1*', 'c2*')
 def check_some_class1_class2(id_ob1, _, id_ob2, _2):
-    assert id_ob1 in ['c1a', 'c1b']
+    assert id_ob1 in ['c1a', 'c1b', 'c1c']
     assert id_ob2 == 'c2a'
 
 
@@ -49,6 +50,11 @@ def check_class1_class2(id_ob1, _, id_ob2, _2):
     print('check_class1_class2(%r,%r)' % (id_ob1, id_ob2))
 
 
+@for_all_class1_class1_symmetric
+def check_class1_class1(id_ob1, _, id_ob2, _2):
+    assert id_ob1 <= id_ob2
+
+
 @for_all_class1_dynamic
 def check_class1_dynamic(context, _, ob1):
     r = context.comp(report_class1, ob1)
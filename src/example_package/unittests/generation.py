@@ -12,6 +12,8 @@ for_some_class1 = comptests_for_some(library_class1)
 for_some_class1_class2 = comptests_for_some_pairs(library_class1, library_class2)
 
 for_all_class1_class2 = comptests_for_all_pairs(library_class1, library_class2)
+for_all_class1_class1_symmetric = comptests_for_all_pairs(library_class1, library_class1,
+                                                          symmetric=True)
 for_all_class1_dynamic = comptests_for_all_dynamic(library_class1)
 for_all_class1_class2_dynamic = comptests_for_all_pairs_dynamic(library_class1, library_class2)
 